@@ -0,0 +1,409 @@
+"""
+Бенчмарк пайплайна обработки видео.
+
+Генерирует синтетические ролики через lavfi (портрет/альбом, 720p/1080p/4K,
+H.264/HEVC/HDR HEVC, MOV/MP4), прогоняет все варианты пайплайна с заглушкой вместо LLM,
+микробенчмарки раскладки текста, рендера подложки и анализа кадров, сравнение движков
+подписи (PNG-overlay и ASS) по SSIM/PSNR.
+Результат пишется в JSON, чтобы сравнивать коммиты между собой.
+
+    python bench.py --output bench.json
+    python bench.py --quick --repeat 1
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import re
+import statistics
+import subprocess
+import tempfile
+
+# main.py создает Bot при импорте: для бенчмарка нужен только валидный по формату токен
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import main
+
+
+RESOLUTIONS = {"720p": (1280, 720), "1080p": (1920, 1080), "4k": (3840, 2160)}
+ORIENTATIONS = ("landscape", "portrait")
+CODECS = {"h264": "libx264", "hevc": "libx265", "hdr": "libx265"}  # hdr - 10-битный HEVC HLG, как с iPhone
+CONTAINERS = ("mp4", "mov")
+
+STUB_THEME = "Философия барберинга, мужской стиль и уход за собой"
+STUB_TITLE = "Бритва не спорит с волосом — она просто знает, куда идти"
+STUB_DESCRIPTION = "Описание для бенчмарка.\n\n#барбер #стиль"
+
+CAPTIONS = {
+    "short": "Стрижка — это решение",
+    "long": (
+        "Каждый клиент приходит не за стрижкой, а за ощущением, что он снова "
+        "управляет своей жизнью — хотя бы на пару сантиметров"
+    )
+}
+
+
+def stub_llm(theme, avoid=None):
+    """Заглушка LLM: бенчмарк меряет только видео"""
+    return STUB_TITLE, STUB_DESCRIPTION
+
+
+def generate_input(folder, resolution, orientation, codec, container, duration):
+    """Синтетический ролик с тестовой картинкой и тоном через lavfi"""
+    width, height = RESOLUTIONS[resolution]
+    if orientation == "portrait":
+        width, height = height, width
+
+    path = os.path.join(folder, f"{resolution}_{orientation}_{codec}.{container}")
+    if os.path.exists(path):
+        return path
+
+    cmd = [
+        main.FFMPEG_PATH,
+        '-f', 'lavfi', '-i', f"testsrc2=size={width}x{height}:rate=30:duration={duration}",
+        '-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        '-c:v', CODECS[codec],
+        '-preset', 'ultrafast',
+        '-pix_fmt', 'yuv420p10le' if codec == "hdr" else 'yuv420p',
+        '-c:a', 'aac',
+        '-shortest'
+    ]
+    if codec == "hdr":
+        cmd += ['-color_primaries', 'bt2020', '-color_trc', 'arib-std-b67', '-colorspace', 'bt2020nc']
+    if codec in ("hevc", "hdr"):
+        cmd += ['-tag:v', 'hvc1']
+    cmd += ['-y', path]
+
+    subprocess.run(cmd, capture_output=True, check=True)
+    return path
+
+
+def generate_photo(folder, index, width=960, height=1280):
+    """Синтетическое фото: тестовая картинка с легким шумом, как у снимка с телефона"""
+    path = os.path.join(folder, f"photo_{index}_{width}x{height}.jpg")
+    if os.path.exists(path):
+        return path
+    subprocess.run([
+        main.FFMPEG_PATH,
+        '-f', 'lavfi', '-i', f"testsrc2=size={width}x{height},noise=alls=5:allf=t,hue=h={index * 36}",
+        '-frames:v', '1', '-q:v', '3', '-y', path
+    ], capture_output=True, check=True)
+    return path
+
+
+# Варианты пайплайна: имя -> функция(input_path, output_path)
+def variant_full(input_path, output_path):
+    """Полный путь бота, как в VideoPipeline: текст, обрезка, анализ кадров и process_video с обложкой"""
+    title, _ = main.generate_title_and_description(STUB_THEME)
+    trim = main.plan_trim(input_path) if main.trim_enabled() else None
+    analysis = main.analyze_frames(input_path, trim) if main.PLACEMENT_ANALYSIS else None
+    cover = main.cover_path(output_path)
+    try:
+        return main.process_video(input_path, output_path, title, analysis=analysis, trim=trim, cover=cover)
+    finally:
+        if os.path.exists(cover):
+            os.remove(cover)
+
+
+def variant_overlay_only(input_path, output_path):
+    """Только наложение подложки, без предварительной конвертации"""
+    return main.add_text_with_rounded_box(input_path, output_path, STUB_TITLE)
+
+
+def variant_ass(input_path, output_path):
+    """Подпись субтитрами ASS (libass) вместо PNG-подложки"""
+    return main.add_text_with_ass(input_path, output_path, STUB_TITLE)
+
+
+def variant_ass_typewriter(input_path, output_path):
+    """ASS с анимацией печати: караоке-теги на каждый символ"""
+    return main.add_text_with_ass(input_path, output_path, STUB_TITLE, animation="typewriter")
+
+
+def variant_renditions(input_path, output_path):
+    """Все форматы (9:16, 1:1, 4:5) одним запуском FFmpeg"""
+    outputs = main.rendition_paths(output_path, main.RENDITIONS)
+    try:
+        return main.add_text_renditions(input_path, outputs, STUB_TITLE)
+    finally:
+        for path in outputs.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+
+PIPELINE_VARIANTS = {
+    "full": variant_full,
+    "overlay_only": variant_overlay_only,
+    "ass": variant_ass,
+    "ass_typewriter": variant_ass_typewriter,
+    "renditions": variant_renditions
+}
+
+
+def summarize(samples):
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "runs": len(samples)
+    }
+
+
+def bench_pipeline(work_dir, matrix, variants, repeat, duration):
+    results = []
+    for resolution, orientation, codec, container in matrix:
+        input_path = generate_input(work_dir, resolution, orientation, codec, container, duration)
+
+        for name in variants:
+            func = PIPELINE_VARIANTS[name]
+            timings = []
+            stages = {}
+            ok = True
+
+            for _ in range(repeat):
+                stem = os.path.splitext(os.path.basename(input_path))[0]
+                output_path = os.path.join(work_dir, f"out_{name}_{stem}.mp4")
+                trace = main.start_trace(0, STUB_THEME)
+                started = time.perf_counter()
+                ok = func(input_path, output_path) and ok
+                timings.append(time.perf_counter() - started)
+                trace.finish()
+
+                for span in trace.spans:
+                    stages.setdefault(span["name"], []).append(span["end"] - span["start"])
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+
+            results.append({
+                "variant": name,
+                "resolution": resolution,
+                "orientation": orientation,
+                "codec": codec,
+                "container": container,
+                "duration": duration,
+                "input_bytes": os.path.getsize(input_path),
+                "ok": ok,
+                "seconds": summarize(timings),
+                "stages": {stage: summarize(values) for stage, values in stages.items()}
+            })
+            logging.warning(
+                f"{name:>14} {resolution:>5} {orientation:>9} {codec:>4} {container}: "
+                f"{statistics.median(timings):.2f}с{'' if ok else ' (ОШИБКА)'}"
+            )
+    return results
+
+
+def bench_slideshow(work_dir, repeat, photos):
+    """Ролик из фото против ролика с камеры той же длины (1080p portrait H.264)"""
+    paths = [generate_photo(work_dir, index, *((1280, 960) if index % 2 else (960, 1280))) for index in range(photos)]
+    duration = main.slideshow_duration(photos)
+    video_path = generate_input(work_dir, "1080p", "portrait", "h264", "mp4", duration)
+    output_path = os.path.join(work_dir, "out_slideshow.mp4")
+
+    timings = {"slideshow": [], "video": []}
+    for _ in range(repeat):
+        for name, func in (("slideshow", lambda: main.process_slideshow(paths, output_path, STUB_TITLE)),
+                           ("video", lambda: main.process_video(video_path, output_path, STUB_TITLE))):
+            started = time.perf_counter()
+            ok = func()
+            timings[name].append(time.perf_counter() - started if ok else float("nan"))
+            if os.path.exists(output_path):
+                os.remove(output_path)
+
+    ratio = statistics.median(timings["slideshow"]) / statistics.median(timings["video"])
+    logging.warning(f"slideshow {photos} фото ({duration:.0f}с): {ratio:.2f} от времени видео той же длины")
+    return {
+        "photos": photos,
+        "duration": duration,
+        "slideshow": summarize(timings["slideshow"]),
+        "video": summarize(timings["video"]),
+        "ratio": ratio
+    }
+
+
+def time_call(func, number, repeat):
+    """Лучшее из repeat: среднее время одного вызова за number повторов"""
+    best = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best.append((time.perf_counter() - started) / number)
+    return summarize(best)
+
+
+def bench_micro(work_dir, resolutions, repeat, duration):
+    results = []
+    font_path = "/usr/share/fonts/truetype/msttcorefonts/Arial.ttf"
+    png_path = os.path.join(work_dir, "micro_overlay.png")
+
+    for resolution in resolutions:
+        for orientation in ORIENTATIONS:
+            width, height = RESOLUTIONS[resolution]
+            if orientation == "portrait":
+                width, height = height, width
+
+            for caption_name, caption in CAPTIONS.items():
+                params = {"resolution": resolution, "orientation": orientation, "caption": caption_name}
+
+                results.append({
+                    "name": "layout_caption", **params,
+                    "seconds": time_call(
+                        lambda: main.layout_caption(caption, width, height, font_path),
+                        number=20, repeat=repeat
+                    )
+                })
+                results.append({
+                    "name": "create_rounded_text_image", **params,
+                    "seconds": time_call(
+                        lambda: main.create_rounded_text_image(caption, png_path, width, height, font_path),
+                        number=5, repeat=repeat
+                    )
+                })
+                results.append({
+                    "name": "build_ass_captions", **params,
+                    "seconds": time_call(
+                        lambda: main.build_ass_captions(caption, width, height, font_path),
+                        number=20, repeat=repeat
+                    )
+                })
+
+            # Анализ кадров для места подписи (сэмплинг через pipe + NumPy) - цель до ~100 мс на ролик
+            input_path = generate_input(work_dir, resolution, orientation, "h264", "mp4", duration)
+            results.append({
+                "name": "analyze_frames", "resolution": resolution, "orientation": orientation,
+                "seconds": time_call(lambda: main.analyze_frames(input_path), number=3, repeat=repeat)
+            })
+    return results
+
+
+SSIM_RE = re.compile(r"SSIM .*?All:([\d.]+)")
+PSNR_RE = re.compile(r"PSNR .*?average:([\d.]+|inf)")
+
+
+def compare_videos(first, second):
+    """SSIM и PSNR между двумя роликами одного размера (кадр к кадру)"""
+    result = subprocess.run(
+        [main.FFMPEG_PATH, '-i', first, '-i', second, '-lavfi', "[0:v][1:v]ssim;[0:v][1:v]psnr", '-f', 'null', '-'],
+        capture_output=True, text=True
+    )
+    ssim = SSIM_RE.search(result.stderr)
+    psnr = PSNR_RE.search(result.stderr)
+    return {
+        "ssim": float(ssim.group(1)) if ssim else None,
+        "psnr": float(psnr.group(1)) if psnr else None
+    }
+
+
+def bench_parity(work_dir, resolutions, duration):
+    """Насколько подпись ASS совпадает с PNG-подложкой: один и тот же ролик обоими движками"""
+    results = []
+    for resolution in resolutions:
+        for orientation in ORIENTATIONS:
+            input_path = generate_input(work_dir, resolution, orientation, "h264", "mp4", duration)
+            for caption_name, caption in CAPTIONS.items():
+                overlay_path = os.path.join(work_dir, "parity_overlay.mp4")
+                ass_path = os.path.join(work_dir, "parity_ass.mp4")
+                try:
+                    ok = (main.add_text_with_rounded_box(input_path, overlay_path, caption)
+                          and main.add_text_with_ass(input_path, ass_path, caption))
+                    scores = compare_videos(overlay_path, ass_path) if ok else {"ssim": None, "psnr": None}
+                finally:
+                    for path in (overlay_path, ass_path):
+                        if os.path.exists(path):
+                            os.remove(path)
+
+                results.append({"resolution": resolution, "orientation": orientation, "caption": caption_name, **scores})
+                logging.warning(f"parity {resolution:>5} {orientation:>9} {caption_name:>5}: SSIM {scores['ssim']}, PSNR {scores['psnr']}")
+    return results
+
+
+def collect_meta():
+    def run(cmd):
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True).stdout.strip()
+        except Exception:
+            return ""
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": run(["git", "-C", os.path.dirname(os.path.abspath(__file__)), "rev-parse", "HEAD"]),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": run([main.FFMPEG_PATH, "-version"]).split("\n")[0]
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк пайплайна обработки видео")
+    parser.add_argument("--output", default="-", help="Куда писать JSON ('-' - stdout)")
+    parser.add_argument("--repeat", type=int, default=3, help="Повторов на каждый вариант")
+    parser.add_argument("--duration", type=float, default=5, help="Длина синтетического ролика, сек")
+    parser.add_argument("--resolutions", default="720p,1080p,4k")
+    parser.add_argument("--codecs", default="h264,hevc,hdr")
+    parser.add_argument("--containers", default="mp4,mov")
+    parser.add_argument("--variants", default=",".join(PIPELINE_VARIANTS))
+    parser.add_argument("--quick", action="store_true", help="Только 720p H.264 MP4")
+    parser.add_argument("--skip-pipeline", action="store_true")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--skip-parity", action="store_true", help="Не сравнивать движки подписи")
+    parser.add_argument("--skip-slideshow", action="store_true", help="Не сравнивать ролик из фото с видео")
+    parser.add_argument("--photos", type=int, default=10, help="Фото в ролике из фото")
+    parser.add_argument("--work-dir", help="Папка для входных файлов (по умолчанию временная)")
+    return parser.parse_args()
+
+
+def run_benchmark():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    main.generate_title_and_description = stub_llm
+
+    if args.quick:
+        args.resolutions, args.codecs, args.containers = "720p", "h264", "mp4"
+
+    resolutions = args.resolutions.split(",")
+    matrix = [
+        (resolution, orientation, codec, container)
+        for resolution in resolutions
+        for orientation in ORIENTATIONS
+        for codec in args.codecs.split(",")
+        for container in args.containers.split(",")
+    ]
+    variants = [name for name in args.variants.split(",") if name in PIPELINE_VARIANTS]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_")
+    os.makedirs(work_dir, exist_ok=True)
+
+    try:
+        report = {"meta": collect_meta(), "pipeline": [], "micro": [], "parity": [], "slideshow": None}
+        if not args.skip_micro:
+            report["micro"] = bench_micro(work_dir, resolutions, args.repeat, args.duration)
+        if not args.skip_parity:
+            report["parity"] = bench_parity(work_dir, resolutions, args.duration)
+        if not args.skip_pipeline:
+            report["pipeline"] = bench_pipeline(work_dir, matrix, variants, args.repeat, args.duration)
+        if not args.skip_slideshow:
+            report["slideshow"] = bench_slideshow(work_dir, args.repeat, args.photos)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    try:
+        run_benchmark()
+    except KeyboardInterrupt:
+        sys.exit(130)
@@ -0,0 +1,217 @@
+"""
+Пакетная обработка папки с видео без Telegram.
+
+Берет все ролики из BULK_INPUT_FOLDER (или --input-dir), накладывает текст тем же
+пайплайном, что и бот, и кладет результат в BULK_OUTPUT_FOLDER. Кодирование идет
+в пуле процессов, тексты генерируются пачками (один запрос к LLM на пачку)
+параллельно с кодированием. Заголовки и описания пишутся в манифест
+(JSON или CSV по расширению). Повторный запуск пропускает готовые ролики.
+
+Папки бота (VIDEOS_FOLDER, OUTPUT_FOLDER) не подходят: при запуске и по таймеру бот
+удаляет из них все файлы, которые не относятся к его задачам.
+
+    python bulk.py --theme "утро барбера"
+    python bulk.py --titles manifest.json --workers 4
+"""
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# main.py создает Bot при импорте: для пакетной обработки нужен только валидный по формату токен
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bulk")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import main
+
+
+BULK_INPUT_FOLDER = os.getenv("BULK_INPUT_FOLDER", "bulk/input")  # Исходники для пакетной обработки
+BULK_OUTPUT_FOLDER = os.getenv("BULK_OUTPUT_FOLDER", "bulk/output")  # Результаты и манифест
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".m4v")
+MANIFEST_FIELDS = ("file", "output", "title", "description", "theme", "status", "seconds", "error")
+
+
+def load_manifest(path):
+    """Манифест прошлого запуска: file -> запись"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = json.load(f)
+    return {row["file"]: row for row in rows if row.get("file")}
+
+
+def save_manifest(path, entries):
+    """Пишем через временный файл, чтобы прерванный запуск не оставил битый манифест"""
+    rows = [entries[name] for name in sorted(entries)]
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+
+def output_name(filename):
+    # clip.mov -> clip.mov.mp4: не пересекается с clip.mp4 из той же папки
+    return filename if os.path.splitext(filename)[1].lower() == ".mp4" else filename + ".mp4"
+
+
+def find_pending(input_dir, output_dir, manifest, force):
+    """Ролики без готового результата (результат есть в манифесте и на диске - пропускаем)"""
+    pending = []
+    skipped = 0
+    for name in sorted(os.listdir(input_dir)):
+        if not name.lower().endswith(VIDEO_EXTENSIONS):
+            continue
+        output_path = os.path.join(output_dir, output_name(name))
+        done = manifest.get(name, {}).get("status") == "ok"
+        if not force and done and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            skipped += 1
+            continue
+        pending.append(name)
+    return pending, skipped
+
+
+def init_worker():
+    # Поток вывода логов не переживает fork - поднимаем свой в каждом процессе пула
+    main.setup_logging()
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def encode_one(input_path, output_path, title, caption=None, music=None):
+    """Выполняется в процессе пула: кодирует один ролик"""
+    # Пишем во временный файл: прерванное кодирование не должно выглядеть готовым
+    part_path = os.path.splitext(output_path)[0] + ".part.mp4"
+    trace = main.start_trace(0)
+    started = time.perf_counter()
+    try:
+        ok = main.process_video(input_path, part_path, title, caption, music=music)
+        if ok:
+            os.replace(part_path, output_path)
+        return ok, time.perf_counter() - started, "" if ok else "ошибка обработки видео"
+    except Exception as e:
+        return False, time.perf_counter() - started, str(e)
+    finally:
+        trace.finish()
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def titles_for(chunk, theme, known):
+    """Тексты для пачки роликов: из файла заголовков или одним запросом к LLM"""
+    missing = [name for name in chunk if not known.get(name, {}).get("title")]
+    generated = main.generate_titles_batch(theme, len(missing)) if missing else []
+
+    result = {name: (known[name]["title"], known[name].get("description", ""))
+              for name in chunk if name not in missing}
+    result.update(zip(missing, generated))
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Пакетная обработка папки с видео")
+    parser.add_argument("--input-dir", default=BULK_INPUT_FOLDER)
+    parser.add_argument("--output-dir", default=BULK_OUTPUT_FOLDER)
+    parser.add_argument("--theme", default=main.DEFAULT_THEME)
+    parser.add_argument("--workers", type=int, default=main.MAX_CONCURRENT_ENCODES, help="Процессов кодирования")
+    parser.add_argument("--manifest", help="Файл манифеста .json или .csv (по умолчанию manifest.json в папке результатов)")
+    parser.add_argument("--titles", help="Манифест с готовыми заголовками вместо запросов к LLM")
+    parser.add_argument("--llm-batch", type=int, default=10, help="Роликов на один запрос к LLM")
+    parser.add_argument("--caption-engine", choices=main.CAPTION_ENGINES, help="Движок подписи (по умолчанию CAPTION_ENGINE)")
+    parser.add_argument("--caption-animation", choices=main.CAPTION_ANIMATIONS, help="Анимация подписи для ass")
+    parser.add_argument("--music", help="Фоновая музыка: имя трека из MUSIC_FOLDER или random")
+    parser.add_argument("--force", action="store_true", help="Обработать заново уже готовые ролики")
+    args = parser.parse_args()
+    for folder in (args.input_dir, args.output_dir):
+        if bot_owned(folder):
+            parser.error(f"{folder}: папка бота, ее файлы удалит уборщик - укажите другую")
+    return args
+
+
+def bot_owned(folder):
+    """Папка внутри рабочих папок бота (или содержит их)"""
+    folder = os.path.abspath(folder)
+    return any(
+        os.path.commonpath([folder, bot_folder]) in (folder, bot_folder)
+        for bot_folder in main.storage.all_folders()
+    )
+
+
+def run_bulk():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = args.manifest or os.path.join(args.output_dir, "manifest.json")
+    entries = load_manifest(manifest_path)
+    # Заголовки из прошлого запуска тоже переиспользуем - LLM зовем только для новых роликов
+    known = {**entries, **load_manifest(args.titles)}
+
+    pending, skipped = find_pending(args.input_dir, args.output_dir, entries, args.force)
+    logging.warning(f"К обработке: {len(pending)}, уже готово: {skipped}")
+    if not pending:
+        return 0
+    # Треки готовим до пула, иначе каждый процесс начнет декодировать их сам
+    if args.music:
+        main.music_library.warm()
+
+    progress = {"done": 0, "failed": 0}
+    caption = {"engine": args.caption_engine, "animation": args.caption_animation}
+
+    def record(finished):
+        for future in finished:
+            name = futures.pop(future)
+            ok, seconds, error = future.result()
+            entries[name].update(status="ok" if ok else "failed", seconds=round(seconds, 2), error=error)
+            progress["done"] += 1
+            progress["failed"] += not ok
+            logging.warning(f"[{progress['done']}/{len(pending)}] {name}: {'готово' if ok else 'ОШИБКА'} за {seconds:.1f}с")
+        save_manifest(manifest_path, entries)
+
+    with ProcessPoolExecutor(max_workers=max(1, args.workers), initializer=init_worker) as pool:
+        futures = {}
+        try:
+            # Пока пул кодирует пачку, родитель генерирует тексты для следующей
+            for start in range(0, len(pending), max(1, args.llm_batch)):
+                chunk = pending[start:start + max(1, args.llm_batch)]
+                for name, (title, desc) in titles_for(chunk, args.theme, known).items():
+                    input_path = os.path.join(args.input_dir, name)
+                    output_path = os.path.join(args.output_dir, output_name(name))
+                    entries[name] = {
+                        "file": name, "output": output_path, "title": title, "description": desc,
+                        "theme": args.theme, "status": "pending", "seconds": 0, "error": ""
+                    }
+                    futures[pool.submit(encode_one, input_path, output_path, title, caption,
+                                         main.music_library.pick(args.music))] = name
+                # Готовое фиксируем сразу, чтобы прерванный запуск не переделывал его
+                record([future for future in futures if future.done()])
+
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                record(finished)
+        except KeyboardInterrupt:
+            # Готовое уже в манифесте; при следующем запуске продолжим с остальных
+            pool.shutdown(wait=False, cancel_futures=True)
+            save_manifest(manifest_path, entries)
+            raise
+
+    logging.warning(f"Готово: {progress['done'] - progress['failed']}, ошибок: {progress['failed']}. Манифест: {manifest_path}")
+    return 1 if progress["failed"] else 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(run_bulk())
+    except KeyboardInterrupt:
+        sys.exit(130)
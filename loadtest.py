@@ -0,0 +1,583 @@
+"""
+Нагрузочный тест бота целиком.
+
+Поднимает локальный фейковый Bot API (getUpdates/getFile/скачивание файлов/sendVideo)
+и заглушку OpenRouter, запускает настоящий диспетчер из main.py и симулирует
+N пользователей, которые шлют темы и видео. В конце печатает JSON-отчет:
+пропускная способность, p50/p95/p99 end-to-end, разбивка по этапам,
+пиковая память и диск.
+
+    python loadtest.py --users 20 --videos-per-user 3
+    python loadtest.py --users 5 --photos 10    # ролики из альбомов фото
+    python loadtest.py --users 2 --drop-rate 0.3 --download-part-mb 0.5    # обрывы скачивания и докачка
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import statistics
+
+from aiohttp import web
+
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+THEMES = [
+    "стиль, уход, профессия",
+    "утро барбера",
+    "борода как характер",
+    "первая стрижка сына",
+    "опасная бритва и терпение"
+]
+
+
+class FakeBotAPI:
+    """Минимальный Bot API: хранит очередь апдейтов и раздает файлы"""
+
+    def __init__(self, token, drop_rate=0.0, seed=0):
+        self.token = token
+        self.drop_rate = drop_rate  # Доля ответов файлового сервера, оборванных на середине
+        self.drop_rng = random.Random(seed)
+        self.downloads = 0
+        self.dropped = 0
+        self.updates = []
+        self.update_id = 0
+        self.message_id = 0
+        self.new_update = asyncio.Event()
+        self.files = {}
+        self.outbox = {}
+        self.buttons = {}  # chat_id -> (сообщение, callback_data) последней кнопки под видео
+        self.bytes_received = 0
+
+    # ---------- то, что делает "пользователь" ----------
+    def push_update(self, chat_id, **payload):
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            **payload
+        }
+        self.updates.append({"update_id": self.update_id, "message": message})
+        self.new_update.set()
+
+    def push_callback(self, chat_id, message, data):
+        """Нажатие инлайн-кнопки под сообщением бота"""
+        self.update_id += 1
+        self.updates.append({"update_id": self.update_id, "callback_query": {
+            "id": str(self.update_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "chat_instance": str(chat_id),
+            "message": message,
+            "data": data
+        }})
+        self.new_update.set()
+
+    def push_text(self, chat_id, text):
+        self.push_update(chat_id, text=text)
+
+    def push_video(self, chat_id, file_id, media_group_id=None):
+        info = self.files[file_id]
+        extra = {"media_group_id": media_group_id} if media_group_id else {}
+        self.push_update(chat_id, **extra, video={
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "width": info["width"],
+            "height": info["height"],
+            "duration": info["duration"],
+            "file_size": info["size"]
+        })
+
+    def push_photo(self, chat_id, file_id, media_group_id=None):
+        info = self.files[file_id]
+        extra = {"media_group_id": media_group_id} if media_group_id else {}
+        # Telegram присылает несколько размеров фото; бот берет последний (самый крупный)
+        self.push_update(chat_id, **extra, photo=[{
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "width": info["width"],
+            "height": info["height"],
+            "file_size": info["size"]
+        }])
+
+    def add_file(self, file_id, path, width, height, duration):
+        self.files[file_id] = {
+            "path": path,
+            "width": width,
+            "height": height,
+            "duration": duration,
+            "size": os.path.getsize(path)
+        }
+
+    def events(self, chat_id):
+        return self.outbox.setdefault(chat_id, asyncio.Queue())
+
+    # ---------- ответы бота ----------
+    def _message(self, chat_id, **extra):
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **extra
+        }
+
+    async def _read_params(self, request):
+        """aiogram шлет multipart/form-data; файлы только считаем по байтам"""
+        params = dict(request.query)
+        files = 0
+        received = 0
+        if request.content_type.startswith("multipart/"):
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename:
+                    files += 1
+                    while True:
+                        chunk = await part.read_chunk(1024 * 1024)
+                        if not chunk:
+                            break
+                        received += len(chunk)
+                else:
+                    params[part.name] = await part.text()
+        elif request.can_read_body:
+            if request.content_type == "application/json":
+                params.update(await request.json())
+            else:
+                params.update(await request.post())
+        self.bytes_received += received
+        return params, files, received
+
+    async def handle_method(self, request):
+        if request.match_info["token"] != self.token:
+            return web.json_response({"ok": False, "error_code": 401, "description": "Unauthorized"}, status=401)
+
+        method = request.match_info["method"]
+        params, files, received = await self._read_params(request)
+        handler = getattr(self, f"api_{method}", None)
+        result = await handler(params, files, received) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def api_getMe(self, params, files, received):
+        return BOT_USER
+
+    async def api_getUpdates(self, params, files, received):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+
+        if not self.updates and timeout:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout=min(timeout, 1.0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    async def api_getFile(self, params, files, received):
+        file_id = params["file_id"]
+        info = self.files[file_id]
+        return {
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "file_size": info["size"],
+            "file_path": f"videos/{file_id}.mp4"
+        }
+
+    async def api_sendMessage(self, params, files, received):
+        chat_id = int(params["chat_id"])
+        self.events(chat_id).put_nowait(("sendMessage", params.get("text", ""), time.perf_counter(), 0))
+        return self._message(chat_id, text=params.get("text", ""))
+
+    async def api_editMessageText(self, params, files, received):
+        chat_id = int(params["chat_id"])
+        self.events(chat_id).put_nowait(("editMessageText", params.get("text", ""), time.perf_counter(), 0))
+        return self._message(chat_id, text=params.get("text", ""))
+
+    async def api_sendVideo(self, params, files, received):
+        chat_id = int(params["chat_id"])
+        message = self._message(chat_id, caption=params.get("caption", ""), video={
+            "file_id": f"out{self.message_id + 1}",
+            "file_unique_id": f"out{self.message_id + 1}",
+            "width": 0,
+            "height": 0,
+            "duration": 0
+        })
+        if params.get("reply_markup"):
+            button = json.loads(params["reply_markup"])["inline_keyboard"][0][0]
+            self.buttons[chat_id] = (message, button["callback_data"])
+        self.events(chat_id).put_nowait(("sendVideo", params.get("caption", ""), time.perf_counter(), received))
+        return message
+
+    async def api_sendMediaGroup(self, params, files, received):
+        chat_id = int(params["chat_id"])
+        media = json.loads(params.get("media", "[]"))
+        self.events(chat_id).put_nowait(("sendMediaGroup", "", time.perf_counter(), received))
+        return [
+            self._message(chat_id, video={
+                "file_id": f"out{self.message_id}_{i}",
+                "file_unique_id": f"out{self.message_id}_{i}",
+                "width": 0,
+                "height": 0,
+                "duration": 0
+            })
+            for i in range(max(1, len(media)))
+        ]
+
+    async def handle_file(self, request):
+        if request.match_info["token"] != self.token:
+            raise web.HTTPUnauthorized()
+        file_id = os.path.splitext(os.path.basename(request.match_info["path"]))[0]
+        info = self.files.get(file_id)
+        if not info:
+            raise web.HTTPNotFound()
+        self.downloads += 1
+        if self.drop_rate and self.drop_rng.random() < self.drop_rate:
+            return await self._dropped_file(request, info["path"])
+        # FileResponse сам поддерживает Range-запросы
+        return web.FileResponse(info["path"])
+
+    async def _dropped_file(self, request, path):
+        """Отдает половину запрошенного куска и рвет соединение - проверка докачки"""
+        self.dropped += 1
+        size = os.path.getsize(path)
+        http_range = request.http_range
+        start = http_range.start or 0
+        stop = min(http_range.stop or size, size)
+        resp = web.StreamResponse(status=206 if request.headers.get("Range") else 200)
+        resp.content_length = stop - start
+        if request.headers.get("Range"):
+            resp.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        await resp.prepare(request)
+        with open(path, "rb") as f:
+            f.seek(start)
+            await resp.write(f.read((stop - start) // 2))
+        request.transport.close()
+        return resp
+
+    def routes(self):
+        return [
+            web.route("*", "/bot{token}/{method}", self.handle_method),
+            web.get("/file/bot{token}/{path:.+}", self.handle_file)
+        ]
+
+
+class FakeOpenRouter:
+    """Заглушка OpenRouter с настраиваемой задержкой ответа"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+
+    async def handle(self, request):
+        self.calls += 1
+        prompt = (await request.json())["messages"][0]["content"]
+        await asyncio.sleep(random.uniform(self.delay * 0.5, self.delay * 1.5))
+
+        batch = re.search(r"РОВНО (\d+)", prompt)
+        if batch:
+            # Пакетный запрос для альбома: JSON с нужным числом вариантов
+            content = json.dumps({"items": [
+                {"title": f"Нагрузочный заголовок {self.calls}.{i}", "description": "Абзац.\n\n#барбер #тест"}
+                for i in range(int(batch.group(1)))
+            ]}, ensure_ascii=False)
+        else:
+            content = (
+                "ЗАГОЛОВОК:\n"
+                f"Нагрузочный заголовок номер {self.calls}\n\n"
+                "ОПИСАНИЕ:\n"
+                "Первый абзац.\n\nВторой абзац.\n\n#барбер #стиль #тест"
+            )
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": content}}]})
+
+    def routes(self):
+        return [web.post("/api/v1/chat/completions", self.handle)]
+
+
+def folder_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+async def sample_disk(folders, peak, interval=0.5):
+    while True:
+        peak["disk"] = max(peak["disk"], sum(folder_size(f) for f in folders))
+        await asyncio.sleep(interval)
+
+
+async def wait_event(queue, predicate, timeout):
+    """Ждем событие от бота, подходящее под условие"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        event = await asyncio.wait_for(queue.get(), timeout=remaining)
+        if predicate(event):
+            return event
+
+
+def is_error(event):
+    return event[0] in ("sendMessage", "editMessageText") and event[1].startswith("❌")
+
+
+async def simulate_user(api, user_id, file_ids, photo_ids, args, rng, jobs):
+    queue = api.events(user_id)
+
+    api.push_text(user_id, "/start")
+    await wait_event(queue, lambda e: e[0] == "sendMessage", args.job_timeout)
+
+    if args.formats:
+        api.push_text(user_id, f"/formats {args.formats.replace(',', ' ')}")
+        await wait_event(queue, lambda e: e[0] == "sendMessage", args.job_timeout)
+
+    if args.reel:
+        api.push_text(user_id, "/reel on")
+        await wait_event(queue, lambda e: e[0] == "sendMessage", args.job_timeout)
+
+    for _ in range(args.videos_per_user):
+        await asyncio.sleep(rng.uniform(0, args.think_time))
+
+        with_theme = rng.random() < args.theme_ratio
+        if with_theme:
+            api.push_text(user_id, rng.choice(THEMES))
+            await wait_event(queue, lambda e: "Тема сохранена" in e[1], args.job_timeout)
+
+        file_id = rng.choice(file_ids)
+        started = time.perf_counter()
+        if args.photos:
+            # Фото вместо видео: одно или альбом - бот собирает из них один ролик
+            group_id = f"photos{user_id}_{time.perf_counter_ns()}" if args.photos > 1 else None
+            for index in range(args.photos):
+                api.push_photo(user_id, photo_ids[index % len(photo_ids)], media_group_id=group_id)
+        elif args.album_size > 1:
+            # Альбом: несколько видео с общим media_group_id
+            group_id = f"album{user_id}_{time.perf_counter_ns()}"
+            for _ in range(args.album_size):
+                api.push_video(user_id, rng.choice(file_ids), media_group_id=group_id)
+        else:
+            api.push_video(user_id, file_id)
+
+        job = {"user_id": user_id, "file_id": file_id, "with_theme": with_theme,
+               "videos": 1 if args.photos or args.reel else args.album_size,
+               "rejected": 0}
+
+        def is_result(event):
+            # Превью приходит раньше результата; часть превью "пользователь" отклоняет
+            if event[0] == "sendVideo" and event[1].startswith("👀"):
+                job.setdefault("preview_latency", event[2] - started)
+                if not job["rejected"] and user_id in api.buttons and rng.random() < args.reject_ratio:
+                    api.push_callback(user_id, *api.buttons.pop(user_id))
+                    job["rejected"] += 1
+                return False
+            return event[0] in ("sendVideo", "sendMediaGroup") or is_error(event)
+
+        try:
+            event = await wait_event(queue, is_result, args.job_timeout)
+            job["ok"] = not is_error(event)
+            job["latency"] = event[2] - started
+            job["bytes_out"] = event[3]
+            if job["ok"]:
+                # Дожидаемся финального сообщения, чтобы состояние успело вернуться в waiting_for_theme
+                await wait_event(queue, lambda e: e[1].startswith("✅ Готово"), args.job_timeout)
+                await asyncio.sleep(0.1)
+            else:
+                job["error"] = event[1]
+        except asyncio.TimeoutError:
+            job["ok"] = False
+            job["error"] = "timeout"
+            job["latency"] = time.perf_counter() - started
+        jobs.append(job)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на фейковом Bot API")
+    parser.add_argument("--users", type=int, default=10, help="Одновременных пользователей")
+    parser.add_argument("--videos-per-user", type=int, default=2)
+    parser.add_argument("--theme-ratio", type=float, default=0.5, help="Доля видео с собственной темой")
+    parser.add_argument("--think-time", type=float, default=2.0, help="Макс. пауза пользователя между действиями, сек")
+    parser.add_argument("--llm-delay", type=float, default=1.5, help="Средняя задержка заглушки LLM, сек")
+    parser.add_argument("--inputs", default="720p:portrait:h264:mp4,1080p:portrait:h264:mov,720p:landscape:hevc:mp4",
+                        help="Набор входных роликов resolution:orientation:codec:container через запятую")
+    parser.add_argument("--duration", type=float, default=5, help="Длина входных роликов, сек")
+    parser.add_argument("--album-size", type=int, default=1, help="Видео в одном сообщении (>1 - альбомом)")
+    parser.add_argument("--reel", action="store_true", help="Склеивать альбом в один ролик (/reel on)")
+    parser.add_argument("--photos", type=int, default=0, help="Отправлять столько фото вместо видео (>1 - альбомом)")
+    parser.add_argument("--formats", default="", help="Форматы через запятую (например 9:16,1:1,4:5) - режим версий")
+    parser.add_argument("--reject-ratio", type=float, default=0.0, help="Доля превью, которые отклоняются кнопкой")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Доля скачиваний, оборванных на середине")
+    parser.add_argument("--download-part-mb", type=float, help="Минимальный кусок параллельного скачивания, МБ")
+    parser.add_argument("--job-timeout", type=float, default=600)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="-", help="Куда писать JSON ('-' - stdout)")
+    parser.add_argument("--work-dir", help="Рабочая папка (по умолчанию временная)")
+    return parser.parse_args()
+
+
+async def run_loadtest(args, work_dir):
+    token = "123456:loadtest"
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    # Окружение нужно выставить до импорта main.py
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": token,
+        "TELEGRAM_API_URL": base_url,
+        "OPENROUTER_URL": f"{base_url}/api/v1/chat/completions",
+        "VIDEOS_FOLDER": os.path.join(work_dir, "input"),
+        "OUTPUT_FOLDER": os.path.join(work_dir, "output"),
+        "METRICS_PORT": "0",
+        "ADMIN_IDS": ""
+    })
+    if args.download_part_mb:
+        os.environ["DOWNLOAD_MIN_PART_MB"] = str(args.download_part_mb)
+    import main
+    import bench
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    api = FakeBotAPI(token, args.drop_rate, args.seed)
+    llm = FakeOpenRouter(args.llm_delay)
+
+    # Входные ролики
+    assets_dir = os.path.join(work_dir, "assets")
+    os.makedirs(assets_dir, exist_ok=True)
+    file_ids = []
+    for i, spec in enumerate(args.inputs.split(",")):
+        resolution, orientation, codec, container = spec.split(":")
+        path = bench.generate_input(assets_dir, resolution, orientation, codec, container, args.duration)
+        width, height = bench.RESOLUTIONS[resolution]
+        if orientation == "portrait":
+            width, height = height, width
+        file_id = f"in{i}"
+        api.add_file(file_id, path, width, height, int(args.duration))
+        file_ids.append(file_id)
+    photo_ids = []
+    for i in range(args.photos):
+        file_id = f"photo{i}"
+        api.add_file(file_id, bench.generate_photo(assets_dir, i), 960, 1280, 0)
+        photo_ids.append(file_id)
+
+    app = web.Application(client_max_size=4 * 1024 ** 3)
+    app.add_routes(api.routes() + llm.routes())
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    peak = {"disk": 0}
+    disk_task = asyncio.create_task(sample_disk([main.VIDEOS_FOLDER, main.OUTPUT_FOLDER], peak))
+    polling_task = asyncio.create_task(main.dp.start_polling(main.bot, handle_signals=False))
+
+    rng = random.Random(args.seed)
+    jobs = []
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*[
+            simulate_user(api, 10_000 + i, file_ids, photo_ids, args, random.Random(rng.random()), jobs)
+            for i in range(args.users)
+        ])
+    finally:
+        wall = time.perf_counter() - started
+        await main.dp.stop_polling()
+        polling_task.cancel()
+        disk_task.cancel()
+        await asyncio.gather(polling_task, disk_task, return_exceptions=True)
+        await main.bot.session.close()
+        await main.downloader.close()
+        await runner.cleanup()
+
+    ok_latencies = [job["latency"] for job in jobs if job["ok"]]
+    preview_latencies = [job["preview_latency"] for job in jobs if "preview_latency" in job]
+    return {
+        "config": {
+            key: getattr(args, key)
+            for key in ("users", "videos_per_user", "album_size", "reel", "photos", "formats", "theme_ratio", "think_time", "llm_delay", "inputs", "duration",
+                        "reject_ratio", "drop_rate", "download_part_mb")
+        },
+        "jobs": len(jobs),
+        "succeeded": len(ok_latencies),
+        "failed": len(jobs) - len(ok_latencies),
+        "videos": sum(job["videos"] for job in jobs if job["ok"]),
+        "errors": sorted({job.get("error", "") for job in jobs if not job["ok"]}),
+        "wall_seconds": wall,
+        "throughput_per_min": len(ok_latencies) / wall * 60 if wall else 0.0,
+        "latency": {
+            "p50": percentile(ok_latencies, 0.50),
+            "p95": percentile(ok_latencies, 0.95),
+            "p99": percentile(ok_latencies, 0.99),
+            "mean": statistics.fmean(ok_latencies) if ok_latencies else 0.0,
+            "max": max(ok_latencies, default=0.0)
+        },
+        "preview": {
+            "count": len(preview_latencies),
+            "rejected": sum(job["rejected"] for job in jobs),
+            "p50": percentile(preview_latencies, 0.50),
+            "p95": percentile(preview_latencies, 0.95)
+        },
+        "stages": main.collect_stage_stats(),
+        "llm_calls": llm.calls,
+        "downloads": {"requests": api.downloads, "dropped": api.dropped},
+        "upload_mb": api.bytes_received / (1024 * 1024),
+        # ru_maxrss на Linux в килобайтах; для детей - максимум по одному процессу
+        # (форк до exec тоже учитывается, поэтому не меньше RSS самого бота)
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "peak_disk_mb": peak["disk"] / (1024 * 1024)
+    }
+
+
+def main_cli():
+    args = parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="loadtest_")
+    os.makedirs(work_dir, exist_ok=True)
+
+    # main.py пишет users.json в текущую папку
+    cwd = os.getcwd()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(work_dir)
+    try:
+        report = asyncio.run(run_loadtest(args, work_dir))
+    finally:
+        os.chdir(cwd)
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    try:
+        main_cli()
+    except KeyboardInterrupt:
+        sys.exit(130)
@@ -3,18 +3,40 @@ import sys
 import asyncio
 import subprocess
 import random
+import shutil
 import textwrap
+import time
+import re
+import uuid
+import signal
+import cProfile
+import threading
+import contextvars
+import queue
+import atexit
+import sqlite3
+import struct
+import errno
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
 
 import requests
+import aiohttp
 import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.types import Message, FSInputFile
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message, FSInputFile, InputMediaVideo
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, start_http_server
 
 
 # ============ НАСТРОЙКИ ============
@@ -24,28 +46,28 @@ FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
 
 OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY", "")
 OPENROUTER_MODEL = os.environ.get("OPENROUTER_MODEL", "openai/gpt-4o-mini")
+OPENROUTER_URL = os.environ.get("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
 
 TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "")  # Свой Bot API сервер (пусто - api.telegram.org)
 
 # Настройка администраторов и пользователей
 admin_ids_str = os.environ.get("ADMIN_IDS", "")
 ADMIN_IDS = [int(id.strip()) for id in admin_ids_str.split(",") if id.strip()] if admin_ids_str else []  # ID пользователя Telegram
 SUBSCRIBED_USERS_FILE = "users.json"  # Файл для сохранения пользователей
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
+USER_SETTINGS_FILE = "user_settings.json"  # Личные настройки пользователей (форматы и т.п.)
 
 # Инициализация бота и диспетчера
-bot = Bot(token=TOKEN)
+if TELEGRAM_API_URL:
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
 # Глобальная переменная для хранения подписчиков
 SUBSCRIBED_USERS = set()
+USER_SETTINGS = {}  # user_id -> {настройка: значение}
 
 # ============ ADMIN СОСТОЯНИЯ ============
 class AdminSendMessage(StatesGroup):
@@ -59,14 +81,719 @@ class VideoProcessing(StatesGroup):
     processing = State()
 
 
-# Настройка логирования для Railway
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)  # Важно для Railway
-    ]
+# ============ МЕТРИКИ ============
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # 0 - не поднимать /metrics
+MAX_CONCURRENT_ENCODES = int(os.getenv("MAX_CONCURRENT_ENCODES", str(os.cpu_count() or 2)))
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "4"))  # Одновременные скачивания
+MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", "2"))  # Одновременные отправки результата
+EVENT_LOOP_LAG_INTERVAL = 1.0  # Как часто меряем задержку event loop (сек)
+LAG_THROTTLE_THRESHOLD = float(os.getenv("LAG_THROTTLE_THRESHOLD", "0.1"))  # Задержка event loop, при которой убавляем кодирования (0 - не убавляем)
+LAG_THROTTLE_SAMPLES = 3  # Столько замеров подряд выше порога - снимаем слот кодирования
+LAG_RECOVERY_SAMPLES = 30  # Столько спокойных замеров подряд - возвращаем слот
+
+# Этапы обработки одного видео (порядок важен для /stats)
+PIPELINE_STAGES = ("get_file", "download", "llm", "probe", "trim", "analyze", "overlay_render", "encode", "preview", "upload")
+
+STAGE_LATENCY = Histogram(
+    "bot_stage_duration_seconds",
+    "Длительность этапов обработки видео",
+    ["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
 )
+STAGE_FAILURES = Counter("bot_stage_failures_total", "Ошибки по этапам обработки", ["stage"])
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Задачи, ожидающие свободный слот пула", ["pool"])
+POOL_ACTIVE = Gauge("bot_pool_active", "Занятые слоты пула", ["pool"])
+POOL_LIMIT = Gauge("bot_pool_limit", "Текущее число слотов пула", ["pool"])
+ACTIVE_ENCODES = Gauge("bot_active_encodes", "Запущенные кодирования FFmpeg")
+EVENT_LOOP_LAG = Gauge("bot_event_loop_lag_seconds", "Задержка event loop")
+JOBS_CANCELLED = Counter("bot_jobs_cancelled_total", "Отмененные и убитые задачи", ["reason"])
+
+
+@contextmanager
+def stage_timer(stage, **attrs):
+    """
+    Замеряет длительность этапа; исключение внутри считается ошибкой этапа.
+    Отдает словарь атрибутов, которые попадут в спан текущего трейса.
+    """
+    start = time.perf_counter()
+    status = "ok"
+    stage_token = CURRENT_STAGE.set(stage)
+    try:
+        yield attrs
+    except JobCancelled:
+        status = "cancelled"
+        raise
+    except Exception:
+        status = "error"
+        STAGE_FAILURES.labels(stage).inc()
+        raise
+    finally:
+        end = time.perf_counter()
+        CURRENT_STAGE.reset(stage_token)
+        STAGE_LATENCY.labels(stage).observe(end - start)
+        trace = CURRENT_TRACE.get()
+        if trace:
+            # Атрибуты могут уточнить статус (например, FFmpeg завершился с ошибкой)
+            trace.add_span(stage, start, end, **{"status": status, **attrs})
+
+
+def _histogram_quantile(buckets, q):
+    """Оценка квантиля по кумулятивным бакетам [(le, count), ...]"""
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return 0.0
+
+    rank = q * total
+    prev_le, prev_count = 0.0, 0
+    for le, count in buckets:
+        if count >= rank:
+            if le == float("inf"):
+                return prev_le
+            if count == prev_count:
+                return le
+            return prev_le + (le - prev_le) * (rank - prev_count) / (count - prev_count)
+        prev_le, prev_count = le, count
+    return prev_le
+
+
+def collect_stage_stats():
+    """Сводка по этапам: {stage: {count, avg, p50, p95, failures}}"""
+    raw = {stage: {"count": 0, "sum": 0.0, "buckets": [], "failures": 0} for stage in PIPELINE_STAGES}
+
+    for metric in STAGE_LATENCY.collect():
+        for sample in metric.samples:
+            item = raw.setdefault(sample.labels["stage"], {"count": 0, "sum": 0.0, "buckets": [], "failures": 0})
+            if sample.name.endswith("_count"):
+                item["count"] = int(sample.value)
+            elif sample.name.endswith("_sum"):
+                item["sum"] = sample.value
+            elif sample.name.endswith("_bucket"):
+                item["buckets"].append((float(sample.labels["le"]), sample.value))
+
+    for metric in STAGE_FAILURES.collect():
+        for sample in metric.samples:
+            if sample.name.endswith("_total") and sample.labels["stage"] in raw:
+                raw[sample.labels["stage"]]["failures"] = int(sample.value)
+
+    stats = {}
+    for stage, item in raw.items():
+        buckets = sorted(item["buckets"])
+        stats[stage] = {
+            "count": item["count"],
+            "avg": item["sum"] / item["count"] if item["count"] else 0.0,
+            "p50": _histogram_quantile(buckets, 0.5),
+            "p95": _histogram_quantile(buckets, 0.95),
+            "failures": item["failures"]
+        }
+    return stats
+
+
+class JobScheduler:
+    """Ограничивает число задач, одновременно занимающих ресурс (сеть, CPU)"""
+
+    def __init__(self, limit, name="cpu"):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_limit = self.limit  # Лимит из настроек; limit может временно опускаться ниже
+        self.active = 0
+        self.waiting = 0
+        self._cond = asyncio.Condition()
+        POOL_LIMIT.labels(name).set(self.limit)
+
+    async def acquire(self, job_id=None):
+        """Ждет свободный слот; отмененная в очереди задача уходит без слота"""
+        async with self._cond:
+            self.waiting += 1
+            QUEUE_DEPTH.labels(self.name).set(self.waiting)
+            try:
+                await self._cond.wait_for(
+                    lambda: self.active < self.limit or supervisor.is_cancelled(job_id)
+                )
+            finally:
+                self.waiting -= 1
+                QUEUE_DEPTH.labels(self.name).set(self.waiting)
+            supervisor.check(job_id)
+            self.active += 1
+            POOL_ACTIVE.labels(self.name).set(self.active)
+
+    async def release(self):
+        async with self._cond:
+            self.active -= 1
+            POOL_ACTIVE.labels(self.name).set(self.active)
+            self._cond.notify_all()
+
+    async def set_limit(self, limit):
+        """Меняет число слотов на ходу; уже запущенные задачи дорабатывают как есть"""
+        async with self._cond:
+            self.limit = max(1, min(limit, self.max_limit))
+            POOL_LIMIT.labels(self.name).set(self.limit)
+            self._cond.notify_all()
+
+    async def notify(self):
+        """Перепроверить очередь (например, после отмены задач)"""
+        async with self._cond:
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def slot(self, job_id=None):
+        await self.acquire(job_id)
+        try:
+            yield
+        finally:
+            await self.release()
+
+
+# Отдельные пулы на каждый ресурс: пока CPU кодирует одну задачу,
+# сеть скачивает следующую и отдает предыдущую
+job_scheduler = JobScheduler(MAX_CONCURRENT_ENCODES, "cpu")
+download_pool = JobScheduler(MAX_CONCURRENT_DOWNLOADS, "net_in")
+upload_pool = JobScheduler(MAX_CONCURRENT_UPLOADS, "net_out")
+JOB_POOLS = (download_pool, job_scheduler, upload_pool)
+
+
+async def notify_pools():
+    """Будим очереди всех пулов (после отмены задач)"""
+    for pool in JOB_POOLS:
+        await pool.notify()
+
+
+async def monitor_event_loop_lag():
+    """
+    Фоновая задача: насколько позже запланированного просыпается event loop.
+    Loop долго опаздывает - кодирования отнимают CPU у бота: снимаем слот в job_scheduler,
+    а когда задержка уходит - по одному возвращаем.
+    """
+    loop = asyncio.get_running_loop()
+    slow = calm = 0
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag = loop.time() - start - EVENT_LOOP_LAG_INTERVAL
+        EVENT_LOOP_LAG.set(max(0.0, lag))
+        if not LAG_THROTTLE_THRESHOLD:
+            continue
+
+        slow = slow + 1 if lag > LAG_THROTTLE_THRESHOLD else 0
+        calm = calm + 1 if lag < LAG_THROTTLE_THRESHOLD / 2 else 0
+        if slow >= LAG_THROTTLE_SAMPLES and job_scheduler.limit > 1:
+            await job_scheduler.set_limit(job_scheduler.limit - 1)
+            logging.warning(f"Задержка event loop {lag * 1000:.0f} мс: кодирований одновременно не больше {job_scheduler.limit}")
+            slow = 0
+        elif calm >= LAG_RECOVERY_SAMPLES and job_scheduler.limit < job_scheduler.max_limit:
+            await job_scheduler.set_limit(job_scheduler.limit + 1)
+            logging.info(f"Event loop успокоился: кодирований одновременно до {job_scheduler.limit}")
+            calm = 0
+
+
+# ============ ТРАССИРОВКА ЗАДАЧ ============
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))  # Сколько последних задач держим в памяти
+PROFILE_MODE = os.getenv("PROFILE_MODE", "")  # "", "cprofile" или "pyspy"
+PROFILE_FOLDER = os.getenv("PROFILE_FOLDER", "/tmp/videos/profiles")
+
+# Последние трейсы (кольцевой буфер) и трейс текущей задачи.
+# asyncio.to_thread копирует контекст, поэтому трейс виден и в потоке обработки
+RECENT_TRACES = deque(maxlen=TRACE_BUFFER_SIZE)
+CURRENT_TRACE = contextvars.ContextVar("current_trace", default=None)
+CURRENT_STAGE = contextvars.ContextVar("current_stage", default=None)
+# Под какой задачей супервизора запускать FFmpeg, если не под задачей трейса (превью - своя подзадача)
+CURRENT_PROCESS_JOB = contextvars.ContextVar("current_process_job", default=None)
+
+
+class JobTrace:
+    """Таймлайн одной задачи: спаны этапов с атрибутами"""
+
+    def __init__(self, user_id, theme=None, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:12]
+        self.user_id = user_id
+        self.theme = theme
+        self.started_at = time.time()
+        self.status = "running"
+        self.spans = []
+        self._t0 = time.perf_counter()
+        self._t1 = None
+
+    def add_span(self, name, start, end, **attrs):
+        span = {"name": name, "start": start - self._t0, "end": end - self._t0}
+        span.update(attrs)
+        self.spans.append(span)
+
+    def finish(self, status=None):
+        """Закрывает трейс; без явного статуса ошибка любого спана = ошибка задачи"""
+        if self._t1 is not None:
+            return
+        self._t1 = time.perf_counter()
+        if status is None:
+            status = "error" if any(span.get("status") == "error" for span in self.spans) else "ok"
+        self.status = status
+
+    @property
+    def duration(self):
+        end = self._t1 if self._t1 is not None else time.perf_counter()
+        return end - self._t0
+
+    def render(self):
+        """Текстовый таймлайн для админа"""
+        started = time.strftime("%d.%m %H:%M:%S", time.localtime(self.started_at))
+        lines = [f"🆔 {self.trace_id} — {self.duration:.1f}с — {self.status} — {started}"]
+        for span in self.spans:
+            extra = []
+            for key in ("frames", "fps", "speed", "returncode", "killed"):
+                if span.get(key) is not None:
+                    extra.append(f"{key}={span[key]}")
+            for key in ("bytes_in", "bytes_out"):
+                if span.get(key):
+                    extra.append(f"{key}={span[key] / (1024 * 1024):.1f}MB")
+            mark = "❌" if span.get("status") == "error" else "•"
+            lines.append(
+                f"  {mark} {span['name']}: {span['start']:.2f}→{span['end']:.2f} "
+                f"({span['end'] - span['start']:.2f}с) {' '.join(extra)}".rstrip()
+            )
+        return "\n".join(lines)
+
+
+def start_trace(user_id, theme=None, trace_id=None):
+    """Создает трейс задачи и делает его текущим для этого контекста"""
+    trace = JobTrace(user_id, theme, trace_id)
+    RECENT_TRACES.append(trace)
+    CURRENT_TRACE.set(trace)
+    logging.info(f"Новая задача пользователя {user_id}")
+    return trace
+
+
+# ============ ЛОГИРОВАНИЕ ============
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # DEBUG - еще команды FFmpeg и ответы LLM
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text или json (одна запись - одна строка JSON)
+LOG_DEBUG_SAMPLE = int(os.getenv("LOG_DEBUG_SAMPLE", "10"))  # Из DEBUG-записей одного места в коде пишем первую и каждую N-ю (1 - все)
+LOG_MAX_MESSAGE = 4000  # Сообщение длиннее - оставляем начало и конец
+LOG_QUEUE_SIZE = 10000  # Очередь к потоку вывода; при переполнении запись теряется, а не тормозит бота
+
+LOG_RECORDS_DROPPED = Counter("bot_log_records_dropped_total", "Записи лога, потерянные при переполнении очереди")
+# Стандартные поля LogRecord; все остальное (контекст задачи, extra=...) уходит в JSON
+LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class TraceIdFilter(logging.Filter):
+    """
+    Добавляет контекст задачи (trace_id, user_id, этап) в каждую запись лога.
+    Стоит на QueueHandler, то есть выполняется в потоке, который пишет запись, - там виден контекст.
+    """
+
+    def filter(self, record):
+        trace = CURRENT_TRACE.get()
+        record.trace_id = trace.trace_id if trace else "-"
+        record.user_id = trace.user_id if trace else None
+        record.stage = CURRENT_STAGE.get()
+        return True
+
+
+class LogSampler(logging.Filter):
+    """Прореживает повторяющийся DEBUG (команды FFmpeg и т.п.) и укорачивает слишком длинные сообщения"""
+
+    def __init__(self):
+        super().__init__()
+        self._seen = {}
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG and LOG_DEBUG_SAMPLE > 1:
+            key = (record.pathname, record.lineno)
+            count = self._seen[key] = self._seen.get(key, 0) + 1
+            if (count - 1) % LOG_DEBUG_SAMPLE:
+                return False
+
+        message = record.getMessage()
+        if len(message) > LOG_MAX_MESSAGE:
+            # Конец важен не меньше начала: ошибка FFmpeg - в последних строках
+            half = LOG_MAX_MESSAGE // 2
+            record.msg = f"{message[:half]} … (+{len(message) - LOG_MAX_MESSAGE} символов) … {message[-half:]}"
+            record.args = None
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON: время, уровень, сообщение, контекст задачи и поля из extra"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        entry.update(
+            (key, value) for key, value in vars(record).items()
+            if key not in LOG_RECORD_FIELDS and value is not None
+        )
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """При переполненной очереди теряет запись (и считает это), а не блокирует и не сыплет ошибками"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def setup_logging():
+    """
+    Логи выводит отдельный поток (QueueListener): пишущий поток, в том числе event loop,
+    только кладет запись в очередь и не ждет stdout. Вызывать заново в дочернем процессе после fork.
+    """
+    output = logging.StreamHandler(sys.stdout)  # stdout - для Railway
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(TraceIdFilter())
+    handler.addFilter(LogSampler())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+
+    listener = QueueListener(log_queue, output)
+    listener.start()
+    # Дописываем очередь при выходе
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
+
+
+@contextmanager
+def profiled(name):
+    """Опциональный профайлинг участка кода (PROFILE_MODE=cprofile|pyspy)"""
+    if PROFILE_MODE not in ("cprofile", "pyspy"):
+        yield
+        return
+
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    trace = CURRENT_TRACE.get()
+    tag = f"{name}_{trace.trace_id if trace else os.getpid()}_{int(time.time() * 1000)}"
+
+    if PROFILE_MODE == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(PROFILE_FOLDER, f"{tag}.prof"))
+        return
+
+    # py-spy пишет flamegraph, пока мы не пошлем SIGINT
+    try:
+        proc = subprocess.Popen(
+            ["py-spy", "record", "--pid", str(os.getpid()), "--nonblocking",
+             "--output", os.path.join(PROFILE_FOLDER, f"{tag}.svg")],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+    except Exception as e:
+        logging.warning(f"py-spy недоступен: {e}")
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+# ============ ИЗОЛЯЦИЯ КОДИРОВАНИЯ ============
+ENCODE_NICE = int(os.getenv("ENCODE_NICE", "10"))  # nice для FFmpeg: планировщик отдает CPU боту раньше кодирований
+ENCODE_IONICE = os.getenv("ENCODE_IONICE", "best-effort")  # Класс ввода-вывода FFmpeg: best-effort, idle или "" (как у бота)
+ENCODE_MEMORY_MB = int(os.getenv("ENCODE_MEMORY_MB", "0"))  # Лимит памяти (адресного пространства) одного FFmpeg (0 - без лимита)
+BOT_RESERVED_CORES = int(os.getenv("BOT_RESERVED_CORES", "1"))  # Ядра только для бота, FFmpeg работает на остальных (0 - не делим)
+
+IONICE_CLASSES = {"best-effort": ["-c", "2", "-n", "7"], "idle": ["-c", "3"]}
+
+
+def cpu_partition():
+    """(ядра бота, ядра кодирования) или (None, None), если делить нечего"""
+    if not hasattr(os, "sched_getaffinity"):
+        return None, None
+    cpus = sorted(os.sched_getaffinity(0))
+    if BOT_RESERVED_CORES <= 0 or len(cpus) <= BOT_RESERVED_CORES:
+        return None, None
+    return set(cpus[:BOT_RESERVED_CORES]), set(cpus[BOT_RESERVED_CORES:])
+
+
+BOT_CPUS, ENCODE_CPUS = cpu_partition()
+ENCODE_CORES = len(ENCODE_CPUS) if ENCODE_CPUS else (os.cpu_count() or 2)
+
+
+def encode_command_prefix():
+    """
+    Обертка для запуска FFmpeg: taskset, prlimit, ionice и nice применяют ограничения
+    и делают exec, так что FFmpeg стартует уже с ними (и его потоки тоже), а PID остается
+    тем же - supervisor убивает именно FFmpeg. Утилит нет в системе - ограничение пропускаем.
+    """
+    prefix = []
+    if ENCODE_CPUS and shutil.which("taskset"):
+        prefix += ["taskset", "-c", ",".join(str(cpu) for cpu in sorted(ENCODE_CPUS))]
+    if ENCODE_MEMORY_MB and shutil.which("prlimit"):
+        prefix += ["prlimit", f"--as={ENCODE_MEMORY_MB * 1024 * 1024}"]
+    if ENCODE_IONICE in IONICE_CLASSES and shutil.which("ionice"):
+        prefix += ["ionice", *IONICE_CLASSES[ENCODE_IONICE]]
+    if ENCODE_NICE and shutil.which("nice"):
+        prefix += ["nice", "-n", str(ENCODE_NICE)]
+    return prefix
+
+
+ENCODE_PREFIX = encode_command_prefix()
+
+
+def pin_worker_thread():
+    """Поток asyncio.to_thread (Pillow, numpy, ожидание FFmpeg) - на ядра кодирования"""
+    os.sched_setaffinity(threading.get_native_id(), ENCODE_CPUS)
+
+
+def reserve_bot_cores():
+    """
+    Закрепляем за ядрами бота только поток event loop. Новые потоки наследуют привязку
+    создавшего их потока, поэтому рабочие потоки to_thread сами переходят на ядра кодирования:
+    тяжелая работа в них не должна занимать ядро event loop.
+    """
+    if BOT_CPUS:
+        os.sched_setaffinity(threading.get_native_id(), BOT_CPUS)
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(initializer=pin_worker_thread))
+    logging.info(
+        f"Изоляция кодирования: бот на ядрах {sorted(BOT_CPUS) if BOT_CPUS else 'всех'}, "
+        f"FFmpeg на {sorted(ENCODE_CPUS) if ENCODE_CPUS else 'всех'}, "
+        f"обертка: {' '.join(ENCODE_PREFIX) or 'нет'}"
+    )
+
+
+# ============ СУПЕРВИЗОР ПРОЦЕССОВ FFMPEG ============
+FFMPEG_STALL_TIMEOUT = int(os.getenv("FFMPEG_STALL_TIMEOUT", "120"))  # Сек без прогресса - процесс завис
+FFMPEG_MAX_RUNTIME = int(os.getenv("FFMPEG_MAX_RUNTIME", "1800"))  # Жесткий лимит на один запуск FFmpeg
+FFMPEG_STDERR_TAIL = 200  # Сколько последних строк stderr FFmpeg храним для отчета об ошибке
+# Предел строк keep: последние N подряд - пары start/end не рвутся, а осиротевший end детекторы пропускают
+FFMPEG_STDERR_KEPT = 2000
+
+
+class JobCancelled(BaseException):
+    """
+    Задача отменена (/cancel, пользователь заблокировал бота).
+    Наследуется от BaseException, как asyncio.CancelledError,
+    чтобы не застревать в обработчиках `except Exception`.
+    """
+
+
+class ProcessSupervisor:
+    """Следит за дочерними процессами задач: отмена, зависания, таймауты"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}  # job_id -> {"user_id", "procs", "cancelled"}
+
+    def register_job(self, job_id, user_id, parent=None):
+        """parent - основная задача для подзадачи (превью): ее процессы можно остановить отдельно"""
+        with self._lock:
+            self._jobs[job_id] = {"user_id": user_id, "procs": set(), "cancelled": None, "parent": parent}
+
+    def finish_job(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def active_jobs(self):
+        """Задачи, которые еще выполняются и не отменены"""
+        with self._lock:
+            return [job_id for job_id, job in self._jobs.items() if not job["cancelled"] and not job["parent"]]
+
+    def is_cancelled(self, job_id):
+        """Причина отмены задачи или None"""
+        job = self._jobs.get(job_id)
+        return job["cancelled"] if job else None
+
+    def check(self, job_id):
+        reason = self.is_cancelled(job_id)
+        if reason:
+            raise JobCancelled(reason)
+
+    def cancel_job(self, job_id, reason):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            # Отклоненное превью ("rejected") - мягкая отмена, настоящая отмена ее перекрывает
+            if not job or job["cancelled"] == reason or job["cancelled"] not in (None, "rejected"):
+                return False
+            job["cancelled"] = reason
+            procs = list(job["procs"])
+
+        for proc in procs:
+            self._kill(proc)
+        JOBS_CANCELLED.labels(reason).inc()
+        logging.info(f"Задача {job_id} отменена ({reason}), остановлено процессов: {len(procs)}")
+        return True
+
+    def clear_rejection(self, job_id):
+        """Снимает отмену "rejected": задача продолжается с новым текстом"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job and job["cancelled"] == "rejected":
+                job["cancelled"] = None
+
+    def cancel_user(self, user_id, reason):
+        """Отменяет все задачи пользователя, возвращает их количество"""
+        with self._lock:
+            jobs = [(job_id, job["parent"]) for job_id, job in self._jobs.items() if job["user_id"] == user_id]
+        # Подзадачи останавливаем вместе с основными, но в число задач не считаем
+        return sum(1 for job_id, parent in jobs if self.cancel_job(job_id, reason) and not parent)
+
+    @staticmethod
+    def _kill(proc):
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+    def run(self, job_id, cmd, outputs=(), keep=None):
+        """
+        Запускает процесс и ждет его, проверяя отмену и прогресс.
+        Возвращает (код выхода, stderr, причина остановки или None).
+        Из stderr остаются только хвост (FFMPEG_STDERR_TAIL строк), последняя строка прогресса
+        и последние FFMPEG_STDERR_KEPT строк, подходящих под регулярное выражение keep, -
+        память не растет с длиной ролика.
+        """
+        proc = subprocess.Popen(
+            ENCODE_PREFIX + cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            errors='replace'
+        )
+        tail = deque(maxlen=FFMPEG_STDERR_TAIL)
+        kept = deque(maxlen=FFMPEG_STDERR_KEPT)
+        progress = {"at": time.monotonic(), "line": ""}
+
+        def read_stderr():
+            # Строки статистики FFmpeg ("frame=... fps=...") и есть признак прогресса
+            for line in proc.stderr:
+                if line.startswith(("frame=", "size=")):
+                    progress["at"] = time.monotonic()
+                    progress["line"] = line
+                elif keep and keep.search(line):
+                    kept.append(line)
+                else:
+                    tail.append(line)
+
+        reader = threading.Thread(target=read_stderr, daemon=True)
+        reader.start()
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job["procs"].add(proc)
+
+        started = time.monotonic()
+        reason = None
+        try:
+            while True:
+                try:
+                    proc.wait(timeout=1)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+
+                now = time.monotonic()
+                reason = self.is_cancelled(job_id)
+                if not reason and now - progress["at"] > FFMPEG_STALL_TIMEOUT:
+                    reason = "stall"
+                if not reason and now - started > FFMPEG_MAX_RUNTIME:
+                    reason = "timeout"
+                if reason:
+                    self._kill(proc)
+                    proc.wait()
+                    break
+        finally:
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job:
+                    job["procs"].discard(proc)
+            reader.join(timeout=5)
+
+        # Процесс мог убить cancel_job из другого потока
+        reason = reason or self.is_cancelled(job_id)
+        if reason:
+            if reason in ("stall", "timeout"):
+                JOBS_CANCELLED.labels(reason).inc()
+            logging.warning(f"FFmpeg остановлен ({reason}) через {time.monotonic() - started:.1f}с")
+            # Недописанный результат никому не нужен
+            for path in outputs:
+                storage.remove(path)
+
+        return proc.returncode, "".join(kept) + progress["line"] + "".join(tail), reason
+
+
+supervisor = ProcessSupervisor()
+
+
+def current_job_id():
+    trace = CURRENT_TRACE.get()
+    return trace.trace_id if trace else None
+
+
+FFMPEG_PROGRESS_RE = re.compile(r"frame=\s*(\d+).*?fps=\s*([\d.]+).*?speed=\s*([\d.]+)x")
+
+
+def run_ffmpeg(cmd, stage="encode", outputs=None, keep=None):
+    """
+    Запускает FFmpeg, пишет метрики и спан со статистикой:
+    код выхода, кадры, fps, скорость, байты на входе и выходе.
+    outputs - все выходные файлы, если их несколько (по умолчанию последний аргумент);
+    keep - регулярное выражение для строк stderr, нужных целиком (см. ProcessSupervisor.run).
+    """
+    inputs = [cmd[i + 1] for i, arg in enumerate(cmd[:-1]) if arg == '-i']
+    outputs = outputs or [cmd[-1]]
+    job_id = CURRENT_PROCESS_JOB.get() or current_job_id()
+    supervisor.check(job_id)
+
+    with stage_timer(stage) as span, ACTIVE_ENCODES.track_inprogress():
+        started = time.perf_counter()
+        returncode, stderr, reason = supervisor.run(job_id, cmd, outputs, keep)
+        result = subprocess.CompletedProcess(cmd, returncode, stdout="", stderr=stderr)
+        elapsed = time.perf_counter() - started
+
+        # Отмена пользователем - не ошибка этапа, а прерывание всей задачи
+        if reason and reason not in ("stall", "timeout"):
+            raise JobCancelled(reason)
+        if reason:
+            span["killed"] = reason
+
+        span["returncode"] = result.returncode
+        span["bytes_in"] = sum(os.path.getsize(p) for p in inputs if os.path.isfile(p))
+        span["bytes_out"] = sum(os.path.getsize(p) for p in outputs if os.path.isfile(p))
+        for path in outputs:
+            storage.track(path)
+
+        progress = FFMPEG_PROGRESS_RE.findall(result.stderr or "")
+        if progress:
+            frames, fps, speed = progress[-1]
+            span["frames"] = int(frames)
+            span["fps"] = float(fps) if float(fps) else round(int(frames) / max(elapsed, 1e-6), 1)
+            span["speed"] = float(speed)
+
+        if result.returncode != 0:
+            span["status"] = "error"
+            STAGE_FAILURES.labels(stage).inc()
+
+    return result
+
 
 def check_system_dependencies():
     """Проверяем системные зависимости"""
@@ -147,6 +874,38 @@ def save_subscribed_users():
     except Exception as e:
         logging.error(f"Ошибка сохранения пользователей: {e}")
 
+# Личные настройки пользователей
+def load_user_settings():
+    """Загружаем настройки пользователей из файла"""
+    try:
+        if os.path.exists(USER_SETTINGS_FILE):
+            with open(USER_SETTINGS_FILE, 'r', encoding='utf-8') as f:
+                return {int(user_id): settings for user_id, settings in json.load(f).items()}
+    except Exception as e:
+        logging.error(f"Ошибка загрузки настроек пользователей: {e}")
+    return {}
+
+
+def save_user_settings():
+    try:
+        with open(USER_SETTINGS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(USER_SETTINGS, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения настроек пользователей: {e}")
+
+
+def get_user_setting(user_id, key, default=None):
+    return USER_SETTINGS.get(user_id, {}).get(key, default)
+
+
+def set_user_setting(user_id, key, value):
+    settings = USER_SETTINGS.setdefault(user_id, {})
+    if value is None:
+        settings.pop(key, None)
+    else:
+        settings[key] = value
+    save_user_settings()
+
 # Отправка сообщения всем пользователям
 async def broadcast_message(text: str, only_admins: bool = False):
     """Отправка сообщения всем подписчикам"""
@@ -189,84 +948,10 @@ async def send_bot_stopping_notification():
 
 # ============ ФУНКЦИИ ОБРАБОТКИ ВИДЕО ============
 
-# Конвертация видео с iPhone
-def convert_mov_to_mp4(input_file, output_file):
-    """Конвертируем MOV в MP4 через FFmpeg"""
-    logging.info(f"Конвертирую {os.path.basename(input_file)}...")
-    try:
-        cmd = [
-            FFMPEG_PATH, '-i', input_file,
-            '-c:v', 'libx264',
-            '-preset', 'fast',
-            '-crf', '23',
-            '-pix_fmt', 'yuv420p',
-            '-c:a', 'aac',
-            '-b:a', '128k',
-            '-y', output_file
-        ]
-
-        logging.debug(f"Выполняем команду: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-        if result.returncode != 0:
-            logging.error(f"FFmpeg ошибка: {result.stderr}")
-            return False
-
-        return True
-    except Exception as e:
-        logging.error(f"Ошибка при конвертации видео: {e}")
-        return False
-
-
-def add_text_with_ffmpeg(input_file, output_file, text):
-    """Добавляем текст на видео используя только FFmpeg"""
-    logging.info(f"Добавляю текст ({len(text)} символов): '{text}'")
-
-    # Создаем уникальное имя для временного текстового файла
-    text_file_name = f"temp_text_{os.getpid()}.txt"
-
-    try:
-        # 1. Записываем текст в файл с кодировкой UTF-8
-        # Это решает проблемы с кириллицей и символами типа длинного тире
-        with open(text_file_name, "w", encoding="utf-8") as f:
-            f.write(text)
-
-        # 2. Формируем команду, указывая FFmpeg читать текст из файла
-        cmd = [
-            FFMPEG_PATH, '-i', input_file,
-            '-vf', f"drawtext=textfile='{text_file_name}':"
-                   f"fontcolor=black:"
-                   f"fontsize=35:"
-                   f"box=1:boxcolor=white@1:boxborderw=15:"
-                   f"x=(w-text_w)/2:y=h*0.8:"
-                   f"line_spacing=10:text_align=center:fix_bounds=true",
-            '-c:a', 'copy',
-            '-y', output_file
-        ]
-
-        # 3. Запускаем процесс
-        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-
-        if result.returncode != 0:
-            logging.error(f"FFmpeg ошибка: {result.stderr}")
-            return False
-
-        return True
-
-    except Exception as e:
-        logging.error(f"Ошибка при добавлении текста: {e}")
-        return False
-    finally:
-        # 4. Удаляем временный файл
-        if os.path.exists(text_file_name):
-            os.remove(text_file_name)
-
-
-def create_rounded_text_image(text, output_path, video_width, video_height, font_path=None, bg_color="white", text_color="black"):
+def layout_caption(text, video_width, video_height, font_path=None):
     """
-    Создает PNG с прозрачным фоном, текстом и закругленной подложкой.
+    Раскладка текста по строкам: шрифт, отступы и размеры подложки каждой строки.
     """
-
-
     # Максимальная ширина текста (90% от ширины видео)
     max_width = int(video_width * 0.9)
 
@@ -322,6 +1007,26 @@ def create_rounded_text_image(text, output_path, video_width, video_height, font
             "text_h": l_height
         })
 
+    return {
+        "font": font,
+        "font_size": font_size,
+        "padding_x": padding_x,
+        "padding_y": padding_y,
+        "lines": line_infos
+    }
+
+
+def create_rounded_text_image(text, output_path, video_width, video_height, font_path=None, bg_color="white", text_color="black"):
+    """
+    Создает PNG с прозрачным фоном, текстом и закругленной подложкой.
+    """
+    layout = layout_caption(text, video_width, video_height, font_path)
+    font = layout["font"]
+    font_size = layout["font_size"]
+    padding_x = layout["padding_x"]
+    line_infos = layout["lines"]
+    lines = [item["text"] for item in line_infos]
+
     # Находим самую широкую строку, чтобы задать ширину всего изображения
     max_box_width = max(item["box_w"] for item in line_infos)
 
@@ -403,47 +1108,84 @@ def create_rounded_text_image(text, output_path, video_width, video_height, font
     image.save(output_path)
     return output_path
 
-def add_text_with_rounded_box(input_video, output_video, text, font_path="/usr/share/fonts/truetype/msttcorefonts/Arial.ttf"):
+def add_text_with_rounded_box(input_video, output_video, text, font_path="/usr/share/fonts/truetype/msttcorefonts/Arial.ttf", profile=None,
+                              analysis=None, trim=None, music=None, cover=None, stage="encode"):
+    """
+    profile - профиль кодирования (output_profile), если ролик потом склеивается
+    с заставками: тогда fps, таймбейс и звук приводятся к нему.
+    analysis - профили кадра (analyze_frames) для выбора места и цвета подписи,
+    trim - кодируемый отрезок (plan_trim), music - фоновый трек (MusicLibrary.asset),
+    cover - куда записать JPEG-обложку (вторым выходом того же запуска).
+    stage - этап в метриках: у превью все время идет в "preview", а не в encode/overlay_render.
+    """
     logging.info("Генерирую подложку с закруглением...")
 
-    # Имя временной картинки
-    overlay_path = "temp_rounded_text.png"
+    # Имя временной картинки (рядом с результатом, чтобы параллельные задачи не пересекались)
+    overlay_path = f"{os.path.splitext(output_video)[0]}_overlay.png"
 
     try:
 
         # 1. Получаем реальные размеры видео
         v_width, v_height = get_video_dimensions(input_video)
         logging.info(f"Размер видео: {v_width}x{v_height}")
+        placement = caption_placement(analysis, text, v_width, v_height, font_path)
 
         # 2. Генерируем картинку с помощью Python
-        create_rounded_text_image(
-            text=text,
-            output_path=overlay_path,
-            video_width=v_width,
-            video_height=v_height,
-            font_path=font_path,
-            bg_color="white",
-            text_color="black"
-        )
+        with stage_timer("overlay_render" if stage == "encode" else stage), profiled("overlay_render"):
+            create_rounded_text_image(
+                text=text,
+                output_path=overlay_path,
+                video_width=v_width,
+                video_height=v_height,
+                font_path=font_path,
+                bg_color=placement["box"],
+                text_color=placement["text"]
+            )
+        storage.track(overlay_path)
 
         # 3. Команда FFmpeg для наложения картинки
 
-        offset_bottom = int(v_height * 0.2)
+        offset_bottom = int(v_height * placement["offset"])
+        source = source_video_filter(input_video)
         cmd = [
             FFMPEG_PATH,
+            *source["input_args"],
+            *trim_input_args(trim),
             '-i', input_video,
             '-framerate', '25',
-            '-i', overlay_path,
-            '-filter_complex',
-            f"[1:v]format=rgba,colorchannelmixer=aa=1[alpha];[0:v][alpha]overlay=x=(W-w)/2:y=H-h-{offset_bottom},format=yuv420p",
-            '-c:v', 'libx264',
-            '-preset', 'ultrafast',
-            '-c:a', 'copy',
-            '-y', output_video
+            '-i', overlay_path
         ]
+        # HDR приводим к SDR до наложения - в том же проходе
+        base = "[0:v]"
+        graph = ""
+        if source["filter"]:
+            base = "[base]"
+            graph = f"[0:v]{source['filter']}[base];"
+        graph += f"[1:v]format=rgba,colorchannelmixer=aa=1[alpha];{base}[alpha]overlay=x=(W-w)/2:y=H-h-{offset_bottom},format=yuv420p[v]"
+        try:
+            duration = trim["duration"] if trim else probe_video(input_video)["duration"]
+        except Exception:
+            duration = None  # Обложка тогда с первого кадра
+        cover_graph, video_label, cover_args = cover_branch("[v]", cover, duration)
+        if cover_graph:
+            graph += ";" + cover_graph
+
+        # Звук: копия, тишина для заставок или сведение с музыкой - в том же проходе
+        audio = caption_audio(input_video, 2, profile=profile, music=music, trim=trim)
+        cmd += audio["inputs"]
+        if audio["graph"]:
+            graph += ";" + audio["graph"]
+
+        cmd += ['-filter_complex', graph, '-map', video_label, '-map', audio["maps"][0]]
+        if profile:
+            # Потоки как у заставок
+            cmd += profile_encode_args(profile)
+        else:
+            cmd += ['-c:v', 'libx264', '-preset', 'ultrafast']
+        cmd += [*audio["args"], *source["output_args"], '-movflags', '+faststart', '-y', output_video, *cover_args]
 
         logging.debug(f"Команда: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
+        result = run_ffmpeg(cmd, stage=stage, outputs=[path for path in (output_video, cover) if path])
 
         if result.returncode != 0:
             logging.error(f"FFmpeg ошибка: {result.stderr}")
@@ -456,185 +1198,3209 @@ def add_text_with_rounded_box(input_video, output_video, text, font_path="/usr/s
         return False
     finally:
         # Удаляем временную картинку
-        if os.path.exists(overlay_path):
-            os.remove(overlay_path)
+        storage.remove(overlay_path)
 
-def get_video_dimensions(video_path):
-    """
-    Возвращает размеры (width, height) видео.
-    """
-    cmd = [
-        FFMPEG_PATH.replace("ffmpeg", "ffprobe"),
-        '-v', 'error',
-        '-select_streams', 'v:0',
-        '-show_entries', 'stream=width,height',
-        '-of', 'csv=s=x:p=0',
-        video_path
-    ]
+# Движки подписи: pillow - PNG-подложка через overlay, ass - субтитры ASS через libass (фильтр ass)
+CAPTION_ENGINES = ("pillow", "ass")
+CAPTION_ANIMATIONS = ("static", "fade", "typewriter")  # Анимации движка ass
+CAPTION_ENGINE = os.getenv("CAPTION_ENGINE", "pillow")  # Движок по умолчанию
+CAPTION_ANIMATION = os.getenv("CAPTION_ANIMATION", "static")  # Анимация по умолчанию
+CAPTION_FADE_MS = 400  # Длительность появления и исчезновения подписи
+TYPEWRITER_CPS = 20  # Скорость "печати": символов в секунду
 
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        width, height = map(int, result.stdout.strip().split('x'))
-        return width, height
-    except Exception as e:
-        logging.error(f"Не удалось получить размер видео: {e}")
-        # Возвращаем значения по умолчанию (FullHD), если не получилось
-        return 1920, 1080
 
-def process_video(input_path, output_path, text):
-    """Обрабатываем одно видео"""
-    try:
-        filename = os.path.basename(input_path)
-        logging.info(f"Обрабатываю: {filename}")
+def caption_settings(caption=None):
+    """Движок и анимация подписи: настройки задачи поверх значений по умолчанию"""
+    caption = caption or {}
+    return caption.get("engine") or CAPTION_ENGINE, caption.get("animation") or CAPTION_ANIMATION
 
-        # Проверяем расширение
-        temp_file = None
-        if filename.lower().endswith('.mov'):
-            # Сначала конвертируем MOV во временный MP4
-            temp_file = output_path.replace('.mp4', '_temp.mp4')
-            if not convert_mov_to_mp4(input_path, temp_file):
-                logging.error(f"Ошибка конвертации")
-                return False
-            input_path = temp_file
 
-        # Добавляем текст
-        if add_text_with_rounded_box(input_path, output_path, text):
-            logging.info(f"Видео готово")
+def ass_time(seconds):
+    """Время в формате ASS: H:MM:SS.cc"""
+    centiseconds = max(0, int(round(seconds * 100)))
+    hours, rest = divmod(centiseconds, 360000)
+    minutes, rest = divmod(rest, 6000)
+    return f"{hours}:{minutes:02d}:{rest // 100:02d}.{rest % 100:02d}"
 
-            # Удаляем временный файл если он был создан
-            if temp_file and os.path.exists(temp_file):
-                os.remove(temp_file)
-            return True
-        else:
-            logging.error(f"Ошибка добавления текста")
-            return False
 
-    except Exception as e:
-        logging.error(f"Ошибка: {e}")
-        return False
+def ass_colour(color):
+    """#RRGGBB -> цвет ASS &HAABBGGRR"""
+    red, green, blue = color[1:3], color[3:5], color[5:7]
+    return f"&H00{blue}{green}{red}".upper()
 
 
-def generate_title_and_description(theme: str):
-    """Генерация заголовка и описания через OpenRouter"""
-    prompt = f"""
-    Ты — философ-практик и мастер с 20-летним стажем в индустрии барберинга и мужского груминга.
-    Ты наблюдаешь за салоном, клиентами и инструментами как за метафорой жизни. 
-    Твои тексты — это короткие, емкие, визуальные мини-эссе для Instagram Reels. 
-    Они сочетают поэзию, практическую мудрость и острые социальные наблюдения. 
-    Твой стиль: лаконичный, слегка ироничный, но глубокий. 
-    Как смесь Алена де Боттона и крутого барбера с улиц большого города.
-    Не повторяйся. Не пиши искусство быть собой.
-    На тему только опирайся, строго следуй формату.
-    
-    ТЕМА:
-    {theme}
+def ass_escape(text):
+    """Фигурные скобки и обратный слэш в ASS служебные: скобки экранируем, после слэша ставим невидимый разделитель"""
+    return text.replace("\\", "\\\u2060").replace("{", "\\{").replace("}", "\\}")
 
-    СДЕЛАЙ:
-    1. Заголовок строго в 1 строку, коротко.
-    2. Описание 3–4 абзаца.
-    3. Спокойный, зрелый тон.
-    4. Без маркетинговых клише.
-    5. В конце 7–10 хэштегов.
 
-    ФОРМАТ(СТРОГО!!!):
+def ass_rounded_rect(width, height, radius):
+    """Контур прямоугольника со скругленными углами в командах рисования ASS (\\p1)"""
+    w, h = width, height
+    r = min(radius, w // 2, h // 2)
+    k = round(r * 0.45)  # Контрольные точки кривой Безье для четверти окружности
+    return (
+        f"m {r} 0 l {w - r} 0 b {w - k} 0 {w} {k} {w} {r} "
+        f"l {w} {h - r} b {w} {h - k} {w - k} {h} {w - r} {h} "
+        f"l {r} {h} b {k} {h} 0 {h - k} 0 {h - r} "
+        f"l 0 {r} b 0 {k} {k} 0 {r} 0"
+    )
 
-    ЗАГОЛОВОК:
-    строка
 
-    ОПИСАНИЕ:
-    текст
+def build_ass_captions(text, video_width, video_height, font_path=None, animation="static", duration=None,
+                       placement=None):
+    """
+    Подпись в формате ASS с той же раскладкой, что у PNG-подложки (layout_caption):
+    подложка каждой строки - векторный контур, текст - строка субтитров поверх нее.
+    animation: static, fade (появление и исчезновение) или typewriter (печать по буквам).
+    placement - место и цвета (choose_caption_placement).
     """
+    placement = placement or choose_caption_placement(None, 0)
+    layout = layout_caption(text, video_width, video_height, font_path)
+    font = layout["font"]
+    font_size = layout["font_size"]
+    padding_x = layout["padding_x"]
+    line_infos = layout["lines"]
+    radius = int(font_size / 2)
 
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json"
-    }
+    # Кегль в ASS - полная высота строки (ascent + descent), в Pillow - размер em
+    if isinstance(font, ImageFont.FreeTypeFont):
+        font_name = font.getname()[0]
+        ass_font_size = sum(font.getmetrics())
+    else:
+        font_name, ass_font_size = "Arial", font_size
 
-    payload = {
-        "model": OPENROUTER_MODEL,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": round(random.uniform(0.65, 0.9), 2)
-    }
+    # Позиция блока такая же, как у картинки в overlay: по центру, с отступом снизу
+    max_box_width = max(item["box_w"] for item in line_infos)
+    total_height = sum(item["box_h"] for item in line_infos) + (len(line_infos) - 1)
+    left = (video_width - max_box_width) // 2
+    top = video_height - int(video_height * placement["offset"]) - total_height
+    box_colour, text_colour = ass_colour(placement["box"]), ass_colour(placement["text"])
+
+    end = ass_time(duration) if duration else "9:59:59.00"
+    effect = ""
+    if animation == "fade":
+        effect = f"\\fad({CAPTION_FADE_MS},{CAPTION_FADE_MS if duration else 0})"
+
+    events = []
+    current_y = top
+    typed = 0  # Сколько символов уже "напечатано" в предыдущих строках
+    char_cs = max(1, round(100 / TYPEWRITER_CPS))
+    for item in line_infos:
+        x = left + (max_box_width - item["box_w"]) // 2
+        shape = ass_rounded_rect(item["box_w"], item["box_h"], radius)
+        events.append(f"Dialogue: 0,0:00:00.00,{end},Box,,0,0,0,,{{\\an7\\pos({x},{current_y}){effect}\\p1}}{shape}")
+
+        # Та же точка вывода текста, что и в create_rounded_text_image
+        bbox = item["bbox"]
+        text_x = x + padding_x
+        text_y = current_y + item["box_h"] / 2 - (bbox[1] + bbox[3]) / 2 + font_size * 0.1
+        if animation == "typewriter":
+            # Караоке: до своего момента символ в прозрачном SecondaryColour, потом в PrimaryColour
+            body = f"{{\\k{typed * char_cs}}}" + "".join(f"{{\\k{char_cs}}}{ass_escape(char)}" for char in item["text"])
+            typed += len(item["text"])
+        else:
+            body = ass_escape(item["text"])
+        events.append(f"Dialogue: 1,0:00:00.00,{end},Text,,0,0,0,,{{\\an7\\pos({text_x:.1f},{text_y:.1f}){effect}}}{body}")
+
+        current_y += item["box_h"]
+
+    return "\n".join([
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {video_width}",
+        f"PlayResY: {video_height}",
+        "WrapStyle: 2",
+        "ScaledBorderAndShadow: yes",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, "
+        "Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, "
+        "MarginL, MarginR, MarginV, Encoding",
+        f"Style: Box,{font_name},{ass_font_size},{box_colour},{box_colour},&H00000000,&H00000000,"
+        "0,0,0,0,100,100,0,0,1,0,0,7,0,0,0,1",
+        f"Style: Text,{font_name},{ass_font_size},{text_colour},&HFF000000,&H00000000,&H00000000,"
+        "0,0,0,0,100,100,0,0,1,0,0,7,0,0,0,1",
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+        *events,
+        ""
+    ])
 
-    try:
-        r = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            data=json.dumps(payload),
-            timeout=60
-        )
-        r.raise_for_status()
 
-        content = r.json()["choices"][0]["message"]["content"]
+def ass_filter(ass_path, font_path):
+    """Фильтр ass для FFmpeg; шрифт ищем в папке font_path, иначе libass берет системный"""
+    def escape(path):
+        return path.replace("\\", "/").replace(":", "\\:").replace("'", "\\'")
+
+    value = f"ass={escape(ass_path)}"
+    if font_path and os.path.exists(font_path):
+        value += f":fontsdir={escape(os.path.dirname(font_path))}"
+    return value
+
+
+def write_ass_captions(text, ass_path, video_width, video_height, font_path=None, animation="static", duration=None,
+                       placement=None):
+    with open(ass_path, "w", encoding="utf-8") as f:
+        f.write(build_ass_captions(text, video_width, video_height, font_path, animation, duration, placement))
+    return ass_path
+
+
+def add_text_with_ass(input_video, output_video, text, font_path="/usr/share/fonts/truetype/msttcorefonts/Arial.ttf",
+                      profile=None, animation="static", analysis=None, trim=None, music=None, cover=None,
+                      stage="encode"):
+    """
+    Подпись через субтитры ASS: без PNG и второго видеовхода, libass рисует
+    подложку и текст прямо в кадре. Поддерживает анимацию (см. build_ass_captions).
+    profile, analysis, trim, music, cover и stage - как в add_text_with_rounded_box.
+    """
+    logging.info(f"Генерирую подпись ASS ({animation})...")
+
+    ass_path = f"{os.path.splitext(output_video)[0]}_caption.ass"
+
+    try:
+        v_width, v_height = get_video_dimensions(input_video)
+        try:
+            duration = trim["duration"] if trim else probe_video(input_video)["duration"]
+        except Exception:
+            duration = None  # Без длительности подпись просто не исчезает в конце
+        placement = caption_placement(analysis, text, v_width, v_height, font_path)
+
+        with stage_timer("overlay_render" if stage == "encode" else stage, engine="ass"), profiled("overlay_render"):
+            write_ass_captions(text, ass_path, v_width, v_height, font_path, animation, duration, placement)
+        storage.track(ass_path)
+
+        source = source_video_filter(input_video)
+        cmd = [FFMPEG_PATH, *source["input_args"], *trim_input_args(trim), '-i', input_video]
+        video_filter = ",".join(filter(None, [source["filter"], ass_filter(ass_path, font_path), "format=yuv420p"]))
+        graph = f"[0:v]{video_filter}[v]"
+        cover_graph, video_label, cover_args = cover_branch("[v]", cover, duration)
+        if cover_graph:
+            graph += ";" + cover_graph
+
+        audio = caption_audio(input_video, 1, profile=profile, music=music, trim=trim)
+        cmd += audio["inputs"]
+        if audio["graph"]:
+            graph += ";" + audio["graph"]
+
+        cmd += ['-filter_complex', graph, '-map', video_label, '-map', audio["maps"][0]]
+        if profile:
+            cmd += profile_encode_args(profile)
+        else:
+            cmd += ['-c:v', 'libx264', '-preset', 'ultrafast']
+        cmd += [*audio["args"], *source["output_args"], '-movflags', '+faststart', '-y', output_video, *cover_args]
+
+        logging.debug(f"Команда: {' '.join(cmd)}")
+        result = run_ffmpeg(cmd, stage=stage, outputs=[path for path in (output_video, cover) if path])
+
+        if result.returncode != 0:
+            logging.error(f"FFmpeg ошибка: {result.stderr}")
+            return False
+
+        return True
+
+    except Exception as e:
+        logging.error(f"Ошибка: {e}")
+        return False
+    finally:
+        storage.remove(ass_path)
+
+
+def add_caption(input_video, output_video, text, profile=None, caption=None, analysis=None, trim=None, music=None,
+                cover=None, stage="encode"):
+    """Подпись движком из настроек задачи (caption - {"engine": ..., "animation": ...})"""
+    engine, animation = caption_settings(caption)
+    if engine == "ass":
+        return add_text_with_ass(
+            input_video, output_video, text, profile=profile, animation=animation, analysis=analysis, trim=trim,
+            music=music, cover=cover, stage=stage
+        )
+    return add_text_with_rounded_box(
+        input_video, output_video, text, profile=profile, analysis=analysis, trim=trim, music=music, cover=cover,
+        stage=stage
+    )
+
+
+# Форматы для режима нескольких версий: имя -> соотношение сторон (ширина, высота)
+RENDITIONS = {"9:16": (9, 16), "1:1": (1, 1), "4:5": (4, 5)}
+RENDITION_MAX_WIDTH = 1080  # Версии не шире этого (и не шире исходника)
+
+
+def rendition_size(aspect, src_width, src_height):
+    """Итоговый размер версии (четный): центральная обрезка исходника, не шире RENDITION_MAX_WIDTH"""
+    aspect_w, aspect_h = RENDITIONS[aspect]
+    crop_w = min(src_width, src_height * aspect_w // aspect_h)
+    out_w = min(crop_w, RENDITION_MAX_WIDTH)
+    out_h = out_w * aspect_h // aspect_w
+    return out_w - out_w % 2, out_h - out_h % 2
+
+
+def rendition_crop(aspect):
+    """Фильтр центральной обрезки: считается FFmpeg по реальному кадру, а не по probe"""
+    aspect_w, aspect_h = RENDITIONS[aspect]
+    return f"crop=trunc(min(iw\\,ih*{aspect_w}/{aspect_h})/2)*2:trunc(min(ih\\,iw*{aspect_h}/{aspect_w})/2)*2"
+
+
+def rendition_paths(output_path, renditions):
+    """Файлы версий рядом с основным результатом: processed_1_abc_9x16.mp4"""
+    stem = os.path.splitext(output_path)[0]
+    return {aspect: f"{stem}_{aspect.replace(':', 'x')}.mp4" for aspect in renditions}
+
+
+def add_text_renditions(input_video, outputs, text, font_path="/usr/share/fonts/truetype/msttcorefonts/Arial.ttf",
+                        profiles=None, caption=None, analysis=None, trim=None, music=None, covers=None):
+    """
+    Несколько форматов за один запуск FFmpeg: видео декодируется один раз,
+    split раздает кадры на обрезку, масштаб и подложку своего размера для каждого формата.
+    outputs - {формат: путь}, profiles - {формат: профиль} для склейки с заставками,
+    caption - движок подписи (с ass подложка рисуется в ветке фильтром, без PNG-входов),
+    analysis - профили кадра для места и цвета подписи каждой версии, trim - кодируемый отрезок,
+    music - фоновый трек, covers - {формат: путь} для JPEG-обложек (выходами того же запуска).
+    """
+    engine, animation = caption_settings(caption)
+    overlays = []
+    try:
+        v_width, v_height = get_video_dimensions(input_video)
+        logging.info(f"Размер видео: {v_width}x{v_height}, версии: {', '.join(outputs)}")
+        duration = trim["duration"] if trim else probe_video(input_video)["duration"]
+
+        source = source_video_filter(input_video)
+        cmd = [FFMPEG_PATH, '-y', *source["input_args"], *trim_input_args(trim), '-i', input_video]
+        # HDR приводим к SDR один раз до split - общий tonemap для всех версий
+        graph = [f"[0:v]{source['filter'] + ',' if source['filter'] else ''}split={len(outputs)}"
+                 + "".join(f"[s{i}]" for i in range(len(outputs)))]
+        next_input = 1
+
+        # Подложка для каждого формата - под его итоговый размер
+        with stage_timer("overlay_render", renditions=len(outputs), engine=engine), profiled("overlay_render"):
+            for i, (aspect, path) in enumerate(outputs.items()):
+                out_w, out_h = rendition_size(aspect, v_width, v_height)
+                crop = f"[s{i}]{rendition_crop(aspect)},scale={out_w}:{out_h}"
+                # Центральная обрезка по высоте: версии видна только середина кадра
+                aspect_w, aspect_h = RENDITIONS[aspect]
+                kept = min(1.0, v_width * aspect_h / aspect_w / v_height)
+                visible = ((1 - kept) / 2, (1 + kept) / 2)
+                placement = caption_placement(analysis, text, out_w, out_h, font_path, visible)
+
+                if engine == "ass":
+                    ass_path = f"{os.path.splitext(path)[0]}_caption.ass"
+                    write_ass_captions(text, ass_path, out_w, out_h, font_path, animation, duration, placement)
+                    overlays.append(ass_path)
+                    storage.track(ass_path)
+                    graph.append(f"{crop},{ass_filter(ass_path, font_path)},format=yuv420p[v{i}]")
+                    continue
+
+                overlay_path = f"{os.path.splitext(path)[0]}_overlay.png"
+                create_rounded_text_image(text, overlay_path, out_w, out_h, font_path,
+                                          bg_color=placement["box"], text_color=placement["text"])
+                overlays.append(overlay_path)
+                storage.track(overlay_path)
+
+                cmd += ['-framerate', '25', '-i', overlay_path]
+                offset_bottom = int(out_h * placement["offset"])
+                graph.append(
+                    f"{crop}[c{i}];"
+                    f"[{next_input}:v]format=rgba[o{i}];"
+                    f"[c{i}][o{i}]overlay=x=(W-w)/2:y=H-h-{offset_bottom},format=yuv420p[v{i}]"
+                )
+                next_input += 1
+
+        # Звук общий для всех версий (с музыкой - одно сведение и asplit на выходы)
+        audio = caption_audio(input_video, next_input, profile=profiles, music=music, trim=trim, outputs=len(outputs))
+        cmd += audio["inputs"]
+        if audio["graph"]:
+            graph.append(audio["graph"])
+
+        labels = {}
+        cover_args = []
+        for i, aspect in enumerate(outputs):
+            cover_graph, labels[aspect], args = cover_branch(f"[v{i}]", (covers or {}).get(aspect), duration, tag=str(i))
+            if cover_graph:
+                graph.append(cover_graph)
+            cover_args += args
+
+        cmd += ['-filter_complex', ";".join(graph)]
+        for i, (aspect, path) in enumerate(outputs.items()):
+            cmd += ['-map', labels[aspect], '-map', audio["maps"][i]]
+            if profiles:
+                cmd += profile_encode_args(profiles[aspect])
+            else:
+                cmd += ['-c:v', 'libx264', '-preset', 'ultrafast']
+            cmd += [*audio["args"], *source["output_args"], '-movflags', '+faststart', path]
+        cmd += cover_args
+
+        logging.debug(f"Команда: {' '.join(cmd)}")
+        cover_paths = [covers[aspect] for aspect in outputs if covers and covers.get(aspect)]
+        result = run_ffmpeg(cmd, outputs=[*outputs.values(), *cover_paths])
+
+        if result.returncode != 0:
+            logging.error(f"FFmpeg ошибка: {result.stderr}")
+            return False
+
+        return True
+
+    except Exception as e:
+        logging.error(f"Ошибка: {e}")
+        return False
+    finally:
+        for overlay_path in overlays:
+            storage.remove(overlay_path)
+
+FFPROBE_PATH = os.getenv("FFPROBE_PATH", FFMPEG_PATH.replace("ffmpeg", "ffprobe"))
+PROBE_CACHE_SIZE = 256
+
+# (путь, размер, mtime) -> сведения о файле: один ролик пробуется несколько раз за задачу
+_probe_cache = {}
+_probe_lock = threading.Lock()
+
+
+def _parse_rate(rate):
+    """'30000/1001' -> 29.97"""
+    try:
+        num, _, den = str(rate).partition("/")
+        return float(num) / float(den or 1) if float(den or 1) else 0.0
+    except ValueError:
+        return 0.0
+
+
+def _ffprobe_json(video_path):
+    cmd = [
+        FFPROBE_PATH,
+        '-v', 'error',
+        '-print_format', 'json',
+        '-show_format',
+        '-show_streams',
+        video_path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    data = json.loads(result.stdout)
+
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if not video:
+        raise ValueError("в файле нет видеопотока")
+
+    rotation = int(float(video.get("tags", {}).get("rotate", 0) or 0))
+    for side_data in video.get("side_data_list", []):
+        if "rotation" in side_data:
+            rotation = int(side_data["rotation"])
+
+    return {
+        "width": int(video["width"]),
+        "height": int(video["height"]),
+        "fps": _parse_rate(video.get("avg_frame_rate")) or _parse_rate(video.get("r_frame_rate")),
+        "duration": float(data.get("format", {}).get("duration") or video.get("duration") or 0),
+        "video_codec": video.get("codec_name", ""),
+        "pix_fmt": video.get("pix_fmt", ""),
+        "color_space": video.get("color_space", ""),
+        "color_primaries": video.get("color_primaries", ""),
+        "color_transfer": video.get("color_transfer", ""),
+        "rotation": rotation % 360,
+        "has_audio": audio is not None,
+        "audio_codec": audio.get("codec_name", "") if audio else "",
+        "sample_rate": int(audio.get("sample_rate") or 0) if audio else 0,
+        "channels": int(audio.get("channels") or 0) if audio else 0
+    }
+
+
+PROBE_DURATION_RE = re.compile(r"Duration: (\d+):(\d+):([\d.]+)")
+PROBE_VIDEO_RE = re.compile(r"Video: (\w+).*?, (\w+)(?:\(([^)]*)\))?, (\d+)x(\d+)")
+PROBE_FPS_RE = re.compile(r"([\d.]+) fps")
+PROBE_AUDIO_RE = re.compile(r"Audio: (\w+).*?, (\d+) Hz, ([\w.]+)")
+PROBE_ROTATION_RE = re.compile(r"rotation of (-?[\d.]+) degrees|rotate\s*: (-?\d+)")
+
+
+def _ffmpeg_banner_probe(video_path):
+    """Запасной вариант без ffprobe: разбор заголовка `ffmpeg -i`"""
+    result = subprocess.run([FFMPEG_PATH, '-hide_banner', '-i', video_path], capture_output=True, text=True)
+    text = result.stderr
+
+    video = PROBE_VIDEO_RE.search(text)
+    if not video:
+        raise ValueError("в файле нет видеопотока")
+    duration = PROBE_DURATION_RE.search(text)
+    fps = PROBE_FPS_RE.search(text)
+    audio = PROBE_AUDIO_RE.search(text)
+    rotation = PROBE_ROTATION_RE.search(text)
+
+    # "tv, bt2020nc/bt2020/smpte2084" -> пространство / праймериз / передаточная функция;
+    # если все три совпадают, FFmpeg пишет одно имя: "tv, bt709, progressive"
+    color = ["", "", ""]
+    for part in (video.group(3) or "").split(", "):
+        if part.count("/") == 2:
+            color = part.split("/")
+        elif part.startswith(("bt", "smpte")):
+            color = [part] * 3
+    color_space, color_primaries, color_transfer = color
+    channels = {"mono": 1, "stereo": 2, "5.1": 6, "7.1": 8}.get(audio.group(3), 2) if audio else 0
+
+    return {
+        "width": int(video.group(4)),
+        "height": int(video.group(5)),
+        "fps": float(fps.group(1)) if fps else 0.0,
+        "duration": int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3)) if duration else 0.0,
+        "video_codec": video.group(1),
+        "pix_fmt": video.group(2),
+        "color_space": color_space,
+        "color_primaries": color_primaries,
+        "color_transfer": color_transfer,
+        "rotation": int(float(next(g for g in rotation.groups() if g))) % 360 if rotation else 0,
+        "has_audio": audio is not None,
+        "audio_codec": audio.group(1) if audio else "",
+        "sample_rate": int(audio.group(2)) if audio else 0,
+        "channels": channels
+    }
+
+
+def probe_video(video_path):
+    """
+    Сведения о ролике: размеры, fps, длительность, звук, цветовые метаданные, поворот.
+    Берем из ffprobe (JSON); если его нет (статические сборки FFmpeg) - из заголовка `ffmpeg -i`.
+    Результат кэшируется, пока файл не изменился.
+    """
+    stat = os.stat(video_path)
+    key = (os.path.abspath(video_path), stat.st_size, stat.st_mtime_ns)
+    with _probe_lock:
+        if key in _probe_cache:
+            return _probe_cache[key]
+
+    with stage_timer("probe"):
+        try:
+            info = _ffprobe_json(video_path)
+        except FileNotFoundError:
+            info = _ffmpeg_banner_probe(video_path)
+
+    with _probe_lock:
+        if len(_probe_cache) >= PROBE_CACHE_SIZE:
+            _probe_cache.clear()
+        _probe_cache[key] = info
+    return info
+
+
+HDR_TRANSFERS = ("smpte2084", "arib-std-b67")  # PQ (HDR10, Dolby Vision) и HLG (HDR с iPhone)
+HDR_TONEMAP = os.getenv("HDR_TONEMAP", "hable")  # Алгоритм tonemap: hable, mobius, reinhard
+HDR_PEAK_NITS = 100  # Яркость белого SDR для перевода в линейный свет
+HDR_THREADS = int(os.getenv("HDR_THREADS", "0"))  # Потоков декодера и фильтров на HDR-кодирование (0 - поровну между кодированиями)
+MP4_AUDIO_CODECS = ("aac", "mp3", "ac3", "eac3", "alac", "opus")  # Такой звук кладем в MP4 без перекодирования
+
+_filter_support = {}
+
+
+def ffmpeg_has_filter(name):
+    """Есть ли фильтр в сборке FFmpeg (проверяем один раз)"""
+    if name not in _filter_support:
+        try:
+            result = subprocess.run([FFMPEG_PATH, '-hide_banner', '-filters'], capture_output=True, text=True)
+            _filter_support[name] = re.search(rf"^\s*\S+\s+{re.escape(name)}\s", result.stdout, re.M) is not None
+        except FileNotFoundError:
+            _filter_support[name] = False
+    return _filter_support[name]
+
+
+def is_hdr(info):
+    return info.get("color_transfer") in HDR_TRANSFERS
+
+
+def source_video_filter(video_path):
+    """
+    Приведение исходника к SDR BT.709 в том же проходе, что и подпись.
+    HDR (10-битный HEVC с iPhone) переводится в линейный свет, tonemap и обратно в 8 бит
+    одной цепочкой zscale; декодеру и фильтрам даем свою долю ядер.
+    Возвращает {"filter": цепочка или "", "input_args": [...], "output_args": [...]}.
+    """
+    source = {"filter": "", "input_args": [], "output_args": []}
+    try:
+        info = probe_video(video_path)
+    except Exception:
+        return source
+    if not is_hdr(info):
+        return source
+    if not ffmpeg_has_filter("zscale"):
+        logging.warning("HDR-видео, но в сборке FFmpeg нет zscale: цвета будут без tonemap")
+        return source
+
+    threads = HDR_THREADS or max(1, ENCODE_CORES // max(1, MAX_CONCURRENT_ENCODES))
+    matrix = info.get("color_space") or "bt2020nc"
+    logging.info(f"HDR ({info['color_transfer']}, {info.get('pix_fmt')}): tonemap {HDR_TONEMAP}, потоков {threads}")
+
+    source["filter"] = (
+        # Линейный свет и гамут BT.709 - одним zscale; tonemap в float; обратно в 8 бит - еще одним
+        f"zscale=tin={info['color_transfer']}:pin=bt2020:min={matrix}:t=linear:npl={HDR_PEAK_NITS}:p=bt709,"
+        f"format=gbrpf32le,tonemap={HDR_TONEMAP}:desat=0,"
+        f"zscale=t=bt709:m=bt709:r=tv,format=yuv420p"
+    )
+    source["input_args"] = [
+        '-threads', str(threads),
+        '-filter_threads', str(threads),
+        '-filter_complex_threads', str(threads)
+    ]
+    source["output_args"] = ['-color_primaries', 'bt709', '-color_trc', 'bt709', '-colorspace', 'bt709']
+    return source
+
+
+def audio_codec_args(video_path):
+    """Звук копируем, если MP4 его принимает; иначе (PCM из MOV и т.п.) кодируем в AAC"""
+    try:
+        codec = probe_video(video_path).get("audio_codec")
+    except Exception:
+        codec = None
+    if codec is None or codec in MP4_AUDIO_CODECS:
+        return ['-c:a', 'copy']
+    return ['-c:a', 'aac', '-b:a', '128k']
+
+
+def caption_audio(input_video, next_input, profile=None, music=None, trim=None, outputs=1):
+    """
+    Звук для прохода с подписью: {"inputs", "graph", "maps", "args"} - доп. входы FFmpeg,
+    ветка filter_complex (или ""), что мапить в каждый выход и параметры звука.
+    profile - профиль заставок (кодек звука тогда задает он), music - фоновый трек.
+    """
+    try:
+        info = probe_video(input_video)
+    except Exception:
+        info = {"has_audio": True, "duration": None}
+    has_audio = info["has_audio"]
+
+    audio = {"inputs": [], "graph": "", "maps": ['0:a?'] * outputs, "args": audio_codec_args(input_video)}
+    if music:
+        duration = trim["duration"] if trim else info["duration"]
+        audio["inputs"], audio["graph"], audio["maps"] = music_mix(music, next_input, has_audio, duration, outputs)
+        audio["args"] = ['-c:a', 'aac', '-b:a', '160k', '-shortest']
+    elif profile and not has_audio:
+        # Заставки со звуком: ролику без звука нужна тишина
+        audio["inputs"] = ['-f', 'lavfi', '-i', SILENT_AUDIO]
+        audio["maps"] = [f'{next_input}:a'] * outputs
+    elif profile:
+        audio["maps"] = ['0:a:0'] * outputs
+
+    if profile:
+        audio["args"] = ['-shortest']
+    return audio
+
+
+def process_renditions(input_path, outputs, text, caption=None, analysis=None, trim=None, music=None, covers=None):
+    """
+    Версии в нескольких форматах; с заставками каждая кодируется в свой профиль и склеивается без перекодирования.
+    music - имя трека из music_library, covers - {формат: путь} для обложек
+    """
+    if trim is None and trim_enabled():
+        trim = plan_trim(input_path)
+    if analysis is None and PLACEMENT_ANALYSIS:
+        analysis = analyze_frames(input_path, trim)
+    music = music_asset(music)
+    if not bumpers_enabled():
+        return add_text_renditions(input_path, outputs, text, caption=caption, analysis=analysis, trim=trim, music=music,
+                                   covers=covers)
+
+    v_width, v_height = get_video_dimensions(input_path)
+    fps = input_profile(input_path)["fps"]
+    profiles = {aspect: output_profile(*rendition_size(aspect, v_width, v_height), fps) for aspect in outputs}
+    main_files = {aspect: path.replace('.mp4', '_main.mp4') for aspect, path in outputs.items()}
+    try:
+        if not add_text_renditions(input_path, main_files, text, profiles=profiles, caption=caption, analysis=analysis,
+                                   trim=trim, music=music, covers=covers):
+            return False
+        return all(attach_bumpers(main_files[aspect], outputs[aspect], profiles[aspect]) for aspect in outputs)
+    finally:
+        for path in main_files.values():
+            storage.remove(path)
+
+
+def get_video_dimensions(video_path):
+    """
+    Возвращает размеры (width, height) кадра так, как его увидят фильтры FFmpeg
+    (с учетом поворота из метаданных телефона).
+    """
+    try:
+        info = probe_video(video_path)
+        if info["rotation"] in (90, 270):
+            return info["height"], info["width"]
+        return info["width"], info["height"]
+    except Exception as e:
+        logging.error(f"Не удалось получить размер видео: {e}")
+        # Возвращаем значения по умолчанию (FullHD), если не получилось
+        return 1920, 1080
+
+def process_video(input_path, output_path, text, caption=None, analysis=None, trim=None, music=None, cover=None):
+    """
+    Обрабатываем одно видео (caption - движок и анимация подписи, см. caption_settings;
+    analysis и trim - готовые результаты analyze_frames и plan_trim, иначе считаем здесь;
+    music - имя трека из music_library для фоновой музыки; cover - путь для JPEG-обложки)
+    """
+    main_file = None
+    try:
+        filename = os.path.basename(input_path)
+        logging.info(f"Обрабатываю: {filename}")
+        if trim is None and trim_enabled():
+            trim = plan_trim(input_path)
+        if analysis is None and PLACEMENT_ANALYSIS:
+            analysis = analyze_frames(input_path, trim)
+        music = music_asset(music)
+
+        # MOV (в том числе HDR HEVC с iPhone) отдельно не конвертируем: перевод в SDR H.264
+        # и звук для MP4 делаются в том же проходе, что и подпись (source_video_filter)
+
+        # С заставками ролик кодируем сразу в их профиль - склейка пройдет без перекодирования
+        profile = input_profile(input_path) if bumpers_enabled() else None
+        if profile:
+            main_file = output_path.replace('.mp4', '_main.mp4')
+
+        # Добавляем текст
+        if not add_caption(input_path, main_file or output_path, text, profile=profile, caption=caption, analysis=analysis,
+                           trim=trim, music=music, cover=cover):
+            logging.error("Ошибка добавления текста")
+            return False
+
+        if profile and not attach_bumpers(main_file, output_path, profile):
+            logging.error("Ошибка добавления заставок")
+            return False
+
+        logging.info("Видео готово")
+        return True
+
+    except Exception as e:
+        logging.error(f"Ошибка: {e}")
+        return False
+    finally:
+        # Удаляем временный файл, если он был создан (в том числе при ошибке)
+        if main_file:
+            storage.remove(main_file)
+
+
+def openrouter_complete(prompt, **extra):
+    """Один запрос к OpenRouter, возвращает текст ответа"""
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+    payload = {
+        "model": OPENROUTER_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": round(random.uniform(0.65, 0.9), 2),
+        **extra
+    }
+
+    r = requests.post(
+        OPENROUTER_URL,
+        headers=headers,
+        data=json.dumps(payload),
+        timeout=60
+    )
+    r.raise_for_status()
+    return r.json()["choices"][0]["message"]["content"]
+
+
+# Роль автора текстов - общая для одиночного и пакетного запроса
+LLM_PERSONA = """
+    Ты — философ-практик и мастер с 20-летним стажем в индустрии барберинга и мужского груминга.
+    Ты наблюдаешь за салоном, клиентами и инструментами как за метафорой жизни. 
+    Твои тексты — это короткие, емкие, визуальные мини-эссе для Instagram Reels. 
+    Они сочетают поэзию, практическую мудрость и острые социальные наблюдения. 
+    Твой стиль: лаконичный, слегка ироничный, но глубокий. 
+    Как смесь Алена де Боттона и крутого барбера с улиц большого города.
+    Не повторяйся. Не пиши искусство быть собой.
+    На тему только опирайся, строго следуй формату.
+"""
+
+
+def generate_title_and_description(theme: str, avoid=None):
+    """Генерация заголовка и описания через OpenRouter (avoid - заголовки, которые пользователь отклонил)"""
+    prompt = f"""{LLM_PERSONA}
+    ТЕМА:
+    {theme}
+
+    СДЕЛАЙ:
+    1. Заголовок строго в 1 строку, коротко.
+    2. Описание 3–4 абзаца.
+    3. Спокойный, зрелый тон.
+    4. Без маркетинговых клише.
+    5. В конце 7–10 хэштегов.
+
+    ФОРМАТ(СТРОГО!!!):
+
+    ЗАГОЛОВОК:
+    строка
+
+    ОПИСАНИЕ:
+    текст
+    """
+    if avoid:
+        rejected = "\n".join(f"- {title}" for title in avoid)
+        prompt += f"\n    Эти заголовки не подошли, придумай непохожий:\n{rejected}\n"
+
+    try:
+        with stage_timer("llm"):
+            content = openrouter_complete(prompt)
+
+            logging.debug(f"Получен ответ от ИИ ({len(content)} символов): {content[:300]}")
+
+            if "ОПИСАНИЕ:" in content:
+                title_part, desc_part = content.split("ОПИСАНИЕ:")
+                title = title_part.replace("ЗАГОЛОВОК:", "").strip()
+                description = desc_part.strip()
+            else:
+                # Если формат не соответствует, возвращаем весь текст нейросети для генерации заголовка
+                ar_prompt = f"Отправь короткий заголовок до 5 слов, которым можно описать этот текст: {content}"
+                title = openrouter_complete(ar_prompt).strip()
+                description = content
+
+        logging.info(f"Сгенерирован заголовок: {title}")
+        logging.info(f"Сгенерировано описание (первые 100 символов): {description[:100]}...")
+        return title, description
+
+    except Exception as e:
+        logging.error(f"Ошибка генерации текста: {e}")
+        return "Философия барберинга", "Описание не сгенерировано из-за ошибки API."
+
+
+def generate_titles_batch(theme: str, count: int):
+    """
+    Заголовки и описания для альбома одним запросом: LLM возвращает JSON
+    с count разными вариантами. Чего не хватило - догенерируем по одному.
+    """
+    if count <= 1:
+        return [generate_title_and_description(theme)]
+
+    prompt = f"""{LLM_PERSONA}
+    ТЕМА:
+    {theme}
+
+    СДЕЛАЙ РОВНО {count} РАЗНЫХ ТЕКСТОВ для серии роликов. Для каждого:
+    1. Заголовок строго в 1 строку, коротко.
+    2. Описание 3–4 абзаца.
+    3. Спокойный, зрелый тон.
+    4. Без маркетинговых клише.
+    5. В конце описания 7–10 хэштегов.
+    Заголовки не должны повторять друг друга.
+
+    ФОРМАТ(СТРОГО!!!) - только JSON, без пояснений:
+    {{"items": [{{"title": "строка", "description": "текст"}}]}}
+    """
+
+    results = []
+    try:
+        with stage_timer("llm", batch=count):
+            content = openrouter_complete(prompt, response_format={"type": "json_object"})
+            logging.debug(f"Получен ответ от ИИ ({len(content)} символов): {content[:300]}")
+
+            # Модели иногда оборачивают JSON в ```json ... ```
+            json_text = content[content.find("{"):content.rfind("}") + 1]
+            for item in json.loads(json_text).get("items", []):
+                title = str(item.get("title", "")).strip()
+                description = str(item.get("description", "")).strip()
+                if title:
+                    results.append((title, description or "Описание не сгенерировано"))
+
+        logging.info(f"Сгенерировано заголовков за один запрос: {len(results)} из {count}")
+
+    except Exception as e:
+        logging.error(f"Ошибка пакетной генерации текста: {e}")
+
+    results = results[:count]
+    while len(results) < count:
+        results.append(generate_title_and_description(theme))
+    return results
+
+
+# ============ АНАЛИЗ КАДРА ДЛЯ ПОДПИСИ ============
+PLACEMENT_ANALYSIS = os.getenv("PLACEMENT_ANALYSIS", "1") == "1"  # Подбирать место и цвет подписи по кадрам ролика
+PLACEMENT_FRAMES = 6  # Сколько ключевых кадров берем для анализа
+PLACEMENT_WIDTH = 64  # Ширина уменьшенного кадра (пикселей)
+CAPTION_OFFSETS = (0.2, 0.1, 0.3, 0.62)  # Отступ низа подписи от низа кадра (доля высоты); первый - обычный
+PLACEMENT_BIAS = 0.15  # Насколько неохотно уходим от обычного места (штраф за каждую следующую позицию)
+PLACEMENT_BRIGHT_LUMA = 175  # Фон под подписью светлее этого - подложка темная
+CAPTION_LIGHT = {"box": "#ffffff", "text": "#000000"}  # Обычная белая подложка
+CAPTION_DARK = {"box": "#141414", "text": "#ffffff"}
+
+
+def analyze_frames(video_path, trim=None):
+    """
+    Несколько ключевых кадров в сильно уменьшенном виде (серые, rawvideo через pipe)
+    сводим в профили по строкам кадра: детализация (градиенты + движение) и яркость.
+    trim - смотрим только отрезок, который пойдет в результат (plan_trim).
+    Возвращает {"detail": [...], "luma": [...], "frames": n} или None, если не вышло.
+    """
+    try:
+        with stage_timer("analyze") as span:
+            v_width, v_height = get_video_dimensions(video_path)
+            width = PLACEMENT_WIDTH
+            height = max(2, round(width * v_height / v_width / 2) * 2)
+            duration = trim["duration"] if trim else probe_video(video_path)["duration"] or 0
+            step = duration / PLACEMENT_FRAMES
+
+            # Декодируем только ключевые кадры, равномерно по длине ролика; если после
+            # обрезки в отрезке нет ключевых кадров - все кадры
+            frame_size = width * height
+            for decode in (['-skip_frame', 'nokey'], []):
+                cmd = [
+                    FFMPEG_PATH, '-v', 'error',
+                    *decode,
+                    *trim_input_args(trim),
+                    '-i', video_path,
+                    '-an',
+                    '-vf', f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,{step:.3f})',"
+                           f"scale={width}:{height}:flags=area,format=gray",
+                    '-fps_mode', 'vfr',
+                    '-frames:v', str(PLACEMENT_FRAMES),
+                    '-f', 'rawvideo', '-'
+                ]
+                result = subprocess.run(cmd, capture_output=True, timeout=30)
+                count = len(result.stdout) // frame_size
+                if count or result.returncode != 0:
+                    break
+            if result.returncode != 0 or not count:
+                raise RuntimeError(result.stderr.decode("utf-8", "replace").strip() or "нет кадров")
+
+            frames = np.frombuffer(result.stdout, np.uint8, count * frame_size).reshape(count, height, width)
+            # Подпись занимает середину кадра по ширине - края не учитываем
+            core = frames[:, :, width // 10: width - width // 10].astype(np.float32)
+
+            gradient_x = np.abs(np.diff(core, axis=2)).mean(axis=2)
+            gradient_y = np.abs(np.diff(core, axis=1, append=core[:, -1:, :])).mean(axis=2)
+            motion = core.std(axis=0).mean(axis=1) if count > 1 else np.zeros(height, np.float32)
+            detail = (gradient_x + gradient_y).mean(axis=0) + motion
+            luma = core.mean(axis=(0, 2))
+            span["frames"] = count
+
+        return {
+            "detail": [round(float(value), 1) for value in detail],
+            "luma": [round(float(value), 1) for value in luma],
+            "frames": count
+        }
+    except Exception as e:
+        logging.warning(f"Анализ кадров не удался, подпись на обычном месте: {e}")
+        return None
+
+
+def choose_caption_placement(analysis, caption_ratio, visible=(0.0, 1.0)):
+    """
+    Место и цвета подписи по профилям кадра: полоса с наименьшей детализацией
+    (с небольшим штрафом за уход с обычного места), цвета - по яркости фона под ней.
+    caption_ratio - высота подписи в долях кадра, visible - видимая часть кадра
+    по высоте (для версий с обрезкой).
+    """
+    placement = {"offset": CAPTION_OFFSETS[0], **CAPTION_LIGHT}
+    if not analysis or not analysis.get("detail"):
+        return placement
+
+    detail = np.asarray(analysis["detail"], np.float32)
+    luma = np.asarray(analysis["luma"], np.float32)
+    rows = len(detail)
+    first = int(rows * visible[0])
+    visible_rows = max(1, int(rows * visible[1]) - first)
+
+    best_score, best_band = None, None
+    for index, offset in enumerate(CAPTION_OFFSETS):
+        bottom = first + visible_rows * (1 - offset)
+        top = bottom - visible_rows * caption_ratio
+        if top < first:
+            continue  # Подпись не помещается над этим отступом
+        band = slice(int(top), max(int(top) + 1, int(np.ceil(bottom))))
+        score = float(detail[band].mean()) * (1 + PLACEMENT_BIAS * index)
+        if best_score is None or score < best_score:
+            best_score, best_band = score, band
+            placement["offset"] = offset
+
+    if best_band is not None and float(luma[best_band].mean()) > PLACEMENT_BRIGHT_LUMA:
+        placement.update(CAPTION_DARK)
+    return placement
+
+
+def caption_placement(analysis, text, video_width, video_height, font_path=None, visible=(0.0, 1.0)):
+    """Размещение подписи для кадра заданного размера (высота подписи - по той же раскладке)"""
+    if not analysis:
+        return choose_caption_placement(None, 0)
+    lines = layout_caption(text, video_width, video_height, font_path)["lines"]
+    caption_height = sum(item["box_h"] for item in lines) + (len(lines) - 1)
+    return choose_caption_placement(analysis, caption_height / video_height, visible)
+
+
+# ============ ОБРЕЗКА ПЕРЕД КОДИРОВАНИЕМ ============
+TRIM_MAX_SECONDS = float(os.getenv("TRIM_MAX_SECONDS", "0"))  # Максимальная длина результата, сек (0 - без ограничения)
+TRIM_DEAD_AIR = os.getenv("TRIM_DEAD_AIR", "0") == "1"  # Срезать тишину на неподвижной картинке в начале и конце
+TRIM_SILENCE_DB = -40  # Тише этого (дБ) - тишина
+TRIM_FREEZE_NOISE = 0.003  # Порог изменения кадра для freezedetect
+TRIM_MIN_GAP = 0.7  # Паузы короче этого (сек) не режем
+TRIM_EDGE = 0.2  # Пауза считается началом или концом ролика, если до края меньше этого (сек)
+TRIM_MIN_KEEP = 1.0  # Если после обрезки остается меньше (сек) - не режем вовсе
+
+SILENCE_RE = re.compile(r"silence_(start|end): (-?[\d.]+)")
+FREEZE_RE = re.compile(r"freeze_(start|end): (-?[\d.]+)")
+DETECTOR_LINE_RE = re.compile(r"(silence|freeze)_(start|end)")  # Строки детекторов, которые не должны уйти из хвоста stderr
+
+
+def trim_enabled():
+    return TRIM_DEAD_AIR or TRIM_MAX_SECONDS > 0
+
+
+def _detector_intervals(matches, duration):
+    """Пары start/end из лога детектора; незакрытый интервал тянется до конца ролика"""
+    intervals = []
+    start = None
+    for kind, value in matches:
+        if kind == "start":
+            start = max(0.0, float(value))
+        elif start is not None:
+            intervals.append((start, float(value)))
+            start = None
+    if start is not None:
+        intervals.append((start, duration))
+    return intervals
+
+
+def detect_dead_air(video_path, duration, has_audio):
+    """
+    Интервалы "пустоты": тишина (silencedetect) одновременно с неподвижной картинкой (freezedetect).
+    Детекторы смотрят прореженный поток: 5 кадров/с шириной 64 px и звук 8 кГц.
+    """
+    cmd = [
+        FFMPEG_PATH, '-hide_banner',
+        '-i', video_path,
+        '-vf', f"fps=5,scale=64:-2,freezedetect=n={TRIM_FREEZE_NOISE}:d={TRIM_MIN_GAP}"
+    ]
+    if has_audio:
+        cmd += ['-af', f"aresample=8000,silencedetect=n={TRIM_SILENCE_DB}dB:d={TRIM_MIN_GAP}"]
+    else:
+        cmd += ['-an']
+    cmd += ['-f', 'null', '-']
+
+    result = run_ffmpeg(cmd, stage="trim", keep=DETECTOR_LINE_RE)
+    if result.returncode != 0:
+        raise RuntimeError(f"детекторы завершились с кодом {result.returncode}")
+
+    frozen = _detector_intervals(FREEZE_RE.findall(result.stderr), duration)
+    if not has_audio:
+        return frozen
+
+    silent = _detector_intervals(SILENCE_RE.findall(result.stderr), duration)
+    return [
+        (max(f_start, s_start), min(f_end, s_end))
+        for f_start, f_end in frozen
+        for s_start, s_end in silent
+        if min(f_end, s_end) > max(f_start, s_start)
+    ]
+
+
+def plan_trim(video_path):
+    """
+    Какой отрезок ролика кодировать: без "пустоты" в начале и конце (TRIM_DEAD_AIR)
+    и не длиннее TRIM_MAX_SECONDS.
+    Возвращает {"start", "duration", "source", "reasons"} или None, если резать нечего.
+    """
+    try:
+        info = probe_video(video_path)
+        source = info["duration"]
+        if not source:
+            return None
+
+        start, end = 0.0, source
+        reasons = []
+        if TRIM_DEAD_AIR:
+            for gap_start, gap_end in detect_dead_air(video_path, source, info["has_audio"]):
+                if gap_start <= TRIM_EDGE:
+                    start = max(start, gap_end)
+                if gap_end >= source - TRIM_EDGE:
+                    end = min(end, gap_start)
+            if end - start < TRIM_MIN_KEEP:
+                start, end = 0.0, source  # Пустой почти весь ролик - лучше отдать как есть
+            if start > 0:
+                reasons.append("head")
+            if end < source:
+                reasons.append("tail")
+
+        if TRIM_MAX_SECONDS and end - start > TRIM_MAX_SECONDS:
+            end = start + TRIM_MAX_SECONDS
+            reasons.append("limit")
+
+        if not reasons:
+            return None
+        logging.info(f"Обрезка: {start:.2f}-{end:.2f} из {source:.2f} сек ({', '.join(reasons)})")
+        return {"start": round(start, 3), "duration": round(end - start, 3), "source": round(source, 3), "reasons": reasons}
+
+    except Exception as e:
+        logging.warning(f"Не удалось подобрать обрезку, кодирую ролик целиком: {e}")
+        return None
+
+
+def trim_input_args(trim):
+    """Быстрый поиск на входе: отрезанные кадры не декодируются и не кодируются"""
+    if not trim:
+        return []
+    return ['-ss', f"{trim['start']:.3f}", '-t', f"{trim['duration']:.3f}"]
+
+
+def trim_note(trim):
+    """Строка для подписи к видео: что и почему обрезано"""
+    if not trim:
+        return ""
+    reasons = {
+        "head": "пауза в начале",
+        "tail": "пауза в конце",
+        "limit": f"лимит {TRIM_MAX_SECONDS:g} с"
+    }
+    return (
+        f"✂️ Обрезано: {trim['start']:.1f}–{trim['start'] + trim['duration']:.1f} с из {trim['source']:.1f} с "
+        f"({', '.join(reasons[reason] for reason in trim['reasons'])})"
+    )
+
+
+# ============ ОБЛОЖКА И ДАННЫЕ ДЛЯ ОТПРАВКИ ============
+COVER_SIZE = 320  # Превью видео в Telegram - JPEG не больше 320x320
+COVER_AT = 1.0  # Кадр обложки берем с этой секунды (у коротких роликов - с середины)
+
+
+def cover_path(video_path):
+    return f"{os.path.splitext(video_path)[0]}_cover.jpg"
+
+
+def cover_branch(video_label, cover, duration=None, tag=""):
+    """
+    Обложка второй веткой того же графа и вторым выходом того же запуска FFmpeg.
+    Возвращает (добавка к графу, метка видео для основного выхода, аргументы выхода обложки).
+    """
+    if not cover:
+        return "", video_label, []
+    at = min(COVER_AT, duration / 2) if duration else 0
+    graph = (
+        f"{video_label}split=2[main{tag}][poster{tag}];"
+        f"[poster{tag}]trim=start={at:.3f},scale={COVER_SIZE}:{COVER_SIZE}:force_original_aspect_ratio=decrease[cover{tag}]"
+    )
+    return graph, f"[main{tag}]", ['-map', f'[cover{tag}]', '-frames:v', '1', '-q:v', '5', cover]
+
+
+def _mp4_boxes(data):
+    """Боксы MP4 внутри data: (тип, содержимое)"""
+    offset = 0
+    while offset + 8 <= len(data):
+        size, kind = struct.unpack(">I4s", data[offset:offset + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[offset + 8:offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = len(data) - offset
+        if size < header:
+            return
+        yield kind, data[offset + header:offset + size]
+        offset += size
+
+
+def mp4_meta(path):
+    """
+    Размер кадра и длительность из заголовка MP4 (moov) - без FFmpeg и ffprobe.
+    Остальные боксы (mdat с видео) пропускаем, не читая; после faststart moov в самом начале файла.
+    """
+    file_size = os.path.getsize(path)
+    moov = None
+    with open(path, "rb") as f:
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            size, kind = struct.unpack(">I4s", f.read(8))
+            header = 8
+            if size == 1:
+                size = struct.unpack(">Q", f.read(8))[0]
+                header = 16
+            elif size == 0:
+                size = file_size - offset
+            if size < header:
+                break
+            if kind == b"moov":
+                moov = f.read(size - header)
+                break
+            offset += size
+    if moov is None:
+        raise ValueError("В файле нет moov")
+
+    meta = {"width": 0, "height": 0, "duration": 0.0}
+    for kind, box in _mp4_boxes(moov):
+        if kind == b"mvhd":
+            if box[0] == 1:
+                timescale, duration = struct.unpack(">IQ", box[20:32])
+            else:
+                timescale, duration = struct.unpack(">II", box[12:20])
+            meta["duration"] = duration / timescale if timescale else 0.0
+        elif kind == b"trak" and not meta["width"]:
+            for child, tkhd in _mp4_boxes(box):
+                if child == b"tkhd":
+                    # Ширина и высота (16.16) - после матрицы; у звуковой дорожки нули
+                    start = 88 if tkhd[0] == 1 else 76
+                    width, height = struct.unpack(">II", tkhd[start:start + 8])
+                    meta["width"], meta["height"] = width >> 16, height >> 16
+    return meta
+
+
+def video_upload_args(path):
+    """Размер, длительность и обложка для send_video / InputMediaVideo: Telegram не придется разбирать файл сам"""
+    args = {"supports_streaming": True}
+    try:
+        meta = mp4_meta(path)
+        args.update(width=meta["width"] or None, height=meta["height"] or None, duration=round(meta["duration"]) or None)
+    except Exception as e:
+        logging.warning(f"Не удалось прочитать заголовок {path}: {e}")
+    cover = cover_path(path)
+    if os.path.exists(cover) and os.path.getsize(cover) > 0:
+        args["thumbnail"] = FSInputFile(cover)
+    return args
+
+
+# ============ РОЛИК ИЗ ФОТО ============
+# Telegram сжимает фото до 1280 по длинной стороне: ролик крупнее только растянул бы их
+SLIDESHOW_SIZE = os.getenv("SLIDESHOW_SIZE", "720x1280")  # Размер ролика из фото (ширина x высота)
+SLIDESHOW_FPS = 25
+SLIDE_SECONDS = float(os.getenv("SLIDE_SECONDS", "3"))  # Сколько показываем одно фото (сек)
+# Затемнение на стыке фото (сек): fade трогает только крайние кадры показа,
+# а цепочка наплывов xfade на 10 фото обходится дороже самого движения камеры
+SLIDE_FADE = 0.25
+SLIDE_ZOOM = 0.12  # Насколько приближается фото за время показа (Ken Burns)
+SLIDE_SUPERSAMPLE = 1  # Запас масштаба под zoompan (2 - мельче шаг сдвига на крупных фото, но движение вдвое дороже)
+SLIDESHOW_MAX_PHOTOS = 10  # Больше фото в альбоме Telegram не бывает
+
+# Движения камеры по фото (zoompan): приближение, отдаление, проезды влево и вправо.
+# on - номер кадра внутри показа, d - кадров на фото
+SLIDE_CENTER = "x='iw/2-iw/zoom/2':y='ih/2-ih/zoom/2'"
+SLIDE_MOTIONS = (
+    f"z='1+{SLIDE_ZOOM}*on/{{d}}':{SLIDE_CENTER}",
+    f"z='1+{SLIDE_ZOOM}*(1-on/{{d}})':{SLIDE_CENTER}",
+    f"z='1+{SLIDE_ZOOM}':x='(iw-iw/zoom)*on/{{d}}':y='ih/2-ih/zoom/2'",
+    f"z='1+{SLIDE_ZOOM}':x='(iw-iw/zoom)*(1-on/{{d}})':y='ih/2-ih/zoom/2'",
+)
+
+
+def slideshow_size():
+    width, height = (int(value) for value in SLIDESHOW_SIZE.lower().split("x"))
+    return width - width % 2, height - height % 2
+
+
+def photo_paths(input_path, count):
+    """Файлы фото задачи: рядом с путем исходника, по одному на фото"""
+    stem = os.path.splitext(input_path)[0]
+    return [f"{stem}_{index}.jpg" for index in range(count)]
+
+
+def slideshow_duration(count):
+    return count * SLIDE_SECONDS
+
+
+def slide_filter(index, width, height, fps):
+    """
+    Одно фото: кадрируем под размер ролика и гоняем по нему камеру.
+    zoompan выдает все кадры показа из одного декодированного кадра -
+    JPEG не декодируется и не копируется заново на каждый кадр, как с -loop 1.
+    """
+    frames = max(1, round(SLIDE_SECONDS * fps))
+    canvas_w, canvas_h = width * SLIDE_SUPERSAMPLE, height * SLIDE_SUPERSAMPLE
+    motion = SLIDE_MOTIONS[index % len(SLIDE_MOTIONS)].format(d=frames)
+    return (
+        f"[{index}:v]scale={canvas_w}:{canvas_h}:force_original_aspect_ratio=increase,"
+        f"crop={canvas_w}:{canvas_h},setsar=1,"
+        f"zoompan={motion}:d={frames}:s={width}x{height}:fps={fps},"
+        f"fade=t=in:d={SLIDE_FADE},fade=t=out:st={SLIDE_SECONDS - SLIDE_FADE:.3f}:d={SLIDE_FADE},format=yuv420p[s{index}]"
+    )
+
+
+def build_slideshow(photos, output_video, text, font_path="/usr/share/fonts/truetype/msttcorefonts/Arial.ttf",
+                    profile=None, music=None, cover=None):
+    """
+    Ролик из фото одним запуском FFmpeg: движение камеры, затемнения на стыках, подложка с подписью
+    (как у движка pillow) и звук. profile - профиль заставок, music - трек (MusicLibrary.asset),
+    cover - путь для JPEG-обложки.
+    """
+    width, height = (profile["width"], profile["height"]) if profile else slideshow_size()
+    fps = profile["fps"] if profile else SLIDESHOW_FPS
+    duration = slideshow_duration(len(photos))
+    overlay_path = f"{os.path.splitext(output_video)[0]}_overlay.png"
+
+    try:
+        placement = caption_placement(None, text, width, height, font_path)
+        with stage_timer("overlay_render"), profiled("overlay_render"):
+            create_rounded_text_image(
+                text=text,
+                output_path=overlay_path,
+                video_width=width,
+                video_height=height,
+                font_path=font_path,
+                bg_color=placement["box"],
+                text_color=placement["text"]
+            )
+        storage.track(overlay_path)
+
+        cmd = [FFMPEG_PATH]
+        for path in photos:
+            cmd += ['-i', path]
+        overlay_input = len(photos)
+        cmd += ['-framerate', str(fps), '-i', overlay_path]
+
+        graph = [slide_filter(index, width, height, fps) for index in range(len(photos))]
+        if len(photos) == 1:
+            slides = "[s0]"
+        else:
+            graph.append("".join(f"[s{index}]" for index in range(len(photos))) + f"concat=n={len(photos)}:v=1:a=0[slides]")
+            slides = "[slides]"
+
+        offset_bottom = int(height * placement["offset"])
+        graph.append(
+            f"[{overlay_input}:v]format=rgba[alpha];"
+            f"{slides}[alpha]overlay=x=(W-w)/2:y=H-h-{offset_bottom},format=yuv420p[v]"
+        )
+        cover_graph, video_label, cover_args = cover_branch("[v]", cover, duration)
+        if cover_graph:
+            graph.append(cover_graph)
+
+        # Своего звука у фото нет: музыка или тишина (без дорожки Telegram может показать ролик как GIF)
+        if music:
+            inputs, audio_graph, labels = music_mix(music, overlay_input + 1, False, duration)
+            cmd += inputs
+            graph.append(audio_graph)
+            audio_map = labels[0]
+        else:
+            cmd += ['-f', 'lavfi', '-i', SILENT_AUDIO]
+            audio_map = f'{overlay_input + 1}:a'
+
+        cmd += ['-filter_complex', ";".join(graph), '-map', video_label, '-map', audio_map]
+        if profile:
+            cmd += profile_encode_args(profile)
+        else:
+            cmd += ['-r', str(fps), '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac', '-b:a', '128k']
+        # Кадры почти не меняются между соседними: stillimage и редкие ключевые кадры
+        cmd += ['-tune', 'stillimage', '-g', str(fps * 4), '-t', f"{duration:.3f}", '-movflags', '+faststart',
+                '-y', output_video, *cover_args]
+
+        logging.debug(f"Команда: {' '.join(cmd)}")
+        result = run_ffmpeg(cmd, outputs=[path for path in (output_video, cover) if path])
+        if result.returncode != 0:
+            logging.error(f"FFmpeg ошибка: {result.stderr}")
+            return False
+        return True
+
+    except Exception as e:
+        logging.error(f"Ошибка: {e}")
+        return False
+    finally:
+        storage.remove(overlay_path)
+
+
+def process_slideshow(photos, output_path, text, music=None, cover=None):
+    """Ролик из фото (music - имя трека из music_library); с заставками - в их профиль и склейка"""
+    main_file = None
+    try:
+        logging.info(f"Собираю ролик из фото: {len(photos)}")
+        music = music_asset(music)
+        profile = output_profile(*slideshow_size(), SLIDESHOW_FPS) if bumpers_enabled() else None
+        if profile:
+            main_file = output_path.replace('.mp4', '_main.mp4')
+
+        if not build_slideshow(photos, main_file or output_path, text, profile=profile, music=music, cover=cover):
+            logging.error("Ошибка сборки ролика из фото")
+            return False
+
+        if profile and not attach_bumpers(main_file, output_path, profile):
+            logging.error("Ошибка добавления заставок")
+            return False
+
+        logging.info("Ролик из фото готов")
+        return True
+
+    except Exception as e:
+        logging.error(f"Ошибка: {e}")
+        return False
+    finally:
+        if main_file:
+            storage.remove(main_file)
+
+
+# ============ РОЛИК ИЗ НЕСКОЛЬКИХ ВИДЕО ============
+REEL_MAX_CLIPS = 10  # Больше видео в альбоме Telegram не бывает
+# Поля probe_video, которые должны совпасть у всех клипов, чтобы склеить их без приведения
+REEL_MATCH_FIELDS = ("width", "height", "rotation", "fps", "video_codec", "pix_fmt", "audio_codec", "sample_rate", "channels")
+
+
+def clip_paths(input_path, count):
+    """Файлы клипов задачи: рядом с путем исходника, по одному на клип"""
+    stem = os.path.splitext(input_path)[0]
+    return [f"{stem}_{index}.mp4" for index in range(count)]
+
+
+def reel_clips_match(infos):
+    """
+    Клипы уже одинаковые (снятые одним телефоном подряд): их читает один concat demuxer
+    без приведения каждого к общему виду, а звук копируется как есть
+    """
+    first = infos[0]
+    if is_hdr(first) or first["audio_codec"] not in MP4_AUDIO_CODECS:
+        return False
+    return all(info["has_audio"] and all(info[field] == first[field] for field in REEL_MATCH_FIELDS) for info in infos)
+
+
+def reel_clip_filter(index, path, info, width, height, fps):
+    """Приведение клипа к кадру ролика: SDR, размер с полями, SAR, fps и стерео 48 кГц той же длины, что видео"""
+    source = source_video_filter(path)
+    video = (
+        f"[{index}:v]{source['filter'] + ',' if source['filter'] else ''}"
+        f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps},format=yuv420p[v{index}]"
+    )
+    audio_format = f"aformat=sample_fmts=fltp:sample_rates={PROFILE_AUDIO_RATE}:channel_layouts=stereo"
+    if info["has_audio"]:
+        audio = f"[{index}:a]aresample={PROFILE_AUDIO_RATE},{audio_format},apad,atrim=0:{info['duration']:.3f}[a{index}]"
+    else:
+        audio = f"{SILENT_AUDIO},{audio_format},atrim=0:{info['duration']:.3f}[a{index}]"
+    return f"{video};{audio}"
+
+
+def build_reel(clips, output_video, text, font_path="/usr/share/fonts/truetype/msttcorefonts/Arial.ttf",
+               profile=None, music=None, cover=None):
+    """
+    Ролик из нескольких клипов одним запуском FFmpeg: приведение клипов, concat, подложка
+    с подписью (как у движка pillow) и звук - один граф, одно кодирование.
+    Если клипы уже одинаковые, приведение пропускаем, а звук без музыки копируем.
+    profile - профиль заставок, music - трек (MusicLibrary.asset), cover - путь для JPEG-обложки.
+    """
+    infos = [probe_video(path) for path in clips]
+    if profile:
+        width, height, fps = profile["width"], profile["height"], profile["fps"]
+    else:
+        width, height = get_video_dimensions(clips[0])
+        width, height = width - width % 2, height - height % 2
+        fps = input_profile(clips[0])["fps"]
+    duration = sum(info["duration"] or 0 for info in infos)
+    matching = reel_clips_match(infos)
+    overlay_path = f"{os.path.splitext(output_video)[0]}_overlay.png"
+    list_path = f"{os.path.splitext(output_video)[0]}_concat.txt"
+    logging.info(f"Склеиваю клипы: {len(clips)}, {duration:.1f}с, {width}x{height}@{fps}" +
+                 (" (одинаковые - без приведения)" if matching else ""))
+
+    try:
+        placement = caption_placement(None, text, width, height, font_path)
+        with stage_timer("overlay_render"), profiled("overlay_render"):
+            create_rounded_text_image(
+                text=text,
+                output_path=overlay_path,
+                video_width=width,
+                video_height=height,
+                font_path=font_path,
+                bg_color=placement["box"],
+                text_color=placement["text"]
+            )
+        storage.track(overlay_path)
+
+        cmd = [FFMPEG_PATH]
+        graph = []
+        output_args = []
+        if matching:
+            write_concat_list(clips, list_path)
+            cmd += ['-f', 'concat', '-safe', '0', '-i', list_path]
+            overlay_input = 1
+            base, voice = "[0:v]", "[0:a]"
+        else:
+            for index, (path, info) in enumerate(zip(clips, infos)):
+                cmd += ['-i', path]
+                graph.append(reel_clip_filter(index, path, info, width, height, fps))
+                if is_hdr(info):
+                    output_args = ['-color_primaries', 'bt709', '-color_trc', 'bt709', '-colorspace', 'bt709']
+            overlay_input = len(clips)
+            graph.append("".join(f"[v{index}][a{index}]" for index in range(len(clips))) + f"concat=n={len(clips)}:v=1:a=1[cv][ca]")
+            base, voice = "[cv]", "[ca]"
+        cmd += ['-framerate', str(fps), '-i', overlay_path]
+
+        offset_bottom = int(height * placement["offset"])
+        graph.append(
+            f"[{overlay_input}:v]format=rgba[alpha];"
+            f"{base}[alpha]overlay=x=(W-w)/2:y=H-h-{offset_bottom},format=yuv420p[v]"
+        )
+        cover_graph, video_label, cover_args = cover_branch("[v]", cover, duration)
+        if cover_graph:
+            graph.append(cover_graph)
+
+        if music:
+            inputs, audio_graph, labels = music_mix(music, overlay_input + 1, True, duration, voice=voice)
+            cmd += inputs
+            graph.append(audio_graph)
+            audio_map, audio_args = labels[0], ['-c:a', 'aac', '-b:a', '160k']
+        elif matching:
+            audio_map, audio_args = '0:a', ['-c:a', 'copy']
+        else:
+            audio_map, audio_args = voice, ['-c:a', 'aac', '-b:a', '128k']
+
+        cmd += ['-filter_complex', ";".join(graph), '-map', video_label, '-map', audio_map]
+        if profile:
+            cmd += profile_encode_args(profile)
+        else:
+            cmd += ['-c:v', 'libx264', '-preset', 'ultrafast', *audio_args]
+        cmd += [*output_args, '-t', f"{duration:.3f}", '-movflags', '+faststart', '-y', output_video, *cover_args]
+
+        logging.debug(f"Команда: {' '.join(cmd)}")
+        result = run_ffmpeg(cmd, outputs=[path for path in (output_video, cover) if path])
+        if result.returncode != 0:
+            logging.error(f"FFmpeg ошибка: {result.stderr}")
+            return False
+        return True
+
+    except Exception as e:
+        logging.error(f"Ошибка: {e}")
+        return False
+    finally:
+        storage.remove(overlay_path)
+        if os.path.exists(list_path):
+            os.remove(list_path)
+
+
+def process_reel(clips, output_path, text, music=None, cover=None):
+    """Ролик из нескольких клипов (music - имя трека из music_library); с заставками - в их профиль и склейка"""
+    main_file = None
+    try:
+        logging.info(f"Собираю ролик из клипов: {len(clips)}")
+        music = music_asset(music)
+        profile = input_profile(clips[0]) if bumpers_enabled() else None
+        if profile:
+            main_file = output_path.replace('.mp4', '_main.mp4')
+
+        if not build_reel(clips, main_file or output_path, text, profile=profile, music=music, cover=cover):
+            logging.error("Ошибка сборки ролика из клипов")
+            return False
+
+        if profile and not attach_bumpers(main_file, output_path, profile):
+            logging.error("Ошибка добавления заставок")
+            return False
+
+        logging.info("Ролик из клипов готов")
+        return True
+
+    except Exception as e:
+        logging.error(f"Ошибка: {e}")
+        return False
+    finally:
+        if main_file:
+            storage.remove(main_file)
+
+
+# ============ ПРЕВЬЮ ============
+PREVIEW_ENABLED = os.getenv("PREVIEW_ENABLED", "1") == "1"  # Быстрое превью подписи, пока идет полное кодирование
+PREVIEW_SECONDS = 4  # Длина превью (сек)
+PREVIEW_WIDTH = 360  # Ширина превью (пикселей)
+PREVIEW_MIN_SOURCE = 10  # Ролик короче (сек) кодируется почти так же быстро, как превью, - превью не делаем
+PREVIEW_MAX_REJECTS = 3  # Сколько раз можно отклонить заголовок одного видео
+
+
+def render_preview(input_path, output_path, text, caption=None, analysis=None, trim=None):
+    """
+    Превью: первые PREVIEW_SECONDS кодируемого отрезка, уменьшенные до PREVIEW_WIDTH, с той же подписью,
+    что будет в результате. Сначала вырезаем и уменьшаем отрезок, потом кладем подпись тем же движком -
+    оба прохода идут по маленькому видео, поэтому превью готово за секунды при любом исходнике.
+    """
+    start = trim["start"] if trim else 0.0
+    available = trim["duration"] if trim else probe_video(input_path)["duration"] or PREVIEW_SECONDS
+    segment = {"start": start, "duration": min(PREVIEW_SECONDS, available)}
+    small_path = output_path.replace('.mp4', '_small.mp4')
+
+    source = source_video_filter(input_path)
+    video_filter = ",".join(part for part in (source["filter"], f"scale={PREVIEW_WIDTH}:-2") if part)
+    cmd = [
+        FFMPEG_PATH,
+        *source["input_args"],
+        *trim_input_args(segment),
+        '-i', input_path,
+        '-vf', video_filter,
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '30',
+        '-c:a', 'aac', '-b:a', '64k',
+        *source["output_args"],
+        '-y', small_path
+    ]
+    try:
+        result = run_ffmpeg(cmd, stage="preview")
+        if result.returncode != 0:
+            logging.error(f"FFmpeg ошибка превью: {result.stderr}")
+            return False
+        # Музыку в превью не кладем: превью - про подпись
+        return add_caption(small_path, output_path, text, caption=caption, analysis=analysis, stage="preview")
+    finally:
+        storage.remove(small_path)
+
+
+def preview_job_id(job):
+    """Подзадача супервизора для FFmpeg превью: ее можно остановить, не трогая полное кодирование"""
+    return f"{job.job_id}:preview"
+
+
+# ============ ЗАСТАВКИ (INTRO / OUTRO) ============
+BUMPER_INTRO = os.getenv("BUMPER_INTRO", "")  # Ролик в начале каждого видео ("" - без заставки)
+BUMPER_OUTRO = os.getenv("BUMPER_OUTRO", "")  # Ролик в конце
+BUMPER_CACHE_FOLDER = os.getenv("BUMPER_CACHE_FOLDER", "bumpers_cache")  # Заставки, закодированные под профили
+BUMPER_WARM_PROFILES = os.getenv("BUMPER_WARM_PROFILES", "1080x1920@30")  # Профили, которые готовим при запуске
+
+STANDARD_FPS = (24, 25, 30, 50, 60)
+PROFILE_AUDIO_RATE = 48000
+SILENT_AUDIO = f"anullsrc=r={PROFILE_AUDIO_RATE}:cl=stereo"  # Звук для роликов без звуковой дорожки
+
+_bumper_locks = {}
+_bumper_locks_guard = threading.Lock()
+
+
+def bumpers_enabled():
+    return bool(BUMPER_INTRO or BUMPER_OUTRO)
+
+
+def output_profile(width, height, fps):
+    """
+    Профиль кодирования: размер, fps и параметры потоков. У ролика и заставок
+    он должен совпадать - тогда concat demuxer склеит их без перекодирования.
+    """
+    fps = min(STANDARD_FPS, key=lambda item: abs(item - (fps or 30)))
+    return {"width": width - width % 2, "height": height - height % 2, "fps": fps}
+
+
+def input_profile(video_path):
+    """Профиль под исходник: его размер (с учетом поворота) и ближайший стандартный fps"""
+    width, height = get_video_dimensions(video_path)
+    try:
+        fps = probe_video(video_path)["fps"]
+    except Exception:
+        fps = 30
+    return output_profile(width, height, fps)
+
+
+def profile_key(profile):
+    return f"{profile['width']}x{profile['height']}@{profile['fps']}"
+
+
+def profile_encode_args(profile):
+    """Параметры потоков, общие для ролика и заставок: кодек, fps, таймбейс, звук"""
+    return [
+        '-r', str(profile["fps"]),
+        '-c:v', 'libx264',
+        '-preset', 'ultrafast',
+        '-pix_fmt', 'yuv420p',
+        '-video_track_timescale', '90000',
+        '-c:a', 'aac',
+        '-ar', str(PROFILE_AUDIO_RATE),
+        '-ac', '2',
+        '-b:a', '128k'
+    ]
+
+
+def bumper_for(source, profile):
+    """Заставка под профиль: кодируется один раз, дальше берется из кэша"""
+    stem = os.path.splitext(os.path.basename(source))[0]
+    # mtime в имени: замена файла заставки сама сбрасывает кэш
+    version = int(os.path.getmtime(source))
+    path = os.path.join(BUMPER_CACHE_FOLDER, f"{stem}_{version}_{profile_key(profile).replace('@', '_')}.mp4")
+
+    with _bumper_locks_guard:
+        lock = _bumper_locks.setdefault(path, threading.Lock())
+
+    # Пока одна задача кодирует заставку, остальные с тем же профилем ждут ее
+    with lock:
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(BUMPER_CACHE_FOLDER, exist_ok=True)
+        logging.info(f"Кодирую заставку {stem} под профиль {profile_key(profile)}")
+        width, height = profile["width"], profile["height"]
+        has_audio = probe_video(source)["has_audio"]
+
+        temp_path = path + ".part.mp4"
+        cmd = [FFMPEG_PATH, '-y', '-i', source]
+        if not has_audio:
+            cmd += ['-f', 'lavfi', '-i', SILENT_AUDIO]
+        cmd += [
+            '-vf', f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                   f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1",
+            '-map', '0:v:0',
+            '-map', '0:a:0' if has_audio else '1:a',
+            *profile_encode_args(profile),
+            '-shortest',
+            temp_path
+        ]
+        result = run_ffmpeg(cmd, stage="bumper")
+        if result.returncode != 0:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise RuntimeError(f"не удалось закодировать заставку {source}: {result.stderr[-500:]}")
+        os.replace(temp_path, path)
+        return path
+
+
+def write_concat_list(paths, list_path):
+    """Список файлов для concat demuxer"""
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for path in paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+
+def attach_bumpers(main_path, output_path, profile):
+    """Склейка заставок с роликом через concat demuxer, без перекодирования (-c copy)"""
+    parts = [bumper_for(BUMPER_INTRO, profile)] if BUMPER_INTRO else []
+    parts.append(main_path)
+    if BUMPER_OUTRO:
+        parts.append(bumper_for(BUMPER_OUTRO, profile))
+
+    list_path = f"{os.path.splitext(output_path)[0]}_concat.txt"
+    write_concat_list(parts, list_path)
+
+    try:
+        cmd = [
+            FFMPEG_PATH, '-y',
+            '-f', 'concat', '-safe', '0',
+            '-i', list_path,
+            '-c', 'copy',
+            '-movflags', '+faststart',
+            output_path
+        ]
+        result = run_ffmpeg(cmd, stage="concat")
+        if result.returncode != 0:
+            logging.error(f"FFmpeg ошибка склейки: {result.stderr}")
+            return False
+        return True
+    finally:
+        os.remove(list_path)
+
+
+def warm_bumpers():
+    """Готовим заставки под частые профили при запуске, чтобы первая задача их не ждала"""
+    if not bumpers_enabled():
+        return
+    for item in filter(None, BUMPER_WARM_PROFILES.split(",")):
+        try:
+            size, _, fps = item.strip().partition("@")
+            width, height = map(int, size.split("x"))
+            profile = output_profile(width, height, float(fps or 30))
+            for source in filter(None, (BUMPER_INTRO, BUMPER_OUTRO)):
+                bumper_for(source, profile)
+        except Exception as e:
+            logging.error(f"Не удалось подготовить заставки для {item}: {e}")
+
+
+# ============ ФОНОВАЯ МУЗЫКА ============
+MUSIC_FOLDER = os.getenv("MUSIC_FOLDER", "")  # Библиотека треков ("" - без музыки)
+MUSIC_CACHE_FOLDER = os.getenv("MUSIC_CACHE_FOLDER", "music_cache")  # Декодированные треки и замеры громкости
+MUSIC_LUFS = float(os.getenv("MUSIC_LUFS", "-20"))  # Громкость музыки (LUFS): тише голоса в роликах
+MUSIC_TRUE_PEAK = -1.5  # Потолок true peak музыки после усиления (dBTP)
+MUSIC_DUCK_THRESHOLD = 0.03  # Уровень голоса, с которого музыка приглушается (sidechaincompress)
+MUSIC_DUCK_RATIO = 8  # Насколько сильно приглушается
+MUSIC_FADE_OUT = 1.0  # Затухание музыки в конце ролика (сек)
+MUSIC_EXTENSIONS = (".mp3", ".m4a", ".aac", ".wav", ".flac", ".ogg", ".opus")
+
+LOUDNORM_JSON_RE = re.compile(r"\{[^{}]*\"input_i\"[^{}]*\}")
+
+
+class MusicLibrary:
+    """
+    Треки для фоновой музыки. Каждый трек один раз декодируется в WAV 48 кГц стерео
+    и меряется loudnorm; замеры лежат рядом в JSON. При сведении громкость выставляется
+    по замерам в том же проходе, что и подпись, без повторного анализа.
+    """
+
+    def __init__(self, folder, cache_folder):
+        self.folder = folder
+        self.cache_folder = cache_folder
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def enabled(self):
+        return bool(self.folder) and os.path.isdir(self.folder)
+
+    def tracks(self):
+        if not self.enabled():
+            return []
+        return sorted(name for name in os.listdir(self.folder) if name.lower().endswith(MUSIC_EXTENSIONS))
+
+    def pick(self, setting):
+        """Трек для задачи по настройке пользователя ("random" или имя трека); None - без музыки"""
+        tracks = self.tracks()
+        if not setting or not tracks:
+            return None
+        if setting == "random":
+            return random.choice(tracks)
+        return setting if setting in tracks else None
+
+    def asset(self, name):
+        """Готовый к сведению трек: {"name", "path", "gain_db", ...}. Готовится при первом обращении"""
+        source = os.path.join(self.folder, name)
+        # mtime в имени: замена трека сама сбрасывает кэш
+        version = int(os.path.getmtime(source))
+        base = os.path.join(self.cache_folder, f"{os.path.splitext(name)[0]}_{version}")
+
+        with self._guard:
+            lock = self._locks.setdefault(base, threading.Lock())
+
+        with lock:
+            if os.path.exists(base + ".json") and os.path.exists(base + ".wav"):
+                with open(base + ".json", 'r', encoding='utf-8') as f:
+                    return json.load(f)
+
+            os.makedirs(self.cache_folder, exist_ok=True)
+            logging.info(f"Готовлю трек {name}: декодирование и замер громкости")
+            temp_path = base + ".part.wav"
+            # Один проход: декодированный трек в WAV и замер громкости (первый проход loudnorm)
+            cmd = [
+                FFMPEG_PATH, '-y', '-i', source,
+                '-filter_complex',
+                f"[0:a]aresample={PROFILE_AUDIO_RATE},aformat=sample_fmts=s16:channel_layouts=stereo,asplit[pcm][measure];"
+                f"[measure]loudnorm=I={MUSIC_LUFS}:TP={MUSIC_TRUE_PEAK}:print_format=json[measured]",
+                '-map', '[pcm]', temp_path,
+                '-map', '[measured]', '-f', 'null', '-'
+            ]
+            result = run_ffmpeg(cmd, stage="music", outputs=[temp_path])
+            match = LOUDNORM_JSON_RE.search(result.stderr or "")
+            if result.returncode != 0 or not match:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise RuntimeError(f"не удалось подготовить трек {name}: {result.stderr[-500:]}")
+
+            stats = json.loads(match.group(0))
+            measured_i = float(stats["input_i"])
+            measured_tp = float(stats["input_tp"])
+            # Линейное усиление до цели, но без выхода за потолок true peak - как loudnorm linear=true
+            # с этими замерами, только без его передискретизации в 192 кГц на каждом ролике
+            gain = min(MUSIC_LUFS - measured_i, MUSIC_TRUE_PEAK - measured_tp) if measured_i > -70 else 0.0
+
+            os.replace(temp_path, base + ".wav")
+            asset = {
+                "name": name,
+                "path": base + ".wav",
+                "gain_db": round(gain, 2),
+                "input_i": measured_i,
+                "input_tp": measured_tp,
+                "input_lra": float(stats["input_lra"])
+            }
+            with open(base + ".json", 'w', encoding='utf-8') as f:
+                json.dump(asset, f, ensure_ascii=False)
+            return asset
+
+    def warm(self):
+        """Готовим все треки при запуске, чтобы первая задача их не ждала"""
+        for name in self.tracks():
+            try:
+                self.asset(name)
+            except Exception as e:
+                logging.error(f"Не удалось подготовить трек {name}: {e}")
+
+
+music_library = MusicLibrary(MUSIC_FOLDER, MUSIC_CACHE_FOLDER)
+
+
+def music_asset(name):
+    """Подготовленный трек для задачи; если трек не готовится - видео выходит без музыки"""
+    if not name:
+        return None
+    try:
+        return music_library.asset(name)
+    except Exception as e:
+        logging.error(f"Музыка отключена для этой задачи ({name}): {e}")
+        return None
+
+
+def music_mix(music, music_input, has_audio, duration, outputs=1, voice="[0:a]"):
+    """
+    Ветка filter_complex для фоновой музыки: зацикленный трек из кэша с усилением по замерам,
+    приглушенный под голосом (sidechaincompress по звуку ролика) и сведенный с ним.
+    voice - звук ролика (вход или метка графа). Возвращает (входы FFmpeg, граф, метки звука для каждого выхода).
+    """
+    inputs = ['-stream_loop', '-1', '-i', music["path"]]
+    graph = f"[{music_input}:a]volume={music['gain_db']}dB"
+    if duration:
+        fade_start = max(0.0, duration - MUSIC_FADE_OUT)
+        graph += f",atrim=0:{duration:.3f},afade=t=out:st={fade_start:.3f}:d={MUSIC_FADE_OUT}"
+
+    if has_audio:
+        graph += (
+            f"[music];{voice}aresample={PROFILE_AUDIO_RATE},aformat=channel_layouts=stereo,asplit=2[voice][key];"
+            f"[music][key]sidechaincompress=threshold={MUSIC_DUCK_THRESHOLD}:ratio={MUSIC_DUCK_RATIO}"
+            f":attack=20:release=400[ducked];"
+            f"[voice][ducked]amix=inputs=2:duration=first:normalize=0"
+        )
+
+    labels = [f"[mix{i}]" for i in range(outputs)]
+    graph += f",asplit={outputs}{''.join(labels)}" if outputs > 1 else labels[0]
+    return inputs, graph, labels
+
+
+# ============ ХРАНИЛИЩЕ ============
+DISK_QUOTA_MB = int(os.getenv("DISK_QUOTA_MB", "5120"))  # Лимит на VIDEOS_FOLDER + OUTPUT_FOLDER (0 - без лимита)
+STALE_FILE_AGE = int(os.getenv("STALE_FILE_AGE", "3600"))  # Файл без живой задачи старше этого (сек) - мусор
+JANITOR_INTERVAL = 300  # Как часто уборщик проверяет файлы (сек)
+SCRATCH_FOLDER = os.getenv("SCRATCH_FOLDER", "")  # RAM-папка для небольших роликов, например /dev/shm/videos
+SCRATCH_MAX_FILE_MB = int(os.getenv("SCRATCH_MAX_FILE_MB", "50"))  # Ролики больше этого идут на диск
+SCRATCH_QUOTA_MB = int(os.getenv("SCRATCH_QUOTA_MB", "512"))
+
+# Исходник + временный MP4 + результат: сколько места нужно задаче относительно входного файла
+JOB_DISK_FACTOR = 3
+
+
+class StorageManager:
+    """
+    Учет места в рабочих папках: размеры файлов обновляются при создании и удалении,
+    полный обход диска делается один раз при запуске.
+    """
+
+    def __init__(self, folders, quota_mb, scratch_folder="", scratch_quota_mb=0):
+        self.folders = list(dict.fromkeys(os.path.abspath(folder) for folder in folders))
+        self.scratch_folder = os.path.abspath(scratch_folder) if scratch_folder else ""
+        self.quota = quota_mb * 1024 * 1024
+        self.scratch_quota = scratch_quota_mb * 1024 * 1024
+        self.usage = {folder: 0 for folder in self.all_folders()}
+        self.files = {}  # path -> (folder, size, mtime)
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+    def all_folders(self):
+        return self.folders + ([self.scratch_folder] if self.scratch_folder else [])
+
+    def _folder_of(self, path):
+        for folder in self.all_folders():
+            if path.startswith(folder + os.sep):
+                return folder
+        return None
+
+    def scan(self):
+        """Полный обход папок - только при запуске"""
+        with self._lock:
+            self.files.clear()
+            self.usage = {folder: 0 for folder in self.all_folders()}
+        for folder in self.all_folders():
+            os.makedirs(folder, exist_ok=True)
+            for root, dirs, files in os.walk(folder):
+                for name in files:
+                    self.track(os.path.join(root, name))
+
+    def track(self, path):
+        """Учесть созданный или измененный файл"""
+        path = os.path.abspath(path)
+        folder = self._folder_of(path)
+        if folder is None:
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+
+        with self._lock:
+            old = self.files.get(path)
+            if old:
+                self.usage[old[0]] -= old[1]
+            self.files[path] = (folder, stat.st_size, stat.st_mtime)
+            self.usage[folder] += stat.st_size
+
+    def remove(self, path):
+        """Удалить файл и снять его с учета; True - если файл был"""
+        path = os.path.abspath(path)
+        try:
+            os.remove(path)
+            existed = True
+        except FileNotFoundError:
+            existed = False
+        except OSError as e:
+            logging.error(f"Не удалось удалить {path}: {e}")
+            return False
+
+        with self._lock:
+            item = self.files.pop(path, None)
+            if item:
+                self.usage[item[0]] -= item[1]
+        return existed
+
+    def tracked_files(self):
+        with self._lock:
+            return list(self.files)
+
+    def disk_usage(self):
+        return sum(self.usage[folder] for folder in self.folders)
+
+    def evict_stale(self, max_age, protected=()):
+        """Удаляет старые файлы, не принадлежащие живым задачам. Возвращает освобожденные байты"""
+        now = time.time()
+        with self._lock:
+            candidates = sorted(self.files.items(), key=lambda item: item[1][2])
+
+        freed = 0
+        for path, (folder, size, mtime) in candidates:
+            if now - mtime < max_age:
+                break
+            if any(path.startswith(prefix) for prefix in protected):
+                continue
+            if self.remove(path):
+                freed += size
+                self.evicted += 1
+                logging.info(f"Уборщик удалил {path} ({size / (1024 * 1024):.1f} MB)")
+        return freed
+
+    def admit(self, file_size):
+        """Хватит ли места на новую задачу; при нехватке сначала чистим мусор"""
+        if not self.quota:
+            return True
+        needed = file_size * JOB_DISK_FACTOR
+        if self.disk_usage() + needed <= self.quota:
+            return True
+
+        self.evict_stale(STALE_FILE_AGE, journal.protected_prefixes())
+        return self.disk_usage() + needed <= self.quota
+
+    def workdirs(self, file_size):
+        """Папки (вход, выход) для задачи: небольшие ролики - в RAM, если она есть и не занята"""
+        if self.scratch_folder and 0 < file_size <= SCRATCH_MAX_FILE_MB * 1024 * 1024:
+            needed = file_size * JOB_DISK_FACTOR
+            try:
+                os.makedirs(self.scratch_folder, exist_ok=True)
+                free = shutil.disk_usage(self.scratch_folder).free
+            except OSError:
+                free = 0
+            if self.usage[self.scratch_folder] + needed <= self.scratch_quota and needed < free:
+                return self.scratch_folder, self.scratch_folder
+        return VIDEOS_FOLDER, OUTPUT_FOLDER
+
+
+storage = StorageManager([VIDEOS_FOLDER, OUTPUT_FOLDER], DISK_QUOTA_MB, SCRATCH_FOLDER, SCRATCH_QUOTA_MB)
+
+
+async def run_storage_janitor():
+    """Фоновая уборка: удаляем то, что не убрали обработчики (падения, временные файлы)"""
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL)
+        try:
+            freed = await asyncio.to_thread(storage.evict_stale, STALE_FILE_AGE, journal.protected_prefixes())
+            if freed:
+                logging.info(f"Уборщик освободил {freed / (1024 * 1024):.1f} MB")
+        except Exception as e:
+            logging.error(f"Ошибка уборщика: {e}")
+
+
+# ============ ЖУРНАЛ ЗАДАЧ ============
+JOBS_JOURNAL_FILE = os.getenv("JOBS_JOURNAL_FILE", "jobs_journal.jsonl")  # Файл журнала задач
+SHUTDOWN_DRAIN_TIMEOUT = int(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "60"))  # Сколько ждем текущие задачи при остановке
+JOB_MAX_ATTEMPTS = 3  # Сколько раз пробуем задачу после перезапусков
+
+# Состояния, после которых задача больше не возобновляется
+JOB_FINAL_STATES = ("done", "failed", "cancelled")
+
+
+class JobJournal:
+    """
+    Журнал переходов состояний задач (JSON Lines, запись с fsync).
+    В памяти держим только незавершенные задачи; состояние в памяти обновляется сразу,
+    а на диск строки пишет отдельный поток - event loop не ждет fsync.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writer = None
+
+    def load(self):
+        """Читает журнал, сжимает его до незавершенных задач и возвращает их"""
+        self.close()  # Файл будет заменен сжатой копией
+        jobs = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Недописанная строка после падения
+                    jobs.setdefault(record["job_id"], {}).update(record)
+
+        self.jobs = {job_id: job for job_id, job in jobs.items() if job.get("state") not in JOB_FINAL_STATES}
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for job in self.jobs.values():
+                f.write(json.dumps(job, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.path)
+
+        return list(self.jobs.values())
+
+    def record(self, job_id, state, **fields):
+        record = {"job_id": job_id, "state": state, "ts": time.time(), **fields}
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="journal-writer", daemon=True)
+                self._writer.start()
+            # Под той же блокировкой, что и память: порядок строк в файле совпадает с порядком переходов
+            self._queue.put(json.dumps(record, ensure_ascii=False) + "\n")
+
+            if state in JOB_FINAL_STATES:
+                self.jobs.pop(job_id, None)
+            else:
+                self.jobs.setdefault(job_id, {}).update(record)
+
+    def _write_loop(self):
+        """Поток записи: все накопившиеся строки - одной записью и одним fsync"""
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                lines = [self._queue.get()]
+                while True:
+                    try:
+                        lines.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    f.write("".join(line for line in lines if line))
+                    f.flush()
+                    os.fsync(f.fileno())
+                except OSError as e:
+                    logging.error(f"Не удалось записать журнал задач: {e}")
+                if None in lines:
+                    return  # close(): все, что было до него, уже на диске
+
+    def state(self, job_id):
+        """Текущее состояние незавершенной задачи (None - задачи нет или она завершена)"""
+        job = self.jobs.get(job_id)
+        return job["state"] if job else None
+
+    def close_job(self, job_id):
+        """Задача закончилась без явного итога - считаем ее неудачной"""
+        if self.state(job_id) not in (None, "interrupted"):
+            self.record(job_id, "failed")
+
+    def referenced_paths(self):
+        """Исходники незавершенных задач - их не трогаем при уборке"""
+        paths = set()
+        for job in self.jobs.values():
+            if job.get("photos") and job.get("input_path"):
+                paths.update(photo_paths(job["input_path"], len(job["photos"])))
+            elif job.get("clips") and job.get("input_path"):
+                paths.update(clip_paths(job["input_path"], len(job["clips"])))
+            elif job.get("input_path"):
+                paths.add(job["input_path"])
+        return paths
+
+    def protected_prefixes(self):
+        """Файлы живых задач: исходник, результат и их временные спутники (_temp, _overlay)"""
+        prefixes = []
+        for job in list(self.jobs.values()):
+            for key in ("input_path", "output_path"):
+                if job.get(key):
+                    prefixes.append(os.path.splitext(os.path.abspath(job[key]))[0])
+        return prefixes
+
+    def close(self):
+        """Дописывает очередь на диск и останавливает поток записи"""
+        with self._lock:
+            writer, self._writer = self._writer, None
+            if writer:
+                self._queue.put(None)
+        if writer:
+            writer.join()
+
+
+journal = JobJournal(JOBS_JOURNAL_FILE)
+atexit.register(journal.close)
+
+
+def collect_orphaned_files(keep):
+    """Удаляет файлы, оставшиеся от упавших запусков (кроме нужных для возобновления)"""
+    keep = {os.path.abspath(path) for path in keep}
+    removed = 0
+    for path in storage.tracked_files():
+        if path not in keep and storage.remove(path):
+            removed += 1
+    return removed
+
+
+async def drain_jobs(timeout):
+    """Ждем текущие задачи; что не успело - отменяем с пометкой для возобновления"""
+    deadline = time.monotonic() + timeout
+    while supervisor.active_jobs() and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+
+    remaining = supervisor.active_jobs()
+    if not remaining:
+        return 0
+
+    logging.warning(f"Не дождались задач: {len(remaining)}, сохраняю их для возобновления")
+    for job_id in remaining:
+        supervisor.cancel_job(job_id, "shutdown")
+    await notify_pools()
+
+    # Даем обработчикам записать чекпоинт
+    grace_deadline = time.monotonic() + 10
+    while supervisor.active_jobs() and time.monotonic() < grace_deadline:
+        await asyncio.sleep(0.2)
+    return len(remaining)
+
+
+def video_caption(title, used_theme, trim=None):
+    # Что обрезали перед кодированием - пишем под темой
+    note = f"\n{trim_note(trim)}" if trim else ""
+    # Проверяем длину заголовка для Telegram caption
+    if title and len(title) > 1024:  # Ограничение Telegram для caption
+        return f"🎬 {title[:1021]}...\n\n📌 Тема: {used_theme}{note}"
+    return f"🎬 {title}\n\n📌 Тема: {used_theme}{note}"
+
+
+async def send_job_result(chat_id, output_path, output_filename, title, desc, used_theme, trim=None):
+    """Отправка готового видео с подписью и описанием"""
+    # Отправляем видео с заголовком как подпись
+    video_file = FSInputFile(output_path, filename=output_filename)
+    with stage_timer("upload", bytes_out=os.path.getsize(output_path)):
+        await bot.send_video(
+            chat_id,
+            video_file,
+            caption=video_caption(title, used_theme, trim),
+            **video_upload_args(output_path)
+        )
+
+    await send_job_description(chat_id, title, desc, used_theme)
+
+
+async def send_job_renditions(chat_id, paths, renditions, title, desc, used_theme, trim=None):
+    """Версии одного ролика в разных форматах - одной медиагруппой, подпись на первом"""
+    caption = video_caption(title, used_theme, trim) + f"\n📐 Форматы: {', '.join(renditions)}"
+    media = [
+        InputMediaVideo(media=FSInputFile(path, filename=os.path.basename(path)), caption=caption if i == 0 else None,
+                        **video_upload_args(path))
+        for i, path in enumerate(paths)
+    ]
+    with stage_timer("upload", bytes_out=sum(os.path.getsize(path) for path in paths), renditions=len(paths)):
+        await bot.send_media_group(chat_id, media)
+
+    await send_job_description(chat_id, title, desc, used_theme)
+
+
+async def send_job_description(chat_id, title, desc, used_theme):
+    # Отправляем описание отдельным сообщением
+    if desc and desc != "Описание не сгенерировано":
+        # Форматируем описание для лучшей читаемости
+        description_text = f"""
+📝 ОПИСАНИЕ ДЛЯ INSTAGRAM:
+```Копировать
+{desc}
+```
+✨ Текст на видео: "{title}"
+🎯 Тема: {used_theme}
+        """
+
+        # Разбиваем на части если слишком длинное (ограничение Telegram)
+        if len(description_text) > 4096:
+            parts = [description_text[i:i + 4000] for i in range(0, len(description_text), 4000)]
+            for part in parts:
+                await bot.send_message(chat_id, part)
+        else:
+            await bot.send_message(chat_id, description_text, parse_mode='Markdown')
+
+
+# ============ ИСТОРИЯ ЗАДАЧ ============
+JOB_HISTORY_DB = os.getenv("JOB_HISTORY_DB", "job_history.sqlite3")  # История задач и агрегаты для /history ("" - не вести)
+HISTORY_PERIODS = {"hour": 3600, "day": 86400}  # Агрегаты: почасовые и посуточные (UTC)
+HISTORY_LATENCY_BOUNDS = (5, 10, 15, 20, 30, 45, 60, 90, 120, 150, 180, 240, 300, 450, 600, 900, 1200, float("inf"))  # Бакеты длительности задачи (сек)
+HISTORY_ERROR_LENGTH = 80  # Причины ошибок группируем по началу текста
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT, user_id INTEGER, started_at REAL, finished_at REAL, outcome TEXT, duration REAL,
+    bytes_in INTEGER, bytes_out INTEGER, profile TEXT, stages TEXT, error TEXT
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    period TEXT, bucket INTEGER, jobs INTEGER DEFAULT 0, done INTEGER DEFAULT 0, failed INTEGER DEFAULT 0,
+    cancelled INTEGER DEFAULT 0, seconds REAL DEFAULT 0, bytes_in INTEGER DEFAULT 0, bytes_out INTEGER DEFAULT 0,
+    PRIMARY KEY (period, bucket)
+);
+CREATE TABLE IF NOT EXISTS latency_rollups (
+    period TEXT, bucket INTEGER, le INTEGER, count INTEGER DEFAULT 0, PRIMARY KEY (period, bucket, le)
+);
+CREATE TABLE IF NOT EXISTS stage_rollups (
+    period TEXT, bucket INTEGER, stage TEXT, count INTEGER DEFAULT 0, seconds REAL DEFAULT 0,
+    PRIMARY KEY (period, bucket, stage)
+);
+CREATE TABLE IF NOT EXISTS user_rollups (
+    period TEXT, bucket INTEGER, user_id INTEGER, jobs INTEGER DEFAULT 0, failed INTEGER DEFAULT 0,
+    PRIMARY KEY (period, bucket, user_id)
+);
+CREATE TABLE IF NOT EXISTS failure_rollups (
+    period TEXT, bucket INTEGER, error TEXT, count INTEGER DEFAULT 0, PRIMARY KEY (period, bucket, error)
+);
+"""
+
+
+class JobHistory:
+    """
+    История задач в SQLite. Сырые записи только дописываются; почасовые и посуточные агрегаты
+    (счетчики, гистограмма длительности, этапы, пользователи, причины ошибок) обновляются
+    в той же транзакции. Отчеты читают только агрегаты - их цена не растет с числом задач.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            # WAL без fsync на каждую транзакцию: запись укладывается в миллисекунды и не тормозит event loop
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(HISTORY_SCHEMA)
+        return self._db
+
+    def record(self, job_id, user_id, started_at, outcome, duration, bytes_in=0, bytes_out=0, profile=None,
+               stages=None, error=None):
+        """Итог задачи: строка истории и все агрегаты - одной транзакцией"""
+        if not self.path:
+            return
+        finished_at = time.time()
+        stages = stages or {}
+        failed = int(outcome in ("failed", "rejected"))
+        cancelled = int(outcome == "cancelled")
+        done = int(outcome == "done")
+        reason = re.sub(r"\d+", "N", error)[:HISTORY_ERROR_LENGTH] if error and failed else None
+        # Длительность в гистограмме - только у успешных задач: это время, которое ждет пользователь
+        le = next(i for i, bound in enumerate(HISTORY_LATENCY_BOUNDS) if duration <= bound) if done else None
+
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute(
+                    "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, user_id, started_at, finished_at, outcome, duration, bytes_in, bytes_out,
+                     json.dumps(profile or {}, ensure_ascii=False), json.dumps(stages), error)
+                )
+                for period, size in HISTORY_PERIODS.items():
+                    bucket = int(finished_at // size * size)
+                    db.execute(
+                        "INSERT INTO rollups VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?) ON CONFLICT (period, bucket) DO UPDATE SET "
+                        "jobs = jobs + 1, done = done + excluded.done, failed = failed + excluded.failed, "
+                        "cancelled = cancelled + excluded.cancelled, seconds = seconds + excluded.seconds, "
+                        "bytes_in = bytes_in + excluded.bytes_in, bytes_out = bytes_out + excluded.bytes_out",
+                        (period, bucket, done, failed, cancelled, duration, bytes_in, bytes_out)
+                    )
+                    db.execute(
+                        "INSERT INTO user_rollups VALUES (?, ?, ?, 1, ?) ON CONFLICT (period, bucket, user_id) DO UPDATE SET "
+                        "jobs = jobs + 1, failed = failed + excluded.failed",
+                        (period, bucket, user_id, failed)
+                    )
+                    if le is not None:
+                        db.execute(
+                            "INSERT INTO latency_rollups VALUES (?, ?, ?, 1) ON CONFLICT (period, bucket, le) DO UPDATE SET "
+                            "count = count + 1",
+                            (period, bucket, le)
+                        )
+                    for stage, seconds in stages.items():
+                        db.execute(
+                            "INSERT INTO stage_rollups VALUES (?, ?, ?, 1, ?) ON CONFLICT (period, bucket, stage) DO UPDATE SET "
+                            "count = count + 1, seconds = seconds + excluded.seconds",
+                            (period, bucket, stage, seconds)
+                        )
+                    if reason:
+                        db.execute(
+                            "INSERT INTO failure_rollups VALUES (?, ?, ?, 1) ON CONFLICT (period, bucket, error) DO UPDATE SET "
+                            "count = count + 1",
+                            (period, bucket, reason)
+                        )
+
+    def summary(self, hours=24):
+        """
+        Сводка за последние hours часов (до 72 - по часовым бакетам, дальше - по суточным):
+        задачи, доля ошибок, пропускная способность, p50/p95, этапы, причины ошибок, активные пользователи
+        """
+        period = "hour" if hours <= 72 else "day"
+        size = HISTORY_PERIODS[period]
+        since = int((time.time() - hours * 3600) // size * size)
+        args = (period, since)
+
+        with self._lock:
+            db = self._connect()
+            totals = db.execute(
+                "SELECT COALESCE(SUM(jobs), 0), COALESCE(SUM(done), 0), COALESCE(SUM(failed), 0), COALESCE(SUM(cancelled), 0), "
+                "COALESCE(SUM(bytes_in), 0), COALESCE(SUM(bytes_out), 0) FROM rollups WHERE period = ? AND bucket >= ?", args
+            ).fetchone()
+            latency = dict(db.execute(
+                "SELECT le, SUM(count) FROM latency_rollups WHERE period = ? AND bucket >= ? GROUP BY le", args
+            ).fetchall())
+            stages = db.execute(
+                "SELECT stage, SUM(count), SUM(seconds) FROM stage_rollups WHERE period = ? AND bucket >= ? "
+                "GROUP BY stage ORDER BY SUM(seconds) DESC", args
+            ).fetchall()
+            users = db.execute(
+                "SELECT user_id, SUM(jobs), SUM(failed) FROM user_rollups WHERE period = ? AND bucket >= ? "
+                "GROUP BY user_id ORDER BY SUM(jobs) DESC LIMIT 5", args
+            ).fetchall()
+            failures = db.execute(
+                "SELECT error, SUM(count) FROM failure_rollups WHERE period = ? AND bucket >= ? "
+                "GROUP BY error ORDER BY SUM(count) DESC LIMIT 5", args
+            ).fetchall()
+            hourly = db.execute(
+                "SELECT bucket, done FROM rollups WHERE period = 'hour' AND bucket >= ? ORDER BY bucket",
+                (int(time.time() // 3600 * 3600) - 11 * 3600,)
+            ).fetchall()
+
+        jobs, done, failed, cancelled, bytes_in, bytes_out = totals
+        cumulative = []
+        running = 0
+        for i, bound in enumerate(HISTORY_LATENCY_BOUNDS):
+            running += latency.get(i, 0)
+            cumulative.append((bound, running))
+        return {
+            "hours": hours,
+            "jobs": jobs,
+            "done": done,
+            "failed": failed,
+            "cancelled": cancelled,
+            "failure_rate": failed / jobs if jobs else 0.0,
+            "per_hour": done / hours,
+            "p50": _histogram_quantile(cumulative, 0.5),
+            "p95": _histogram_quantile(cumulative, 0.95),
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "stages": [{"stage": stage, "count": count, "avg": seconds / count} for stage, count, seconds in stages],
+            "users": [{"user_id": user_id, "jobs": count, "failed": user_failed} for user_id, count, user_failed in users],
+            "failures": failures,
+            "hourly": hourly
+        }
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+
+job_history = JobHistory(JOB_HISTORY_DB)
+
+
+def job_stage_times(trace):
+    """Суммарное время по этапам из спанов трейса: {stage: сек}"""
+    stages = {}
+    for span in trace.spans:
+        stages[span["name"]] = round(stages.get(span["name"], 0.0) + span["end"] - span["start"], 3)
+    return stages
+
+
+# ============ СКАЧИВАНИЕ ФАЙЛОВ ============
+DOWNLOAD_PARTS = int(os.getenv("DOWNLOAD_PARTS", "4"))  # Одновременные Range-запросы на один файл (1 - одним потоком)
+DOWNLOAD_MIN_PART_MB = float(os.getenv("DOWNLOAD_MIN_PART_MB", "4"))  # Кусок не мельче этого: маленький файл качаем одним запросом
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "5"))  # Повторы куска подряд без прогресса
+DOWNLOAD_READ_TIMEOUT = 60  # Сколько ждем следующую порцию данных (сек)
+DOWNLOAD_CHUNK = 256 * 1024  # Порция чтения из сокета и записи на диск
+DOWNLOAD_SAVE_EVERY = 4 * 1024 * 1024  # Как часто кусок сохраняет прогресс (байт)
+
+DOWNLOAD_RETRIES_TOTAL = Counter("bot_download_retries_total", "Повторные запросы куска после обрыва скачивания")
+
+
+class DownloadError(Exception):
+    """Ошибка, которую повтор не исправит (4xx, неверный размер)"""
+
+
+class RangeNotSupported(DownloadError):
+    """Сервер отдает файл целиком в ответ на Range"""
+
+
+def partial_paths(path):
+    """Недокачанный файл и прогресс его кусков"""
+    return path + ".part", path + ".part.json"
+
+
+class RangedDownloader:
+    """
+    Скачивание файла несколькими Range-запросами в заранее выделенный файл: каждый кусок
+    пишет по своему смещению (pwrite). Прогресс кусков лежит рядом в .part.json,
+    поэтому после обрыва или перезапуска бота докачиваем только недостающее.
+    """
+
+    def __init__(self, parts=DOWNLOAD_PARTS, min_part_mb=DOWNLOAD_MIN_PART_MB, retries=DOWNLOAD_RETRIES):
+        self.parts = max(1, parts)
+        self.min_part = max(DOWNLOAD_CHUNK, int(min_part_mb * 1024 * 1024))
+        self.retries = retries
+        self._session = None
+
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=DOWNLOAD_READ_TIMEOUT)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    def plan(self, size, parts=None):
+        """Куски [начало, докачано до, конец) примерно равной длины"""
+        count = max(1, min(parts or self.parts, size // self.min_part))
+        step = -(-size // count) or 1
+        return [[start, start, min(start + step, size)] for start in range(0, size, step)] or [[0, 0, 0]]
+
+    def load_state(self, path, size):
+        """Прогресс прошлой попытки, если он относится к тому же файлу"""
+        part_path, state_path = partial_paths(path)
+        try:
+            with open(state_path, encoding="utf-8") as f:
+                state = json.load(f)
+            if (size is None or state["size"] == size) and os.path.getsize(part_path) == state["size"]:
+                return state
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        for stale in (part_path, state_path):
+            storage.remove(stale)
+        return None
+
+    def save_state(self, path, data):
+        state_path = partial_paths(path)[1]
+        with open(state_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(state_path + ".tmp", state_path)
+
+    @staticmethod
+    def open_part(part_path, size):
+        """
+        Открыть .part и сразу выделить место под весь файл:
+        нехватка диска всплывет до скачивания, а не посреди него
+        """
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+                if hasattr(os, "posix_fallocate") and size:
+                    try:
+                        os.posix_fallocate(fd, 0, size)
+                    except OSError as e:
+                        if e.errno == errno.ENOSPC:
+                            raise DownloadError("Недостаточно места на диске")
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    async def probe_size(self, url):
+        """Размер файла, если get_file его не вернул: один байт через Range"""
+        async with self.session().get(url, headers={"Range": "bytes=0-0"}) as resp:
+            if resp.status == 206 and "/" in resp.headers.get("Content-Range", ""):
+                total = resp.headers["Content-Range"].rsplit("/", 1)[1]
+                if total.isdigit():
+                    return int(total)
+            if resp.status == 200 and resp.content_length is not None:
+                return resp.content_length
+            if 400 <= resp.status < 500:
+                raise DownloadError(f"HTTP {resp.status}")
+        raise DownloadError("Сервер не сообщил размер файла")
+
+    async def fetch_part(self, url, fd, part, whole, save):
+        """Докачать один кусок; обрыв - повтор с места остановки"""
+        failures = 0
+        unsaved = 0
+        while part[1] < part[2]:
+            progressed = part[1]
+            try:
+                async with self.session().get(url, headers={"Range": f"bytes={part[1]}-{part[2] - 1}"}) as resp:
+                    if resp.status == 200:
+                        if not whole:
+                            raise RangeNotSupported("Сервер не поддерживает Range")
+                        part[1] = part[0]  # Пришел весь файл - пишем с начала
+                    elif 400 <= resp.status < 500:
+                        raise DownloadError(f"HTTP {resp.status}")
+                    elif resp.status != 206:
+                        raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK):
+                        chunk = chunk[:part[2] - part[1]]
+                        await asyncio.to_thread(os.pwrite, fd, chunk, part[1])
+                        part[1] += len(chunk)
+                        unsaved += len(chunk)
+                        if unsaved >= DOWNLOAD_SAVE_EVERY:
+                            await save()
+                            unsaved = 0
+                        if part[1] >= part[2]:
+                            break
+                if part[1] < part[2]:
+                    raise aiohttp.ClientPayloadError("Соединение закрылось раньше конца куска")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                failures = 0 if part[1] > progressed else failures + 1
+                if failures > self.retries:
+                    raise
+                DOWNLOAD_RETRIES_TOTAL.inc()
+                logging.warning(f"Обрыв скачивания на {part[1]}/{part[2]} байт: {e or type(e).__name__}; докачиваю")
+                await save()
+                unsaved = 0
+                await asyncio.sleep(min(0.5 * 2 ** failures, 10))
+
+    async def download(self, url, path, size=None):
+        """Скачать url в path; возвращает размер файла"""
+        part_path, state_path = partial_paths(path)
+        state = self.load_state(path, size)
+        if state is None:
+            if size is None:
+                size = await self.probe_size(url)
+            state = {"size": size, "parts": self.plan(size)}
+        size = state["size"]
+        resumed = sum(part[1] - part[0] for part in state["parts"])
+        if resumed:
+            logging.info(f"Докачиваю {os.path.basename(path)}: уже есть {resumed} из {size} байт")
+
+        # Файловые операции - в потоке: параллельные куски не должны останавливать event loop
+        fd = await asyncio.to_thread(self.open_part, part_path, size)
+        try:
+            storage.track(part_path)
+
+            async def save():
+                # Снимок берем в event loop: куски продолжают менять state, пока файл пишется
+                await asyncio.to_thread(self.save_state, path, json.dumps(state))
+
+            try:
+                await self.run_parts(url, fd, state, save)
+            except RangeNotSupported:
+                # Сервер без Range: один поток с начала файла
+                state["parts"] = self.plan(size, parts=1)
+                await self.run_parts(url, fd, state, save)
+            finally:
+                await save()
+
+            written = os.fstat(fd).st_size
+            missing = sum(part[2] - part[1] for part in state["parts"])
+            if written != size or missing:
+                raise DownloadError(f"Размер не совпал: {written} байт, недокачано {missing} из {size}")
+        finally:
+            os.close(fd)
+
+        os.replace(part_path, path)
+        storage.remove(state_path)
+        storage.remove(part_path)  # Снять с учета старое имя; сам файл уже переименован
+        storage.track(path)
+        return size
+
+    async def run_parts(self, url, fd, state, save):
+        """Все недокачанные куски параллельно; ошибка одного останавливает остальные"""
+        whole = len(state["parts"]) == 1
+        tasks = [
+            asyncio.create_task(self.fetch_part(url, fd, part, whole, save))
+            for part in state["parts"] if part[1] < part[2]
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+downloader = RangedDownloader()
+
+
+# ============ ПАЙПЛАЙН ОБРАБОТКИ ============
+DEFAULT_THEME = "Философия барберинга, мужской стиль и уход за собой"
+ALBUM_COLLECT_DELAY = float(os.getenv("ALBUM_COLLECT_DELAY", "1.0"))  # Сколько ждем остальные части альбома (сек)
+
+
+class JobFailed(Exception):
+    """Ошибка задачи, текст которой показываем пользователю"""
+
+
+class VideoJob:
+    """Задача на обработку видео: все, что нужно этапам пайплайна"""
+
+    def __init__(self, chat_id, user_id, file_id, file_size=0, theme=None, job_id=None, status_message=None,
+                 renditions=None, caption=None, music=None, photos=None, clips=None):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.file_id = file_id
+        self.file_size = file_size or 0
+        self.theme = theme or DEFAULT_THEME
+        self.job_id = job_id
+        self.resumed = job_id is not None  # Задача из журнала после перезапуска
+        self.status_message = status_message
+        self.input_path = None
+        self.output_path = None
+        self.title = None
+        self.desc = None
+        self.album = None  # AlbumBatch, если видео пришло в альбоме
+        self.index = 0  # Номер ролика в альбоме
+        self.renditions = renditions or None  # Форматы (9:16, 1:1, ...) - все за один запуск FFmpeg
+        self.caption = caption or None  # Движок и анимация подписи ({"engine": ..., "animation": ...})
+        self.analysis = None  # Профили кадра для места подписи (analyze_frames), хранятся в журнале
+        self.trim = None  # Кодируемый отрезок (plan_trim), хранится в журнале
+        self.music = music  # Трек фоновой музыки из music_library (None - без музыки)
+        self.preview_path = None
+        self.preview_message = None  # Сообщение с превью и кнопкой "другой заголовок"
+        self.rejected_titles = []
+        self.photos = photos or None  # file_id фото, если ролик собирается из фото
+        self.clips = clips or None  # file_id клипов, если ролик склеивается из нескольких видео
+
+    @classmethod
+    def from_message(cls, message, theme, status_message=None):
+        return cls(
+            message.chat.id, message.from_user.id, message.video.file_id,
+            file_size=message.video.file_size, theme=theme, status_message=status_message,
+            renditions=get_user_setting(message.from_user.id, "renditions"),
+            caption=get_user_setting(message.from_user.id, "caption"),
+            music=music_library.pick(get_user_setting(message.from_user.id, "music"))
+        )
+
+    @classmethod
+    def from_photos(cls, messages, theme, status_message=None):
+        """Ролик из фото (одного или альбома); версии в нескольких форматах для него не делаем"""
+        photos = [message.photo[-1] for message in messages[:SLIDESHOW_MAX_PHOTOS]]  # Самый крупный размер
+        user_id = messages[0].from_user.id
+        return cls(
+            messages[0].chat.id, user_id, photos[0].file_id,
+            file_size=sum(photo.file_size or 0 for photo in photos), theme=theme, status_message=status_message,
+            caption=get_user_setting(user_id, "caption"),
+            music=music_library.pick(get_user_setting(user_id, "music")),
+            photos=[photo.file_id for photo in photos]
+        )
+
+    @classmethod
+    def from_clips(cls, messages, theme, status_message=None):
+        """Один ролик из нескольких видео альбома, по порядку; версии для него не делаем"""
+        videos = [message.video for message in messages[:REEL_MAX_CLIPS]]
+        user_id = messages[0].from_user.id
+        return cls(
+            messages[0].chat.id, user_id, videos[0].file_id,
+            file_size=sum(video.file_size or 0 for video in videos), theme=theme, status_message=status_message,
+            caption=get_user_setting(user_id, "caption"),
+            music=music_library.pick(get_user_setting(user_id, "music")),
+            clips=[video.file_id for video in videos]
+        )
+
+    @property
+    def output_filename(self):
+        return os.path.basename(self.output_path)
+
+    def output_files(self):
+        """Все результаты задачи: основной файл или файлы версий"""
+        if self.renditions:
+            return list(rendition_paths(self.output_path, self.renditions).values())
+        return [self.output_path]
+
+    def input_files(self):
+        """Исходники задачи: видео, фото для ролика из фото или клипы для склейки"""
+        if self.photos:
+            return photo_paths(self.input_path, len(self.photos))
+        if self.clips:
+            return clip_paths(self.input_path, len(self.clips))
+        return [self.input_path]
+
+    def source_ids(self):
+        """file_id исходников - в том же порядке, что input_files"""
+        return self.photos or self.clips or [self.file_id]
+
+    async def set_status(self, text):
+        """Обновляет статус-сообщение задачи (создает его при первом вызове)"""
+        if self.album:
+            return  # У альбома одно общее статус-сообщение
+        if self.status_message:
+            await self.status_message.edit_text(text)
+        else:
+            self.status_message = await bot.send_message(self.chat_id, text)
+
+    async def report(self, text):
+        """Итоговый статус: ошибки Telegram здесь уже не важны"""
+        try:
+            if self.album:
+                await bot.send_message(self.chat_id, f"Видео {self.index + 1}/{self.album.size}: {text}")
+            else:
+                await self.set_status(text)
+        except Exception:
+            pass
+
+
+class VideoPipeline:
+    """
+    Конвейер задач: скачивание -> кодирование -> отправка.
+    Каждый этап занимает слот только своего пула, поэтому пока CPU кодирует
+    одну задачу, сеть скачивает следующую и отдает предыдущую.
+    Текст для видео генерируется параллельно со скачиванием.
+    """
+
+    def __init__(self, download_pool, encode_pool, upload_pool):
+        self.download_pool = download_pool
+        self.encode_pool = encode_pool
+        self.upload_pool = upload_pool
+        self.previews = {}  # job_id -> задача, превью которой еще можно отклонить
+
+    async def run(self, job):
+        """Проводит задачу через все этапы. Итог: done, rejected, failed, cancelled или interrupted"""
+        trace = start_trace(job.user_id, job.theme, trace_id=job.job_id)
+        job.job_id = trace.trace_id
+        supervisor.register_job(job.job_id, job.user_id)
+        if not job.resumed:
+            journal.record(
+                job.job_id, "accepted",
+                chat_id=job.chat_id, user_id=job.user_id, file_id=job.file_id, file_size=job.file_size, theme=job.theme,
+                renditions=job.renditions, caption=job.caption, music=job.music, photos=job.photos, clips=job.clips
+            )
+
+        outcome = "failed"
+        error = None
+        llm_task = None
+        try:
+            os.makedirs(VIDEOS_FOLDER, exist_ok=True)
+            os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+
+            # Под нагрузкой на диск новые задачи не берем
+            # Каждая версия - отдельный результат на диске; при нехватке места admit чистит мусор - не в event loop
+            needed = job.file_size * len(job.renditions or [None])
+            if not job.resumed and not await asyncio.to_thread(storage.admit, needed):
+                error = "мало места на диске"
+                journal.record(job.job_id, "failed", error=error)
+                outcome = "rejected"
+                trace.finish(outcome)
+                await bot.send_message(
+                    job.chat_id,
+                    "⏳ Сейчас на сервере мало места для обработки. Попробуйте отправить видео через несколько минут."
+                )
+                return outcome
+
+            if not job.input_path:
+                self.assign_paths(job)
+                journal.record(job.job_id, "downloading", input_path=job.input_path, output_path=job.output_path)
+
+            # Текст не зависит от файла - LLM работает, пока видео скачивается
+            if job.title is None:
+                llm_task = asyncio.create_task(self.generate_text(job))
+
+            await self.download(job)
+
+            await job.set_status(f"⚙️ Обрабатываю видео...\n🤔 Генерирую текст на тему: '{job.theme}'")
+            if llm_task:
+                await llm_task
+            supervisor.check(job.job_id)
+            journal.record(job.job_id, "processing", title=job.title, desc=job.desc)
+
+            await self.encode_with_preview(job)
+            await self.upload(job)
+            outcome = "done"
+
+        except JobCancelled as e:
+            # Состояние пользователя уже сбросил тот, кто отменил задачу
+            logging.info(f"Задача отменена: {e}")
+            outcome = "interrupted" if str(e) == "shutdown" else "cancelled"
+            trace.finish(outcome)
+            journal.record(job.job_id, outcome)
+            if outcome == "interrupted":
+                # Бот останавливается: исходник сохраняем, продолжим после запуска
+                await job.report("⏸️ Бот перезапускается. Обработка продолжится автоматически после запуска.")
+            else:
+                await job.report("🚫 Обработка отменена")
+
+        except JobFailed as e:
+            error = str(e)
+            trace.finish("error")
+            journal.record(job.job_id, "failed", error=error)
+            await job.report(f"❌ {e}")
+
+        except Exception as e:
+            logging.error(f"Ошибка в пайплайне: {e}")
+            error = str(e)
+            trace.finish("error")
+            journal.record(job.job_id, "failed", error=error)
+            try:
+                await bot.send_message(job.chat_id, f"❌ Произошла ошибка: {str(e)}")
+            except Exception:
+                pass
+
+        finally:
+            if llm_task and not llm_task.done():
+                llm_task.cancel()
+            self.previews.pop(job.job_id, None)
+            if job.album:
+                # Альбом ждет все ролики, в том числе неудачные
+                await job.album.skip(job)
+            trace.finish()
+            supervisor.finish_job(job.job_id)
+            journal.close_job(job.job_id)
+            logging.info(f"Задача завершена за {trace.duration:.1f}с: {trace.status}")
+            # Прерванную остановкой задачу допишет в историю следующий запуск
+            if outcome != "interrupted":
+                await self.record_history(job, trace, outcome, error)
+            # Очистка временных файлов (исходник прерванной задачи нужен для возобновления)
+            try:
+                if job.input_path and outcome != "interrupted":
+                    for path in job.input_files():
+                        storage.remove(path)
+                        for partial in partial_paths(path):
+                            storage.remove(partial)
+                if job.output_path:
+                    for path in job.output_files():
+                        storage.remove(path)
+                        storage.remove(cover_path(path))
+                if job.preview_path:
+                    storage.remove(job.preview_path)
+            except Exception as e:
+                logging.error(f"Ошибка при очистке файлов: {e}")
+
+        return outcome
+
+    async def record_history(self, job, trace, outcome, error):
+        """Итог задачи в историю (до удаления результатов - нужен их размер); SQLite пишет в потоке"""
+        try:
+            bytes_out = sum(os.path.getsize(path) for path in job.output_files() if os.path.exists(path)) if job.output_path else 0
+            profile = {
+                "renditions": job.renditions,
+                "caption": caption_settings(job.caption),
+                "music": job.music,
+                "trimmed": bool(job.trim),
+                "album": bool(job.album),
+                "photos": len(job.photos or []),
+                "clips": len(job.clips or []),
+                "resumed": job.resumed,
+                "rejected_titles": len(job.rejected_titles)
+            }
+            await asyncio.to_thread(
+                job_history.record, job.job_id, job.user_id, trace.started_at, outcome, trace.duration,
+                bytes_in=job.file_size, bytes_out=bytes_out, profile=profile, stages=job_stage_times(trace), error=error
+            )
+        except Exception as e:
+            logging.error(f"Не удалось записать задачу в историю: {e}")
+
+    def assign_paths(self, job):
+        """Уникальные имена файлов; небольшие ролики обрабатываем в RAM-папке, если она настроена"""
+        input_folder, output_folder = storage.workdirs(job.file_size)
+        job.input_path = os.path.join(input_folder, f"temp_{job.user_id}_{job.job_id}.mp4")
+        job.output_path = os.path.join(output_folder, f"processed_{job.user_id}_{job.job_id}.mp4")
+        logging.info(f"Скачиваю видео в: {job.input_path}")
+        logging.info(f"Тема: {job.theme}")
+
+    async def generate_text(self, job):
+        if job.album:
+            job.title, job.desc = await job.album.text_for(job)
+        else:
+            job.title, job.desc = await asyncio.to_thread(generate_title_and_description, job.theme)
+
+    async def download(self, job):
+        paths = job.input_files()
+        # Исходник мог сохраниться с прошлого запуска (у ролика из фото или клипов - часть файлов)
+        pending = [
+            (file_id, path) for file_id, path in zip(job.source_ids(), paths)
+            if not os.path.exists(path) or os.path.getsize(path) == 0
+        ]
+        if not pending:
+            for path in paths:
+                storage.track(path)
+            return
+
+        await job.set_status("📥 Скачиваю фото..." if job.photos else "📥 Скачиваю видео...")
+        async with self.download_pool.slot(job.job_id):
+            for file_id, path in pending:
+                with stage_timer("get_file"):
+                    file_info = await bot.get_file(file_id)
+                try:
+                    with stage_timer("download") as span:
+                        url = bot.session.api.file_url(bot.token, file_info.file_path)
+                        span["bytes_in"] = await downloader.download(url, path, file_info.file_size)
+                        if not span["bytes_in"]:
+                            raise Exception("Файл пустой")
+                except Exception as e:
+                    raise JobFailed(f"Ошибка скачивания: {str(e)}")
+                supervisor.check(job.job_id)
+
+        logging.info(f"Файлы скачаны. Размер: {sum(os.path.getsize(path) for path in paths)} байт")
+        journal.record(job.job_id, "downloaded")
+
+    async def analyze(self, job):
+        """Обрезка и анализ кадров: дешевые, результат пишем в журнал, после перезапуска не повторяем"""
+        if job.photos or job.clips:
+            return  # Ролика еще нет - резать и анализировать нечего
+        changed = False
+        if job.trim is None and trim_enabled():
+            job.trim = await asyncio.to_thread(plan_trim, job.input_path) or {}
+            changed = True
+        if job.analysis is None and PLACEMENT_ANALYSIS:
+            job.analysis = await asyncio.to_thread(analyze_frames, job.input_path, job.trim) or {}
+            changed = True
+        if changed:
+            journal.record(job.job_id, "analyzed", analysis=job.analysis, trim=job.trim)
+
+    def wants_preview(self, job):
+        """Превью только для одиночных новых задач с достаточно длинным роликом"""
+        if not PREVIEW_ENABLED or job.album or job.resumed or job.photos or job.clips:
+            return False
+        try:
+            duration = job.trim["duration"] if job.trim else probe_video(job.input_path)["duration"]
+        except Exception:
+            return False
+        return (duration or 0) >= PREVIEW_MIN_SOURCE
+
+    async def preview(self, job):
+        """Рендерит и отправляет превью; пока идет полное кодирование, его можно отклонить кнопкой"""
+        job.preview_path = job.output_path.replace('.mp4', '_preview.mp4')
+        preview_job = preview_job_id(job)
+        supervisor.register_job(preview_job, job.user_id, parent=job.job_id)
+        CURRENT_PROCESS_JOB.set(preview_job)  # Контекст своей задачи asyncio: основное кодирование не затрагивает
+        try:
+            async with self.encode_pool.slot(job.job_id):
+                render = asyncio.ensure_future(asyncio.to_thread(
+                    render_preview, job.input_path, job.preview_path, job.title, job.caption, job.analysis, job.trim
+                ))
+                try:
+                    ok = await asyncio.shield(render)
+                except asyncio.CancelledError:
+                    # Поток не отменить: ждем, пока выйдет его (уже остановленный) FFmpeg,
+                    # чтобы слот CPU освободился и файлы превью убрались только после этого
+                    await asyncio.gather(render, return_exceptions=True)
+                    storage.remove(job.preview_path)
+                    raise
+        finally:
+            supervisor.finish_job(preview_job)
+        supervisor.check(job.job_id)
+        if not ok:
+            return  # Без превью задача просто идет дальше
+
+        keyboard = None
+        if len(job.rejected_titles) < PREVIEW_MAX_REJECTS:
+            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[[
+                types.InlineKeyboardButton(text="🔄 Другой заголовок", callback_data=f"preview_reject:{job.job_id}")
+            ]])
+        try:
+            job.preview_message = await bot.send_video(
+                job.chat_id,
+                FSInputFile(job.preview_path, filename="preview.mp4"),
+                caption=f"👀 Превью: {job.title}\n\nПолное видео уже кодируется." + (
+                    " Если заголовок не подходит - нажмите кнопку, сделаю другой." if keyboard else ""
+                ),
+                supports_streaming=True,
+                reply_markup=keyboard
+            )
+            if keyboard:
+                self.previews[job.job_id] = job
+        except Exception as e:
+            logging.error(f"Не удалось отправить превью: {e}")
+        finally:
+            storage.remove(job.preview_path)
+
+    async def retitle(self, job):
+        """Пользователь отклонил превью: новый заголовок, и кодирование начинается заново"""
+        job.rejected_titles.append(job.title)
+        supervisor.clear_rejection(job.job_id)
+        await job.set_status("🔄 Генерирую другой заголовок...")
+        job.title, job.desc = await asyncio.to_thread(generate_title_and_description, job.theme, job.rejected_titles)
+        supervisor.check(job.job_id)
+        journal.record(job.job_id, "processing", title=job.title, desc=job.desc)
+        await job.set_status("⚙️ Обрабатываю видео с новым заголовком...")
+
+    async def encode_with_preview(self, job):
+        """
+        Кодирование; превью рендерится и отправляется параллельно с ним.
+        Отклоненное превью останавливает кодирование и запускает его заново с другим заголовком.
+        """
+        while True:
+            preview_task = None
+            if self.wants_preview(job):
+                # Превью и полное кодирование кладут одну и ту же подпись
+                async with self.encode_pool.slot(job.job_id):
+                    await self.analyze(job)
+                preview_task = asyncio.create_task(self.preview(job))
+                # Превью короткое и нужно пользователю первым: даем ему занять слот CPU раньше кодирования
+                await asyncio.sleep(0)
+            try:
+                await self.encode(job)
+                # Между концом кодирования и этой строкой нет await: отклонить уже готовое видео нельзя
+                shown = self.previews.pop(job.job_id, None)
+                break
+            except JobCancelled as e:
+                if str(e) != "rejected":
+                    raise
+                await self.retitle(job)
+            finally:
+                if preview_task:
+                    # Видео готово раньше превью - превью уже не нужно: останавливаем его FFmpeg
+                    supervisor.cancel_job(preview_job_id(job), "preview")
+                    preview_task.cancel()
+                    await asyncio.gather(preview_task, return_exceptions=True)
+
+        if shown and job.preview_message:
+            try:
+                await job.preview_message.edit_reply_markup(reply_markup=None)
+            except Exception:
+                pass
+
+    async def encode(self, job):
+        async with self.encode_pool.slot(job.job_id):
+            await self.analyze(job)
+
+            if job.photos:
+                success = await asyncio.to_thread(
+                    process_slideshow, job.input_files(), job.output_path, job.title, job.music, cover_path(job.output_path)
+                )
+            elif job.clips:
+                success = await asyncio.to_thread(
+                    process_reel, job.input_files(), job.output_path, job.title, job.music, cover_path(job.output_path)
+                )
+            elif job.renditions:
+                outputs = rendition_paths(job.output_path, job.renditions)
+                success = await asyncio.to_thread(
+                    process_renditions, job.input_path, outputs, job.title, job.caption, job.analysis, job.trim, job.music,
+                    {aspect: cover_path(path) for aspect, path in outputs.items()}
+                )
+            else:
+                success = await asyncio.to_thread(
+                    process_video, job.input_path, job.output_path, job.title, job.caption, job.analysis, job.trim, job.music,
+                    cover_path(job.output_path)
+                )
+
+        # Пока шла обработка, задачу могли отменить - тогда ничего не отправляем
+        supervisor.check(job.job_id)
+        if not success:
+            raise JobFailed("Ошибка обработки видео")
+        if not all(os.path.exists(path) for path in job.output_files()):
+            raise JobFailed("Обработанное видео не создано")
+
+    async def upload(self, job):
+        await job.set_status("📤 Отправляю результат...")
+        journal.record(job.job_id, "uploading")
+        if job.album:
+            await job.album.deliver(job)
+            journal.record(job.job_id, "done")
+            return
 
-        logging.debug(f"Получен ответ от ИИ:\n{content}")
+        async with self.upload_pool.slot(job.job_id):
+            try:
+                if job.renditions:
+                    await send_job_renditions(
+                        job.chat_id, job.output_files(), job.renditions, job.title, job.desc, job.theme, job.trim
+                    )
+                else:
+                    await send_job_result(
+                        job.chat_id, job.output_path, job.output_filename, job.title, job.desc, job.theme, job.trim
+                    )
+            except Exception as e:
+                logging.error(f"Ошибка отправки: {e}")
+                raise JobFailed(f"Ошибка отправки: {str(e)}")
+        journal.record(job.job_id, "done")
 
-        if "ОПИСАНИЕ:" in content:
-            title_part, desc_part = content.split("ОПИСАНИЕ:")
-            title = title_part.replace("ЗАГОЛОВОК:", "").strip()
-            description = desc_part.strip()
-        else:
-            # Если формат не соответствует, возвращаем весь текст нейросети для генерации заголовка
-            ar_prompt = f"Отправь короткий заголовок до 5 слов, которым можно описать этот текст: {content}"
+        await job.status_message.delete()
 
-            ar_payload = {
-                "model": OPENROUTER_MODEL,
-                "messages": [{"role": "user", "content": ar_prompt}],
-                "temperature": round(random.uniform(0.65, 0.9), 2)
-            }
+        # Предлагаем обработать еще одно видео
+        await bot.send_message(
+            job.chat_id,
+            "✅ Готово! Видео обработано успешно.\n\n"
+            "Хочешь обработать еще одно видео?\n"
+            "1. Отправь новую тему для текста\n"
+            "2. Или просто отправь следующее видео - будет использована стандартная тема\n\n"
+            "Для отмены используй /cancel"
+        )
 
-            ar = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                data=json.dumps(ar_payload),
-                timeout=60
+    async def run_album(self, jobs, status_message=None):
+        """Ролики альбома идут по пайплайну параллельно, результат - одной медиагруппой"""
+        album = AlbumBatch(self, jobs[0].chat_id, jobs[0].theme, len(jobs), status_message)
+        for index, job in enumerate(jobs):
+            job.album = album
+            job.index = index
+            job.renditions = None  # В медиагруппе до 10 роликов - версии для альбома не делаем
+        return await asyncio.gather(*(self.run(job) for job in jobs))
+
+    async def send_album(self, album, jobs):
+        media = [
+            InputMediaVideo(
+                media=FSInputFile(job.output_path, filename=job.output_filename),
+                caption=video_caption(job.title, job.theme, job.trim),
+                **video_upload_args(job.output_path)
             )
-            ar.raise_for_status()
-
-            ar_content = ar.json()["choices"][0]["message"]["content"]
+            for job in jobs
+        ]
+        async with self.upload_pool.slot():
+            with stage_timer("upload", bytes_out=sum(os.path.getsize(job.output_path) for job in jobs), batch=len(jobs)):
+                await bot.send_media_group(album.chat_id, media)
 
-            title = ar_content.strip()
-            description = content
+        for job in jobs:
+            await send_job_description(album.chat_id, job.title, job.desc, job.theme)
 
-        logging.info(f"Сгенерирован заголовок: {title}")
-        logging.info(f"Сгенерировано описание (первые 100 символов): {description[:100]}...")
-        return title, description
+        if album.status_message:
+            await album.status_message.delete()
 
-    except Exception as e:
-        logging.error(f"Ошибка генерации текста: {e}")
-        return "Философия барберинга", "Описание не сгенерировано из-за ошибки API."
+        failed = album.size - len(jobs)
+        await bot.send_message(
+            album.chat_id,
+            f"✅ Готово! Обработано видео: {len(jobs)} из {album.size}.\n\n"
+            + (f"⚠️ Не удалось обработать: {failed}\n\n" if failed else "")
+            + "Хочешь обработать еще?\n"
+            "1. Отправь новую тему для текста\n"
+            "2. Или просто отправь следующее видео или альбом - будет использована стандартная тема\n\n"
+            "Для отмены используй /cancel"
+        )
 
 
-def process_single_video(input_path, output_path, theme=None):
-    """Обработка одного видео для бота"""
-    try:
-        # Создаем папки если не существуют
-        os.makedirs(os.path.dirname(input_path), exist_ok=True)
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+class AlbumBatch:
+    """
+    Альбом из нескольких видео. Ролики идут по пайплайну как обычные задачи,
+    но текст для всех генерируется одним запросом к LLM, а готовые ролики
+    ждут друг друга и уходят одной медиагруппой.
+    """
 
-        # Проверяем FFmpeg
+    def __init__(self, pipeline, chat_id, theme, size, status_message=None):
+        self.pipeline = pipeline
+        self.chat_id = chat_id
+        self.theme = theme
+        self.size = size
+        self.status_message = status_message
+        self.ready = {}  # index -> готовая задача
+        self.arrived = set()  # Ролики, дошедшие до конца пайплайна (готовые и неудачные)
+        self.delivered = asyncio.Event()
+        self.error = None
+        self._titles = None
+
+    async def text_for(self, job):
+        # Первый ролик запускает общий запрос, остальные ждут его результат
+        if self._titles is None:
+            self._titles = asyncio.create_task(asyncio.to_thread(generate_titles_batch, self.theme, self.size))
+        titles = await asyncio.shield(self._titles)
+        return titles[job.index]
+
+    async def deliver(self, job):
+        """Готовый ролик ждет остальных; отправляет тот, кто пришел последним"""
+        self.ready[job.index] = job
+        await self._arrive(job)
+        await self.delivered.wait()
+        if self.error:
+            raise JobFailed(f"Ошибка отправки: {self.error}")
+
+    async def skip(self, job):
+        """Ролик выбыл (ошибка, отмена) - отправку не задерживает"""
+        if job.index not in self.arrived:
+            await self._arrive(job)
+
+    async def _arrive(self, job):
+        self.arrived.add(job.index)
+        if len(self.arrived) < self.size:
+            return
         try:
-            subprocess.run([FFMPEG_PATH, '-version'], capture_output=True, check=True)
+            if self.ready:
+                await self.pipeline.send_album(self, [self.ready[i] for i in sorted(self.ready)])
         except Exception as e:
-            logging.error(f"FFmpeg не найден: {e}")
-            return False, "FFmpeg не найден", None, None
+            logging.error(f"Ошибка отправки альбома: {e}")
+            self.error = str(e)
+        finally:
+            self.delivered.set()
 
-        # Если тема не указана, используем стандартную
-        if not theme:
-            theme = "Философия барберинга, мужской стиль и уход за собой"
 
-        # Генерируем текст
-        text, desc = generate_title_and_description(theme)
+pipeline = VideoPipeline(download_pool, job_scheduler, upload_pool)
 
-        # Обрабатываем видео
-        if process_video(input_path, output_path, text):
-            return True, "Успешно обработано", text, desc, theme
-        else:
-            return False, "Ошибка обработки видео", text, desc, theme
+
+async def resume_job(record):
+    """Продолжает задачу из журнала после перезапуска бота"""
+    job_id = record["job_id"]
+    chat_id = record["chat_id"]
+    attempts = record.get("attempts", 0) + 1
+    journal.record(job_id, "resumed", attempts=attempts)
+
+    try:
+        if attempts > JOB_MAX_ATTEMPTS:
+            journal.record(job_id, "failed", error="слишком много попыток")
+            await bot.send_message(chat_id, "❌ Не удалось обработать ваше видео после перезапуска бота. Отправьте его еще раз.")
+            return
+
+        job = VideoJob(
+            chat_id, record["user_id"], record["file_id"],
+            file_size=record.get("file_size"), theme=record.get("theme"), job_id=job_id,
+            renditions=record.get("renditions"), caption=record.get("caption"), music=record.get("music"),
+            photos=record.get("photos"), clips=record.get("clips")
+        )
+        # Пути и текст уже в журнале - повторно их не выбираем и LLM не зовем
+        job.input_path = record.get("input_path")
+        job.output_path = record.get("output_path")
+        job.title = record.get("title")
+        job.desc = record.get("desc")
+        job.analysis = record.get("analysis")
+        job.trim = record.get("trim")
+
+        job.status_message = await bot.send_message(chat_id, "🔄 Бот перезапустился, продолжаю обработку вашего видео...")
+        await pipeline.run(job)
 
     except Exception as e:
-        logging.error(f"Ошибка в process_single_video: {e}")
-        return False, f"Ошибка: {str(e)}", None, None, theme
+        logging.error(f"Ошибка возобновления задачи: {e}")
+        journal.close_job(job_id)
 
 
 # ============ КОМАНДЫ БОТА ============
@@ -658,7 +4424,12 @@ async def cmd_start(message: Message, state: FSMContext):
         "2. Отправь видео\n"
         "3. Я добавлю текст на видео и сгенерирую описание\n\n"
         "✏️ Чтобы начать, отправь свою тему для текста (например: 'стиль, уход, профессия')\n"
-        "📝 Или просто отправь видео - тогда будет использована стандартная тема\n\n"
+        "📝 Или просто отправь видео - тогда будет использована стандартная тема\n"
+        "🖼 Нет видео? Отправь фото или альбом фото - соберу из них видео\n"
+        "📐 /formats - получать видео сразу в нескольких форматах (9:16, 1:1, 4:5)\n"
+        "🎨 /caption - оформление подписи (анимация появления, печать по буквам)\n"
+        "🎵 /music - фоновая музыка под видео\n"
+        "🎞 /reel - склеивать альбом из видео в один ролик\n\n"
         "ℹ️ Теперь вы будете получать уведомления о статусе бота!"
     )
     await state.set_state(VideoProcessing.waiting_for_theme)
@@ -679,7 +4450,176 @@ async def cmd_default(message: Message, state: FSMContext):
 @dp.message(Command("cancel"))
 async def cmd_cancel(message: Message, state: FSMContext):
     await state.clear()
-    await message.answer("❌ Операция отменена. Используйте /start чтобы начать заново.")
+
+    # Останавливаем FFmpeg и задачи в очереди, слоты возвращаются планировщику
+    cancelled = supervisor.cancel_user(message.from_user.id, "cancel")
+    if cancelled:
+        await notify_pools()
+        await message.answer(f"❌ Операция отменена, остановлено задач: {cancelled}. Используйте /start чтобы начать заново.")
+    else:
+        await message.answer("❌ Операция отменена. Используйте /start чтобы начать заново.")
+
+
+# Команда /formats - версии видео в нескольких форматах
+@dp.message(Command("formats"))
+async def cmd_formats(message: Message):
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+    available = ", ".join(RENDITIONS)
+
+    if not args:
+        current = get_user_setting(user_id, "renditions")
+        await message.answer(
+            f"📐 Форматы: {', '.join(current) if current else 'только исходный'}\n\n"
+            f"Доступно: {available}\n"
+            f"• /formats 9:16 1:1 4:5 - присылать видео сразу в этих форматах\n"
+            f"• /formats off - только исходный формат"
+        )
+        return
+
+    if args == ["off"]:
+        set_user_setting(user_id, "renditions", None)
+        await message.answer("✅ Буду присылать видео в исходном формате.")
+        return
+
+    unknown = [item for item in args if item not in RENDITIONS]
+    if unknown:
+        await message.answer(f"❌ Неизвестный формат: {', '.join(unknown)}. Доступно: {available}")
+        return
+
+    renditions = list(dict.fromkeys(args))
+    set_user_setting(user_id, "renditions", renditions)
+    await message.answer(f"✅ Буду присылать каждое видео в форматах: {', '.join(renditions)}")
+
+
+# Команда /caption - движок и анимация подписи
+@dp.message(Command("caption"))
+async def cmd_caption(message: Message):
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+
+    if not args:
+        engine, animation = caption_settings(get_user_setting(user_id, "caption"))
+        await message.answer(
+            f"🎨 Подпись: {engine}" + (f", анимация: {animation}" if engine == "ass" else "") + "\n\n"
+            f"• /caption pillow - подложка картинкой (по умолчанию)\n"
+            f"• /caption ass [{' | '.join(CAPTION_ANIMATIONS)}] - субтитры с анимацией\n"
+            f"• /caption off - настройки по умолчанию"
+        )
+        return
+
+    if args == ["off"]:
+        set_user_setting(user_id, "caption", None)
+        await message.answer("✅ Подпись будет оформлена по умолчанию.")
+        return
+
+    engine, animation = args[0], args[1] if len(args) > 1 else None
+    if engine not in CAPTION_ENGINES or len(args) > 2:
+        await message.answer(f"❌ Неизвестный движок. Доступно: {', '.join(CAPTION_ENGINES)}")
+        return
+    if animation and (engine != "ass" or animation not in CAPTION_ANIMATIONS):
+        await message.answer(f"❌ Анимация есть только у ass: {', '.join(CAPTION_ANIMATIONS)}")
+        return
+
+    caption = {"engine": engine}
+    if animation:
+        caption["animation"] = animation
+    set_user_setting(user_id, "caption", caption)
+    await message.answer(f"✅ Подпись: {engine}" + (f", анимация: {animation}" if animation else ""))
+
+
+# Команда /reel - альбом из видео склеивается в один ролик
+@dp.message(Command("reel"))
+async def cmd_reel(message: Message):
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+
+    if not args:
+        enabled = get_user_setting(user_id, "reel")
+        await message.answer(
+            f"🎞 Альбом из видео: {'один ролик' if enabled else 'каждое видео отдельно'}\n\n"
+            f"• /reel on - склеивать видео альбома по порядку в один ролик с одной подписью\n"
+            f"• /reel off - обрабатывать каждое видео альбома отдельно"
+        )
+        return
+
+    if args not in (["on"], ["off"]):
+        await message.answer("❌ Используйте /reel on или /reel off")
+        return
+
+    enabled = args == ["on"]
+    set_user_setting(user_id, "reel", enabled or None)
+    await message.answer(
+        f"✅ Альбом из видео будет склеен в один ролик (до {REEL_MAX_CLIPS} видео)." if enabled
+        else "✅ Каждое видео альбома буду обрабатывать отдельно."
+    )
+
+
+# Команда /music - фоновая музыка
+@dp.message(Command("music"))
+async def cmd_music(message: Message):
+    user_id = message.from_user.id
+    args = message.text.split(maxsplit=1)[1:]
+    tracks = music_library.tracks()
+
+    if not tracks:
+        await message.answer("🎵 Библиотека музыки сейчас пуста.")
+        return
+
+    if not args:
+        current = get_user_setting(user_id, "music")
+        listing = "\n".join(f"• {name}" for name in tracks[:30])
+        await message.answer(
+            f"🎵 Музыка: {'случайный трек' if current == 'random' else current or 'выключена'}\n\n"
+            f"Треки:\n{listing}\n\n"
+            f"• /music random - случайный трек к каждому видео\n"
+            f"• /music <название> - всегда этот трек\n"
+            f"• /music off - без музыки"
+        )
+        return
+
+    choice = args[0].strip()
+    if choice == "off":
+        set_user_setting(user_id, "music", None)
+        await message.answer("✅ Видео будут без фоновой музыки.")
+        return
+
+    if choice != "random" and choice not in tracks:
+        await message.answer("❌ Такого трека нет. Список: /music")
+        return
+
+    set_user_setting(user_id, "music", choice)
+    await message.answer(f"✅ Музыка: {'случайный трек' if choice == 'random' else choice}. Голос в видео останется громче музыки.")
+
+
+# Кнопка "Другой заголовок" под превью
+@dp.callback_query(F.data.startswith("preview_reject:"))
+async def process_preview_reject(callback: types.CallbackQuery):
+    job_id = callback.data.split(":", 1)[1]
+    job = pipeline.previews.get(job_id)
+    if not job or job.user_id != callback.from_user.id:
+        await callback.answer("Видео уже готово или обработка остановлена")
+        try:
+            await callback.message.edit_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+        return
+
+    # Останавливаем полное кодирование - CPU не тратится на видео, которое не нужно
+    pipeline.previews.pop(job_id)
+    supervisor.cancel_job(job_id, "rejected")
+    await notify_pools()
+    await callback.message.edit_caption(caption=f"❌ Отклонено: {job.title}", reply_markup=None)
+    await callback.answer("Делаю другой заголовок")
+
+
+# Пользователь заблокировал бота - его задачи больше некому отдавать
+@dp.my_chat_member()
+async def handle_chat_member_update(update: types.ChatMemberUpdated):
+    if update.new_chat_member.status in ("kicked", "left"):
+        cancelled = supervisor.cancel_user(update.from_user.id, "blocked")
+        if cancelled:
+            await notify_pools()
 
 
 # ============ КОМАНДЫ АДМИНА БОТА ============
@@ -692,19 +4632,10 @@ async def cmd_stats(message: Message):
         await message.answer("❌ У вас нет прав для просмотра статистики.")
         return
 
-    # Проверяем размер папок
-    input_size = 0
-    output_size = 0
-
-    if os.path.exists(VIDEOS_FOLDER):
-        for root, dirs, files in os.walk(VIDEOS_FOLDER):
-            for file in files:
-                input_size += os.path.getsize(os.path.join(root, file))
-
-    if os.path.exists(OUTPUT_FOLDER):
-        for root, dirs, files in os.walk(OUTPUT_FOLDER):
-            for file in files:
-                output_size += os.path.getsize(os.path.join(root, file))
+    # Размеры папок берем из учета хранилища - без обхода диска, историю - из готовых агрегатов
+    day = await asyncio.to_thread(job_history.summary, 24)
+    input_size = storage.usage[os.path.abspath(VIDEOS_FOLDER)]
+    output_size = storage.usage[os.path.abspath(OUTPUT_FOLDER)]
 
     stats_text = f"""
 📊 Статистика бота:
@@ -719,10 +4650,30 @@ async def cmd_stats(message: Message):
 💾 Папка результатов:
   • Путь: {OUTPUT_FOLDER}
   • Размер: {output_size / (1024 * 1024):.2f} MB
-    
-🔄 Последние 5 пользователей:
+
+🧹 Диск:
+  • Занято: {storage.disk_usage() / (1024 * 1024):.2f} из {DISK_QUOTA_MB or '∞'} MB
+  • RAM-папка: {(storage.usage.get(storage.scratch_folder, 0) / (1024 * 1024)) if storage.scratch_folder else 0:.2f} MB
+  • Удалено уборщиком: {storage.evicted}
+
+⚙️ Нагрузка:
+  • Скачивание: {download_pool.active} из {download_pool.limit}, в очереди {download_pool.waiting}
+  • Обработка: {job_scheduler.active} из {job_scheduler.limit} (макс. {job_scheduler.max_limit}), в очереди {job_scheduler.waiting}
+  • Отправка: {upload_pool.active} из {upload_pool.limit}, в очереди {upload_pool.waiting}
+  • Кодирований FFmpeg: {int(REGISTRY.get_sample_value("bot_active_encodes") or 0)}
+  • Задержка event loop: {(REGISTRY.get_sample_value("bot_event_loop_lag_seconds") or 0) * 1000:.0f} мс
+
+📈 За 24 часа (подробнее - /history):
+  • {day['jobs']} задач, готово {day['done']}, ошибок {day['failure_rate'] * 100:.1f}%, p95 {day['p95']:.0f}с
+
+⏱ Этапы (кол-во / сред. / p95 / ошибки):
 """
 
+    for stage, item in collect_stage_stats().items():
+        stats_text += f"  • {stage}: {item['count']} / {item['avg']:.2f}с / {item['p95']:.2f}с / {item['failures']}\n"
+
+    stats_text += "\n🔄 Последние 5 пользователей:\n"
+
     # Получаем последних 5 пользователей
     recent_users = list(SUBSCRIBED_USERS)[-5:] if SUBSCRIBED_USERS else []
     for i, uid in enumerate(recent_users, 1):
@@ -730,6 +4681,83 @@ async def cmd_stats(message: Message):
 
     await message.answer(stats_text)
 
+# Команда /trace - таймлайн самых долгих недавних задач
+@dp.message(Command("trace"))
+async def cmd_trace(message: Message):
+    """Трейсы последних задач пользователя (только для админов)"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав для просмотра трейсов.")
+        return
+
+    # Формат: /trace [ID_пользователя]
+    args = message.text.split(maxsplit=1)
+    traces = list(RECENT_TRACES)
+
+    if len(args) > 1:
+        try:
+            target_id = int(args[1])
+        except ValueError:
+            await message.answer("❌ ID должен быть числом")
+            return
+        traces = [t for t in traces if t.user_id == target_id]
+        header = f"🧭 Самые долгие задачи пользователя {target_id}:"
+    else:
+        header = "🧭 Самые долгие недавние задачи:"
+
+    if not traces:
+        await message.answer("📭 Нет недавних задач.")
+        return
+
+    traces.sort(key=lambda t: t.duration, reverse=True)
+    text = header + "\n\n" + "\n\n".join(t.render() for t in traces[:5])
+
+    # Ограничение Telegram на длину сообщения
+    for i in range(0, len(text), 4000):
+        await message.answer(text[i:i + 4000])
+
+# Команда /history - сводка по истории задач
+@dp.message(Command("history"))
+async def cmd_history(message: Message):
+    """Пропускная способность, задержки, ошибки и активные пользователи (только для админов)"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав для просмотра истории.")
+        return
+
+    # Формат: /history [часов], по умолчанию сутки
+    args = message.text.split(maxsplit=1)
+    try:
+        hours = max(1, int(args[1])) if len(args) > 1 else 24
+    except ValueError:
+        await message.answer("❌ Укажите число часов, например /history 168")
+        return
+
+    s = await asyncio.to_thread(job_history.summary, hours)
+    text = (
+        f"📈 История за {hours} ч:\n\n"
+        f"  • Задач: {s['jobs']}, готово {s['done']}, ошибок {s['failed']} ({s['failure_rate'] * 100:.1f}%), "
+        f"отменено {s['cancelled']}\n"
+        f"  • Пропускная способность: {s['per_hour']:.1f} видео/ч\n"
+        f"  • Время до результата: p50 {s['p50']:.0f}с, p95 {s['p95']:.0f}с\n"
+        f"  • Трафик: принято {s['bytes_in'] / (1024 * 1024):.0f} MB, отдано {s['bytes_out'] / (1024 * 1024):.0f} MB\n"
+    )
+    if s["hourly"]:
+        text += "\n🕐 Готово по часам (UTC):\n" + "\n".join(
+            f"  {time.strftime('%H:00', time.gmtime(bucket))} {'▇' * min(done, 30)} {done}" for bucket, done in s["hourly"]
+        ) + "\n"
+    if s["stages"]:
+        text += "\n⏱ Этапы (кол-во / сред.):\n" + "\n".join(
+            f"  • {item['stage']}: {item['count']} / {item['avg']:.2f}с" for item in s["stages"]
+        ) + "\n"
+    if s["failures"]:
+        text += "\n❌ Частые ошибки:\n" + "\n".join(f"  • {count}× {error}" for error, count in s["failures"]) + "\n"
+    if s["users"]:
+        text += "\n👥 Самые активные:\n" + "\n".join(
+            f"  • {item['user_id']}: {item['jobs']} задач, ошибок {item['failed']}" for item in s["users"]
+        )
+
+    for i in range(0, len(text), 4000):
+        await message.answer(text[i:i + 4000])
+
 # Команда /msg - отправка сообщений с удобным меню
 @dp.message(Command("msg"))
 async def cmd_send_message_menu(message: Message, state: FSMContext):
@@ -997,146 +5025,112 @@ async def process_theme(message: Message, state: FSMContext):
     await state.set_state(VideoProcessing.waiting_for_video)
 
 
-# Обработка видео с сохраненной темой
-@dp.message(VideoProcessing.waiting_for_video, F.video)
-async def handle_video_with_theme(message: Message, state: FSMContext):
-    # Получаем сохраненную тему
-    user_data = await state.get_data()
-    theme = user_data.get('theme', "Философия барберинга, мужской стиль и уход за собой")
-
-    # Уведомляем пользователя
-    status_message = await message.answer(f"🎬 Видео получено. Тема: '{theme}'\nНачинаю обработку...")
-
-    await state.set_state(VideoProcessing.processing)
-
-    try:
-        # Создаем рабочие папки
-        os.makedirs(VIDEOS_FOLDER, exist_ok=True)
-        os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-
-        # Получаем информацию о файле
-        video = message.video
-        file_info = await bot.get_file(video.file_id)
-
-        # Генерируем уникальные имена файлов
-        user_id = message.from_user.id
-        timestamp = int(asyncio.get_event_loop().time())
-        input_filename = f"temp_{user_id}_{timestamp}.mp4"
-        output_filename = f"processed_{user_id}_{timestamp}.mp4"
-
-        input_path = os.path.join(VIDEOS_FOLDER, input_filename)
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+async def finish_video_state(state: FSMContext, outcome, retry_state):
+    """Состояние пользователя после задачи"""
+    if outcome == "done":
+        # Возвращаемся в состояние ожидания темы
+        await state.set_state(VideoProcessing.waiting_for_theme)
+    elif outcome == "rejected":
+        await state.set_state(retry_state)
+    elif outcome == "failed":
+        await state.clear()
+    # cancelled / interrupted: состояние уже сбросил тот, кто отменил задачу
 
-        logging.info(f"Скачиваю видео в: {input_path}")
-        logging.info(f"Тема: {theme}")
 
-        # Скачиваем видео
-        await status_message.edit_text("📥 Скачиваю видео...")
-        try:
-            await bot.download_file(file_info.file_path, input_path)
-            if not os.path.exists(input_path) or os.path.getsize(input_path) == 0:
-                raise Exception("Файл не скачался или пустой")
-            logging.info(f"Файл скачан. Размер: {os.path.getsize(input_path)} байт")
-        except Exception as e:
-            await status_message.edit_text(f"❌ Ошибка скачивания: {str(e)}")
-            await state.clear()
-            return
+async def job_theme(state: FSMContext):
+    """Тема для новой задачи и состояние, в которое вернуться, если задачу не приняли"""
+    if await state.get_state() == VideoProcessing.waiting_for_video:
+        user_data = await state.get_data()
+        return user_data.get('theme', DEFAULT_THEME), VideoProcessing.waiting_for_video
+    return DEFAULT_THEME, VideoProcessing.waiting_for_theme
 
-        # Обрабатываем видео
-        await status_message.edit_text(f"⚙️ Обрабатываю видео...\n🤔 Генерирую текст на тему: '{theme}'")
 
-        # Используем asyncio.to_thread для блокирующих операций
-        success, result_msg, title, desc, used_theme = await asyncio.to_thread(
-            process_single_video,
-            input_path,
-            output_path,
-            theme
-        )
+# Части альбома, которые еще собираются: media_group_id -> сообщения
+album_buffers = {}
 
-        if not success:
-            await status_message.edit_text(f"❌ {result_msg}")
-            await state.clear()
-            return
 
-        # Проверяем результат
-        if not os.path.exists(output_path):
-            await status_message.edit_text("❌ Обработанное видео не создано")
-            await state.clear()
-            return
+# Альбом из нескольких видео - одна пакетная задача, альбом из фото - один ролик
+@dp.message(F.media_group_id, F.video | F.photo)
+async def handle_video_album(message: Message, state: FSMContext):
+    # Telegram присылает каждое видео альбома отдельным апдейтом
+    group = album_buffers.get(message.media_group_id)
+    if group is not None:
+        group.append(message)
+        return
 
-        # Отправляем результат
-        await status_message.edit_text("📤 Отправляю результат...")
+    group = album_buffers[message.media_group_id] = [message]
+    # Ждем, пока части альбома перестанут приходить
+    collected = 0
+    while collected != len(group):
+        collected = len(group)
+        await asyncio.sleep(ALBUM_COLLECT_DELAY)
+    del album_buffers[message.media_group_id]
+    messages = sorted(group, key=lambda m: m.message_id)
 
-        try:
-            # Проверяем длину заголовка для Telegram caption
-            if title and len(title) > 1024:  # Ограничение Telegram для caption
-                caption = f"🎬 {title[:1021]}...\n\n📌 Тема: {used_theme}"
-            else:
-                caption = f"🎬 {title}\n\n📌 Тема: {used_theme}"
+    if await state.get_state() == VideoProcessing.processing:
+        await message.answer("⏳ Пожалуйста, подождите, текущее видео еще обрабатывается...")
+        return
 
-            # Отправляем видео с заголовком как подпись
-            video_file = FSInputFile(output_path, filename=output_filename)
-            await message.answer_video(
-                video_file,
-                caption=caption
-            )
+    theme, retry_state = await job_theme(state)
+    videos = [item for item in messages if item.video]
+    if not videos:
+        await state.set_state(VideoProcessing.processing)
+        outcome = await pipeline.run(VideoJob.from_photos(messages, theme, await message.answer(
+            f"🖼 Получен альбом из {len(messages)} фото. Тема: '{theme}'\n"
+            f"Собираю из них видео..."
+        )))
+        await finish_video_state(state, outcome, retry_state)
+        return
 
-            # Отправляем описание отдельным сообщением
-            if desc and desc != "Описание не сгенерировано":
-                # Форматируем описание для лучшей читаемости
-                description_text = f"""
-📝 ОПИСАНИЕ ДЛЯ INSTAGRAM:
-```Копировать
-{desc}
-```
-✨ Текст на видео: "{title}"
-🎯 Тема: {used_theme}
-                """
+    skipped = len(messages) - len(videos)
+    if len(videos) > 1 and get_user_setting(message.from_user.id, "reel"):
+        await state.set_state(VideoProcessing.processing)
+        outcome = await pipeline.run(VideoJob.from_clips(videos, theme, await message.answer(
+            f"🎞 Получен альбом из {len(videos)} видео. Тема: '{theme}'\n"
+            + (f"📌 Фото из альбома пропускаю ({skipped})\n" if skipped else "")
+            + "Склеиваю видео в один ролик..."
+        )))
+        await finish_video_state(state, outcome, retry_state)
+        return
 
-                # Разбиваем на части если слишком длинное (ограничение Telegram)
-                if len(description_text) > 4096:
-                    parts = [description_text[i:i + 4000] for i in range(0, len(description_text), 4000)]
-                    for part in parts:
-                        await message.answer(part)
-                else:
-                    await message.answer(description_text, parse_mode='Markdown')
+    status_message = await message.answer(
+        f"🎬 Получен альбом из {len(videos)} видео. Тема: '{theme}'\n"
+        + (f"📌 Фото из альбома пропускаю ({skipped}): видео из фото собираю только из альбома без видео\n" if skipped else "")
+        + "Обрабатываю все видео, результат пришлю одним альбомом..."
+    )
 
-            await status_message.delete()
+    await state.set_state(VideoProcessing.processing)
+    outcomes = await pipeline.run_album(
+        [VideoJob.from_message(item, theme) for item in videos],
+        status_message
+    )
 
-            # Предлагаем обработать еще одно видео
-            await message.answer(
-                "✅ Готово! Видео обработано успешно.\n\n"
-                "Хочешь обработать еще одно видео?\n"
-                "1. Отправь новую тему для текста\n"
-                "2. Или просто отправь следующее видео - будет использована стандартная тема\n\n"
-                "Для отмены используй /cancel"
-            )
+    # Итог альбома: готов, если отправлен хотя бы один ролик
+    if "done" in outcomes:
+        outcome = "done"
+    elif all(item == "rejected" for item in outcomes):
+        outcome = "rejected"
+    elif "failed" in outcomes or "rejected" in outcomes:
+        outcome = "failed"
+    else:
+        outcome = "cancelled"
+    await finish_video_state(state, outcome, retry_state)
 
-            # Возвращаемся в состояние ожидания темы
-            await state.set_state(VideoProcessing.waiting_for_theme)
 
-        except Exception as e:
-            await status_message.edit_text(f"❌ Ошибка отправки: {str(e)}")
-            logging.error(f"Ошибка отправки: {e}")
-            await state.clear()
+# Обработка видео с сохраненной темой
+@dp.message(VideoProcessing.waiting_for_video, F.video)
+async def handle_video_with_theme(message: Message, state: FSMContext):
+    # Получаем сохраненную тему
+    user_data = await state.get_data()
+    theme = user_data.get('theme', DEFAULT_THEME)
 
-    except Exception as e:
-        logging.error(f"Ошибка в handle_video: {e}")
-        try:
-            await message.answer(f"❌ Произошла ошибка: {str(e)}")
-        except:
-            pass
-        await state.clear()
+    # Уведомляем пользователя
+    status_message = await message.answer(f"🎬 Видео получено. Тема: '{theme}'\nНачинаю обработку...")
 
-    finally:
-        # Очистка временных файлов
-        try:
-            if 'input_path' in locals() and os.path.exists(input_path):
-                os.remove(input_path)
-            if 'output_path' in locals() and os.path.exists(output_path):
-                os.remove(output_path)
-        except Exception as e:
-            logging.error(f"Ошибка при очистке файлов: {e}")
+    await state.set_state(VideoProcessing.processing)
+    outcome = await pipeline.run(VideoJob.from_message(message, theme, status_message))
+    # Тема сохранена, при нехватке места можно прислать видео снова
+    await finish_video_state(state, outcome, VideoProcessing.waiting_for_video)
 
 
 # Обработка видео БЕЗ предварительного выбора темы (используется стандартная тема)
@@ -1149,157 +5143,35 @@ async def handle_video_without_theme(message: Message, state: FSMContext):
     if current_state == VideoProcessing.waiting_for_video:
         return
 
-    # Используем стандартную тему
-    standard_theme = "Философия барберинга, мужской стиль и уход за собой"
-
     await message.answer(
-        f"🎬 Видео получено. Использую стандартную тему: '{standard_theme}'\n\n"
+        f"🎬 Видео получено. Использую стандартную тему: '{DEFAULT_THEME}'\n\n"
         f"⏳ Начинаю обработку...\n\n"
         f"ℹ️ Если хотите задать свою тему, сначала отправьте текст темы, а затем видео"
     )
 
     # Устанавливаем состояние обработки
     await state.set_state(VideoProcessing.processing)
+    outcome = await pipeline.run(VideoJob.from_message(message, DEFAULT_THEME))
+    await finish_video_state(state, outcome, VideoProcessing.waiting_for_theme)
 
-    try:
-        # Создаем рабочие папки
-        os.makedirs(VIDEOS_FOLDER, exist_ok=True)
-        os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-
-        # Получаем информацию о файле
-        video = message.video
-        file_info = await bot.get_file(video.file_id)
-
-        # Генерируем уникальные имена файлов
-        user_id = message.from_user.id
-        timestamp = int(asyncio.get_event_loop().time())
-        input_filename = f"temp_{user_id}_{timestamp}.mp4"
-        output_filename = f"processed_{user_id}_{timestamp}.mp4"
-
-        input_path = os.path.join(VIDEOS_FOLDER, input_filename)
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
-
-        logging.info(f"Скачиваю видео в: {input_path}")
-        logging.info(f"Использую стандартную тему: {standard_theme}")
-
-        # Скачиваем видео
-        status_message = await message.answer("📥 Скачиваю видео...")
-        try:
-            await bot.download_file(file_info.file_path, input_path)
-            if not os.path.exists(input_path) or os.path.getsize(input_path) == 0:
-                raise Exception("Файл не скачался или пустой")
-            logging.info(f"Файл скачан. Размер: {os.path.getsize(input_path)} байт")
-        except Exception as e:
-            await status_message.edit_text(f"❌ Ошибка скачивания: {str(e)}")
-            await state.clear()
-            return
-
-        # Обрабатываем видео
-        await status_message.edit_text(f"⚙️ Обрабатываю видео...\n🤔 Генерирую текст на стандартную тему...")
-
-        # Используем asyncio.to_thread для блокирующих операций
-        success, result_msg, title, desc, used_theme = await asyncio.to_thread(
-            process_single_video,
-            input_path,
-            output_path,
-            standard_theme
-        )
-
-        if not success:
-            await status_message.edit_text(f"❌ {result_msg}")
-            await state.clear()
-            return
-
-        # Проверяем результат
-        if not os.path.exists(output_path):
-            await status_message.edit_text("❌ Обработанное видео не создано")
-            await state.clear()
-            return
-
-        # Отправляем результат
-        await status_message.edit_text("📤 Отправляю результат...")
-
-        try:
-            # Проверяем длину заголовка для Telegram caption
-            if title and len(title) > 1024:  # Ограничение Telegram для caption
-                caption = f"🎬 {title[:1021]}...\n\n📌 Тема: {used_theme}"
-            else:
-                caption = f"🎬 {title}\n\n📌 Тема: {used_theme}"
-
-            # Отправляем видео с заголовком как подпись
-            video_file = FSInputFile(output_path, filename=output_filename)
-            await message.answer_video(
-                video_file,
-                caption=caption
-            )
-
-            # Отправляем описание отдельным сообщением
-            if desc and desc != "Описание не сгенерировано":
-                # Форматируем описание для лучшей читаемости
-                description_text = f"""
-📝 ОПИСАНИЕ ДЛЯ INSTAGRAM:
-```Копировать
-{desc}
-```
-✨ Текст на видео: "{title}"
-🎯 Тема: {used_theme}
-                """
-
-                # Разбиваем на части если слишком длинное (ограничение Telegram)
-                if len(description_text) > 4096:
-                    parts = [description_text[i:i + 4000] for i in range(0, len(description_text), 4000)]
-                    for part in parts:
-                        await message.answer(part)
-                else:
-                    await message.answer(description_text, parse_mode='Markdown')
-
-            await status_message.delete()
-
-            # Предлагаем обработать еще одно видео
-            await message.answer(
-                "✅ Готово! Видео обработано успешно.\n\n"
-                "Хочешь обработать еще одно видео?\n"
-                "1. Отправь новую тему для текста\n"
-                "2. Или просто отправь следующее видео - будет использована стандартная тема\n\n"
-                "Для отмены используй /cancel"
-            )
-
-            # Возвращаемся в состояние ожидания темы
-            await state.set_state(VideoProcessing.waiting_for_theme)
-
-        except Exception as e:
-            await status_message.edit_text(f"❌ Ошибка отправки: {str(e)}")
-            logging.error(f"Ошибка отправки: {e}")
-            await state.clear()
-
-    except Exception as e:
-        logging.error(f"Ошибка в handle_video_without_theme: {e}")
-        try:
-            await message.answer(f"❌ Произошла ошибка: {str(e)}")
-        except:
-            pass
-        await state.clear()
-
-    finally:
-        # Очистка временных файлов
-        try:
-            if 'input_path' in locals() and os.path.exists(input_path):
-                os.remove(input_path)
-            if 'output_path' in locals() and os.path.exists(output_path):
-                os.remove(output_path)
-        except Exception as e:
-            logging.error(f"Ошибка при очистке файлов: {e}")
 
+# Фото - короткий ролик с движением камеры по нему (тема - как у видео)
+@dp.message(F.photo)
+async def handle_photo(message: Message, state: FSMContext):
+    if await state.get_state() == VideoProcessing.processing:
+        await message.answer("⏳ Пожалуйста, подождите, текущее видео еще обрабатывается...")
+        return
 
-# Если в состоянии waiting_for_theme пришло фото
-@dp.message(VideoProcessing.waiting_for_theme, F.photo)
-async def handle_photo_in_theme_state(message: Message):
-    await message.answer(
-        "📌 Вы отправили фото, но я ожидаю тему для текста.\n\n"
-        "Пожалуйста, отправьте текстовое сообщение с темой (например: 'стиль, уход, профессия')\n"
-        "Или используйте /default для стандартной темы"
+    theme, retry_state = await job_theme(state)
+    status_message = await message.answer(
+        f"🖼 Фото получено. Тема: '{theme}'\nСобираю из него видео...\n\n"
+        f"ℹ️ Несколько фото одним альбомом - и видео будет из всех"
     )
 
+    await state.set_state(VideoProcessing.processing)
+    outcome = await pipeline.run(VideoJob.from_photos([message], theme, status_message))
+    await finish_video_state(state, outcome, retry_state)
+
 
 # Если в состоянии waiting_for_theme пришел документ
 @dp.message(VideoProcessing.waiting_for_theme, F.document)
@@ -1349,9 +5221,18 @@ async def graceful_shutdown():
     logging.info("Начинаю плавное завершение работы...")
 
     try:
+        # Новые апдейты уже не принимаются (поллинг остановлен) - дожидаемся текущих задач
+        interrupted = await drain_jobs(SHUTDOWN_DRAIN_TIMEOUT)
+        if interrupted:
+            logging.info(f"Прервано задач: {interrupted}, они продолжатся после запуска")
+
         # Отправляем уведомление об остановке только если бот работал
         try:
-            text = "🛑 Бот завершает работу. Все текущие операции будут прерваны.\n\nСпасибо за использование!"
+            text = (
+                "🛑 Бот завершает работу.\n\n"
+                "Видео, которые не успели обработаться, будут обработаны автоматически после запуска.\n\n"
+                "Спасибо за использование!"
+            )
             sent, failed = await broadcast_message(text)
             logging.info(f"Уведомление о завершении отправлено: {sent} успешно, {failed} неудачно")
         except Exception as e:
@@ -1367,6 +5248,10 @@ async def graceful_shutdown():
         save_subscribed_users()
         logging.info("Список пользователей сохранен")
 
+        journal.close()
+        job_history.close()
+        await downloader.close()
+
         # Закрываем сессию бота
         try:
             await bot.session.close()
@@ -1377,32 +5262,73 @@ async def graceful_shutdown():
 
 
 # ============ ЗАПУСК БОТА ============
+# Фоновые задачи без владельца: event loop держит на задачи только слабые ссылки
+BACKGROUND_TASKS = set()
+
+
+def start_background(coro):
+    """Запускает задачу в фоне и держит ссылку на нее, пока она не закончится"""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
 
 async def main():
-    global SUBSCRIBED_USERS
+    global SUBSCRIBED_USERS, USER_SETTINGS
 
     logging.info("Запуск бота...")
+    # Первым делом, пока не запущены потоки метрик и to_thread
+    reserve_bot_cores()
 
     # Загружаем подписчиков
     SUBSCRIBED_USERS = load_subscribed_users()
     logging.info(f"Загружено {len(SUBSCRIBED_USERS)} подписчиков")
+    USER_SETTINGS = load_user_settings()
 
     # Создаем необходимые папки
     os.makedirs(VIDEOS_FOLDER, exist_ok=True)
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+    # Незавершенные задачи из журнала и мусор от упавших запусков
+    storage.scan()
+    unfinished_jobs = journal.load()
+    removed = collect_orphaned_files(journal.referenced_paths())
+    logging.info(f"Незавершенных задач: {len(unfinished_jobs)}, удалено осиротевших файлов: {removed}")
+
+    # Метрики для Prometheus (/metrics) и мониторинг event loop
+    if METRICS_PORT:
+        try:
+            start_http_server(METRICS_PORT)
+            logging.info(f"Метрики доступны на :{METRICS_PORT}/metrics")
+        except Exception as e:
+            logging.error(f"Не удалось запустить сервер метрик: {e}")
+    lag_task = asyncio.create_task(monitor_event_loop_lag())
+    janitor_task = asyncio.create_task(run_storage_janitor())
+    # Заставки под частые профили кодируем заранее, в фоне
+    start_background(asyncio.to_thread(warm_bumpers))
+    # Треки фоновой музыки декодируем и меряем заранее
+    start_background(asyncio.to_thread(music_library.warm))
+
     try:
         # Отправляем уведомление о запуске
         await send_bot_started_notification()
 
+        # Возобновляем задачи, прерванные прошлым запуском
+        for job in unfinished_jobs:
+            start_background(resume_job(job))
+
         # Удаляем вебхуки и начинаем поллинг
+        # (сессию не закрываем - она нужна задачам, которые дорабатывают при остановке)
         await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot)
+        await dp.start_polling(bot, close_bot_session=False)
     except KeyboardInterrupt:
         logging.info("Получен сигнал KeyboardInterrupt")
     except Exception as e:
         logging.error(f"Критическая ошибка при запуске бота: {e}")
     finally:
+        lag_task.cancel()
+        janitor_task.cancel()
         # Всегда выполняем graceful shutdown
         await graceful_shutdown()
 